@@ -4,12 +4,14 @@
 from __future__ import (absolute_import, division, unicode_literals)
 
 import os
+import copy
 import logging
 from binascii import b2a_hex
 
 from avax.repository.errors import ObjectNotExist
 
 from .wsgidav import util
+from .wsgidav.timing import timed
 from .wsgidav import xml_tools
 from .wsgidav.util import etree
 from .wsgidav.dav_error import DAVError, HTTP_FORBIDDEN
@@ -20,6 +22,38 @@ BUFFER_SIZE = 8192
 logger = logging.getLogger(__name__)
 # logger.addHandler(logging.NullHandler())
 
+# environ key of the per-request cache for parsed xattr values
+_PARSED_XATTRS_KEY = b'archive_provider.parsed_xattrs'
+
+
+def load_xattrs(resources):
+    """Fetch all extended attributes for a list of archive resources.
+
+    The names and raw values of each resource are read in one pass and
+    kept on the resource, so later property lookups don't go to the
+    repository again. Resources that are already loaded are skipped.
+    """
+    for res in resources:
+        if res is None or res._xattrs is not None:
+            continue
+        content_item = res._content_item
+        res._xattrs = dict((name, content_item.get_xattr(name))
+                           for name in content_item.list_xattrs())
+
+
+def parse_xattr(environ, value):
+    """Return an XML element for a stored xattr value.
+
+    Parsed values are memoized per request, since the same values tend to
+    show up for many resources of a PROPFIND response. A copy is returned
+    because an element can only be attached to one response.
+    """
+    cache = environ.setdefault(_PARSED_XATTRS_KEY, {})
+    el = cache.get(value)
+    if el is None:
+        el = cache[value] = xml_tools.stringToXML(value)
+    return copy.deepcopy(el)
+
 
 class FileResource(DAVNonCollection):
     """Represents a single existing DAV resource instance.
@@ -30,6 +64,8 @@ class FileResource(DAVNonCollection):
         super(FileResource, self).__init__(path, environ)
         self._batch = batch
         self._content_item = content_item
+        self._content_type = None
+        self._xattrs = None
         # Setting the name from the file path should fix the case on Windows
         self.name = os.path.basename(self.path)
         # self.name = self.name.encode("utf8")
@@ -39,10 +75,12 @@ class FileResource(DAVNonCollection):
         return self._content_item.length
 
     def getContentType(self):
-        mime_type = self._content_item.mime_type
-        if not mime_type or mime_type == b'application/octet-stream':
-            return util.guessMimeType(self.path)
-        return mime_type
+        if self._content_type is None:
+            mime_type = self._content_item.mime_type
+            if not mime_type or mime_type == b'application/octet-stream':
+                mime_type = util.guessMimeType(self.path)
+            self._content_type = mime_type
+        return self._content_type
 
     def getCreationDate(self):
         return self._content_item.created_at
@@ -58,14 +96,16 @@ class FileResource(DAVNonCollection):
 
     def getPropertyNames(self, isAllProp):
         prop_name_list = super(FileResource, self).getPropertyNames(isAllProp)
-        prop_name_list.extend(self._content_item.list_xattrs())
+        load_xattrs([self])
+        prop_name_list.extend(self._xattrs.keys())
 
         return prop_name_list
 
     def getPropertyValue(self, propname):
-        value = self._content_item.get_xattr(propname)
+        load_xattrs([self])
+        value = self._xattrs.get(propname)
         if value:
-            return xml_tools.stringToXML(value)
+            return parse_xattr(self.environ, value)
 
         return super(FileResource, self).getPropertyValue(propname)
 
@@ -78,6 +118,7 @@ class FileResource(DAVNonCollection):
             else:
                 value = etree.tostring(value)
                 self._content_item.set_xattr(propname, value)
+            self._xattrs = None
 
     def supportEtag(self):
         return True
@@ -105,6 +146,7 @@ class FileResource(DAVNonCollection):
         if contentType:
             logger.debug("Client provided content type: %s", contentType)
             self._content_item.mime_type = contentType
+            self._content_type = None
             self._batch.dirty = True
         return self._content_item.put_content_as_stream()
 
@@ -198,6 +240,7 @@ class FolderResource(DAVCollection):
         super(FolderResource, self).__init__(path, environ)
         self._batch = batch
         self._content_item = content_item
+        self._xattrs = None
         # Setting the name from the file path should fix the case on Windows
         self.name = os.path.basename(path)
 
@@ -220,14 +263,16 @@ class FolderResource(DAVCollection):
 
     def getPropertyNames(self, isAllProp):
         prop_name_list = super(FolderResource, self).getPropertyNames(isAllProp)
-        prop_name_list.extend(self._content_item.list_xattrs())
+        load_xattrs([self])
+        prop_name_list.extend(self._xattrs.keys())
 
         return prop_name_list
 
     def getPropertyValue(self, propname):
-        value = self._content_item.get_xattr(propname)
+        load_xattrs([self])
+        value = self._xattrs.get(propname)
         if value:
-            return xml_tools.stringToXML(value)
+            return parse_xattr(self.environ, value)
 
         return super(FolderResource, self).getPropertyValue(propname)
 
@@ -240,9 +285,11 @@ class FolderResource(DAVCollection):
             else:
                 value = etree.tostring(value)
                 self._content_item.set_xattr(propname, value)
+            self._xattrs = None
 
     def removeAllProperties(self, recursive):
         self._content_item.remove_all_xattrs()
+        self._xattrs = None
 
     def getMemberNames(self):
         """Return list of direct collection member names (utf-8 encoded).
@@ -256,6 +303,19 @@ class FolderResource(DAVCollection):
         logger.info("member names: %r", name_list)
         return name_list
 
+    def getMemberList(self):
+        """Return list of direct members.
+
+        For PROPFIND the extended attributes of all members are fetched
+        right away.
+
+        See DAVCollection.getMemberList()
+        """
+        member_list = super(FolderResource, self).getMemberList()
+        if self.environ.get(b'REQUEST_METHOD') == b'PROPFIND':
+            load_xattrs(member_list)
+        return member_list
+
     def getMember(self, name):
         """Return direct collection member (DAVResource or derived).
 
@@ -412,6 +472,7 @@ class ArchiveProvider(DAVProvider):
         batch = environ.get(b'batch', None)
         return batch.item_exists(path)
 
+    @timed(b"resource", 2)
     def getResourceInst(self, full_path, environ):
         """Return info dictionary for path.
 
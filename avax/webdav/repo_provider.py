@@ -6,6 +6,7 @@ import logging
 
 from binascii import b2a_hex
 from .wsgidav import util
+from .wsgidav.timing import timed
 from .wsgidav.dav_error import DAVError, HTTP_FORBIDDEN
 from .wsgidav.dav_provider import DAVProvider, DAVCollection, DAVNonCollection
 
@@ -126,6 +127,7 @@ class RepositoryProvider(DAVProvider):
         path = path.strip(b'/')
         return self.repository.has_repository(path)
 
+    @timed(b"resource", 2)
     def getResourceInst(self, path, environ):
         """Return info dictionary for path.
 
@@ -0,0 +1,81 @@
+# -*- coding: iso-8859-1 -*-
+"""Unit test for access_log.py"""
+import threading
+import time
+import unittest
+from StringIO import StringIO
+from avax.webdav.wsgidav.access_log import AccessLogger
+
+
+class _SlowStream(object):
+    """Stream that blocks until released."""
+    def __init__(self):
+        self.released = threading.Event()
+        self.data = []
+
+    def write(self, s):
+        self.released.wait(5)
+        self.data.append(s)
+
+    def flush(self):
+        pass
+
+
+class BasicTest(unittest.TestCase):
+    """Test access_log.AccessLogger()."""
+
+    environ = {"REMOTE_ADDR": "127.0.0.1",
+               "REQUEST_METHOD": "GET",
+               "SCRIPT_NAME": "/dav",
+               "PATH_INFO": "/a b.txt",
+               "http_authenticator.username": "tester",
+               }
+
+    def _log(self, al, status="200 OK", headers=()):
+        entry = al.makeEntry(self.environ, status, list(headers), time.time())
+        al.log(entry)
+        return entry
+
+    def testClassic(self):
+        """Default format should be the classic request summary."""
+        stream = StringIO()
+        al = AccessLogger(stream, flushInterval=0.01)
+        self._log(al, headers=[("Content-Length", "42")])
+        al.close()
+        line = stream.getvalue()
+        self.assertTrue(line.endswith("\n"))
+        self.assertTrue(' 127.0.0.1 - tester - [' in line, line)
+        self.assertTrue('"GET /a b.txt" bytes=42, elap=' in line, line)
+        self.assertTrue(line.endswith("-> 200 OK\n"), line)
+
+    def testFields(self):
+        """Configured fields should be written as name=value pairs."""
+        stream = StringIO()
+        al = AccessLogger(stream, fields=["method", "uri", "status", "bytes"],
+                          flushInterval=0.01)
+        entry = self._log(al, status="404 Not Found")
+        self.assertEqual(al.formatEntry(entry),
+                         'method=GET uri="/dav/a b.txt" status=404 bytes=-')
+        self.assertRaises(ValueError, AccessLogger, fields=["method", "bogus"])
+        al.close()
+        self.assertEqual(al.written, 1)
+
+    def testDrop(self):
+        """A slow stream should cause dropped entries, not blocked requests."""
+        stream = _SlowStream()
+        al = AccessLogger(stream, maxQueued=10, flushInterval=0.01)
+        self._log(al)
+        time.sleep(0.1)  # Writer is now blocked in write()
+        start = time.time()
+        for _ in range(100):
+            self._log(al)
+        self.assertTrue(time.time() - start < 1.0, "log() blocked")
+        self.assertEqual(al.dropped, 90)
+        stream.released.set()
+        al.close()
+        self.assertEqual(al.written, 11)
+        self.assertTrue("90 entries dropped" in stream.data[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
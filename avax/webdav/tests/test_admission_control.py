@@ -0,0 +1,127 @@
+# -*- coding: iso-8859-1 -*-
+"""Unit test for admission_control.py"""
+import threading
+import unittest
+from avax.webdav.wsgidav.dav_error import DAVError, HTTP_SERVICE_UNAVAILABLE
+from avax.webdav.wsgidav.admission_control import AdmissionController
+
+
+class _Res(object):
+    """Minimal resource stub."""
+    def __init__(self, refUrl, isCollection=True):
+        self.refUrl = refUrl
+        self.isCollection = isCollection
+
+    def getRefUrl(self):
+        return self.refUrl
+
+
+class BasicTest(unittest.TestCase):
+    """Test admission_control.AdmissionController()."""
+
+    def setUp(self):
+        self.ac = AdmissionController(maxHeavy=2, maxHeavyPerUser=1,
+                                      queueTimeout=0.2, retryAfter=7,
+                                      heavyCost=100)
+
+    def _environ(self, user, remoteAddr="127.0.0.1"):
+        return {"http_authenticator.username": user, "REMOTE_ADDR": remoteAddr,
+                "REQUEST_METHOD": "PROPFIND"}
+
+
+    def testCost(self):
+        """Only large subtrees should be heavy."""
+        ac = self.ac
+        tree = _Res("/dav/tree/")
+        assert ac.estimateCost(_Res("/dav/file", False), "infinity") == 1
+        assert ac.estimateCost(tree, "1") == 1
+        assert ac.estimateCost(tree, "infinity") is None
+        # Unknown sizes need a slot (and are learned by the tree walk)
+        assert ac.isHeavy(None)
+        ticket = ac.admit(self._environ("joe"), tree, "infinity")
+        assert ticket is not None
+        self.assertEqual(ac.running, 1)
+        ac.release(ticket)
+        self.assertEqual(ac.running, 0)
+        ac.recordCost(tree, 10)
+        assert ac.estimateCost(tree, "infinity") == 10
+        assert ac.admit(self._environ("joe"), tree, "infinity") is None
+        ac.recordCost(tree, 1000)
+        assert ac.isHeavy(ac.estimateCost(tree, "infinity"))
+
+
+    def testLimits(self):
+        """Heavy operations should be limited per user and per server."""
+        ac = self.ac
+        tree = _Res("/dav/tree/")
+        ac.recordCost(tree, 1000)
+        t1 = ac.admit(self._environ("joe"), tree, "infinity")
+        assert t1 is not None
+        # Same user must wait, and is finally rejected
+        try:
+            ac.admit(self._environ("joe"), tree, "infinity")
+            self.fail("Second heavy operation of the same user was admitted")
+        except DAVError, e:
+            self.assertEqual(e.value, HTTP_SERVICE_UNAVAILABLE)
+            self.assertEqual(e.headers, [("Retry-After", "7")])
+        t2 = ac.admit(self._environ("ann"), tree, "infinity")
+        self.assertRaises(DAVError, ac.admit, self._environ("bob"), tree, "infinity")
+        ac.release(t1)
+        ac.release(t2)
+        ac.release(ac.admit(self._environ("joe"), tree, "infinity"))
+
+
+    def testQueue(self):
+        """Waiting operations should be admitted when a slot is freed."""
+        ac = AdmissionController(maxHeavy=1, queueTimeout=5)
+        tree = _Res("/dav/tree/")
+        ac.recordCost(tree, 1000)
+        ticket = ac.admit(self._environ("joe"), tree, "infinity")
+        threading.Timer(0.1, ac.release, [ticket]).start()
+        ticket = ac.admit(self._environ("ann"), tree, "infinity")
+        assert ticket is not None
+        ac.release(ticket)
+
+
+    def testColdWalk(self):
+        """Only one walk of a subtree of unknown size should run at a time."""
+        ac = AdmissionController(maxHeavyPerUser=2, queueTimeout=0.2,
+                                 heavyCost=100, maxUnknown=2)
+        tree = _Res("/dav/tree/")
+        t1 = ac.admit(self._environ("joe"), tree, "infinity")
+        # Same subtree must wait for the first walk
+        self.assertRaises(DAVError, ac.admit, self._environ("ann"), tree, "infinity")
+        # ... which is limited per user like heavy operations
+        t2 = ac.admit(self._environ("joe"), _Res("/dav/other/"), "infinity")
+        self.assertRaises(DAVError, ac.admit, self._environ("joe"),
+                          _Res("/dav/third/"), "infinity")
+        # ... and server-wide by maxUnknown
+        self.assertRaises(DAVError, ac.admit, self._environ("bob"),
+                          _Res("/dav/third/"), "infinity")
+        ac.release(t2)
+
+        # When the walk finds a small subtree, waiting requests run without a slot
+        ac.queueTimeout = 5
+        def finish():
+            ac.recordCost(tree, 10)
+            ac.release(t1)
+        threading.Timer(0.1, finish).start()
+        assert ac.admit(self._environ("ann"), tree, "infinity") is None
+        self.assertEqual(ac.running, 0)
+
+
+    def testAnonymous(self):
+        """Anonymous clients should be limited per remote address."""
+        ac = self.ac
+        tree = _Res("/dav/tree/")
+        ac.recordCost(tree, 1000)
+        t1 = ac.admit(self._environ("", "10.0.0.1"), tree, "infinity")
+        t2 = ac.admit(self._environ(None, "10.0.0.2"), tree, "infinity")
+        ac.release(t2)
+        self.assertRaises(DAVError, ac.admit, self._environ("", "10.0.0.1"),
+                          tree, "infinity")
+        ac.release(t1)
+
+
+if __name__ == "__main__":
+    unittest.main()
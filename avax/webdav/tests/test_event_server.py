@@ -0,0 +1,190 @@
+# -*- coding: iso-8859-1 -*-
+"""Unit test for server/event_server.py"""
+import socket
+import struct
+import threading
+import time
+import unittest
+from avax.webdav.wsgidav.server.event_server import EventServer
+
+
+class _App(object):
+    """WSGI application that records the threads it runs on."""
+
+    def __init__(self, size=10, chunk=1024):
+        self.size = size
+        self.chunk = chunk
+        self.gate = None  # Event the application waits for, if set
+        self.calls = []
+        self.closes = []
+        self.closed = threading.Event()
+
+    def __call__(self, environ, start_response):
+        self.calls.append((environ["PATH_INFO"], threading.current_thread()))
+        if self.gate is not None:
+            self.gate.wait(5)
+        size = self.size
+        if environ["PATH_INFO"] == "/small":
+            size = 10
+        start_response("200 OK", [("Content-Type", "text/plain"),
+                                  ("Content-Length", str(size))])
+        return _Body(self, size)
+
+
+class _Body(object):
+
+    def __init__(self, app, size):
+        self.app = app
+        self.size = size
+
+    def __iter__(self):
+        left = self.size
+        while left > 0:
+            n = min(left, self.app.chunk)
+            left -= n
+            yield b"x" * n
+
+    def close(self):
+        self.app.closes.append(threading.current_thread())
+        self.app.closed.set()
+
+
+def _readResponse(f):
+    status = f.readline()
+    headers = {}
+    while True:
+        line = f.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, value = line.split(b":", 1)
+        headers[name.strip().lower()] = value.strip()
+    body = f.read(int(headers[b"content-length"]))
+    return status.split()[1], body
+
+
+class EventServerTest(unittest.TestCase):
+    """Test event_server.EventServer()."""
+
+    def _start(self, app, **kwargs):
+        self.server = EventServer(app, ("127.0.0.1", 0), **kwargs)
+        self.server.bind()
+        self.loop = threading.Thread(target=self.server.serve_forever)
+        self.loop.daemon = True
+        self.loop.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for s in self.sockets:
+            s.close()
+        self.server.stop()
+        self.loop.join(10)
+
+    def _connect(self):
+        s = socket.create_connection(self.server.bindAddress, 5)
+        self.sockets.append(s)
+        return s
+
+    def _get(self, s, path="/small"):
+        s.sendall(b"GET %s HTTP/1.1\r\nHost: test\r\n\r\n" % path)
+
+
+    def testKeepAlive(self):
+        """Requests on one connection should reuse it."""
+        self._start(_App())
+        s = self._connect()
+        f = s.makefile("rb")
+        for _ in range(3):
+            self._get(s)
+            self.assertEqual(_readResponse(f), (b"200", b"x" * 10))
+
+
+    def testPipelining(self):
+        """Pipelined requests should be answered in order."""
+        app = _App()
+        self._start(app)
+        s = self._connect()
+        s.sendall(b"GET /a HTTP/1.1\r\nHost: test\r\n\r\n"
+                  b"GET /small HTTP/1.1\r\nHost: test\r\n\r\n")
+        f = s.makefile("rb")
+        self.assertEqual(_readResponse(f), (b"200", b"x" * 10))
+        self.assertEqual(_readResponse(f), (b"200", b"x" * 10))
+        self.assertEqual([path for path, _t in app.calls], ["/a", "/small"])
+
+
+    def testSlowReader(self):
+        """A slow reader should not hold the only worker."""
+        app = _App(size=512 * 1024)
+        self._start(app, threads=1, highWater=4096)
+        slow = self._connect()
+        slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self._get(slow, "/big")
+        time.sleep(0.2)
+        s = self._connect()
+        self._get(s)
+        self.assertEqual(_readResponse(s.makefile("rb")), (b"200", b"x" * 10))
+        status, body = _readResponse(slow.makefile("rb"))
+        self.assertEqual(status, b"200")
+        self.assertEqual(len(body), 512 * 1024)
+        self.assertEqual(len(app.closes), 2)
+        assert self.loop not in app.closes
+
+
+    def testDisconnect(self):
+        """A response should be closed once, by its worker, on disconnect."""
+        app = _App(size=64 * 1024 * 1024)
+        self._start(app, highWater=4096)
+        s = self._connect()
+        self._get(s, "/big")
+        assert s.recv(1024)
+        s.close()
+        assert app.closed.wait(5)
+        time.sleep(0.2)
+        self.assertEqual(len(app.closes), 1)
+        assert app.closes[0] is app.calls[0][1]
+        assert app.closes[0] is not self.loop
+
+
+    def testReset(self):
+        """A connection reset while the app runs should be closed at once."""
+        app = _App()
+        app.gate = threading.Event()
+        self._start(app)
+        s = self._connect()
+        self._get(s)
+        time.sleep(0.2)
+        self.assertEqual(len(self.server._connections), 1)
+        # Send RST on close
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        s.close()
+        deadline = time.time() + 2
+        while self.server._connections and time.time() < deadline:
+            time.sleep(0.01)
+        # Closed by the loop while the request is still running
+        self.assertEqual(self.server._connections, {})
+        self.assertEqual(app.closes, [])
+        app.gate.set()
+        assert app.closed.wait(5)
+        self.assertEqual(len(app.closes), 1)
+        assert app.closes[0] is app.calls[0][1]
+
+
+    def testSaturation(self):
+        """Requests should wait while all workers are busy and the queue is full."""
+        app = _App()
+        app.gate = threading.Event()
+        self._start(app, threads=1, maxQueued=1)
+        conns = [self._connect() for _ in range(4)]
+        for s in conns:
+            self._get(s)
+        time.sleep(0.2)
+        self.assertEqual(len(app.calls), 1)
+        app.gate.set()
+        for s in conns:
+            self.assertEqual(_readResponse(s.makefile("rb")), (b"200", b"x" * 10))
+        self.assertEqual(len(app.calls), 4)
+        self.assertEqual(len(app.closes), 4)
+        assert self.loop not in app.closes
+
+
+if __name__ == "__main__":
+    unittest.main()
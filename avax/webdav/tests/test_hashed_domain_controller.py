@@ -0,0 +1,85 @@
+# -*- coding: iso-8859-1 -*-
+"""Unit test for addons/hashed_domain_controller.py"""
+import os
+import time
+import unittest
+from tempfile import mkstemp
+from avax.webdav.wsgidav.addons import hashed_domain_controller
+from avax.webdav.wsgidav.addons.hashed_domain_controller import HashedDomainController
+
+
+class BasicTest(unittest.TestCase):
+    """Test hashed_domain_controller.HashedDomainController()."""
+
+    def setUp(self):
+        fd, self.path = mkstemp()
+        os.close(fd)
+        self._write("secret")
+        self.dc = HashedDomainController(self.path, cacheTTL=60, reloadInterval=0)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _write(self, password):
+        with open(self.path, "wb") as f:
+            f.write("# realm:username:hash\n")
+            f.write("/dav:tester:%s\n" % hashed_domain_controller.hashPassword(password, 1000))
+
+    def _environ(self, password):
+        return {"HTTP_AUTHORIZATION": "Basic " + ("tester:" + password).encode("base64").strip()}
+
+    def testHash(self):
+        """Hash values should verify the right password only."""
+        h = hashed_domain_controller.hashPassword("secret", 1000)
+        assert h != hashed_domain_controller.hashPassword("secret", 1000), "Salt missing"
+        assert hashed_domain_controller.verifyPassword("secret", h)
+        assert not hashed_domain_controller.verifyPassword("Secret", h)
+        assert not hashed_domain_controller.verifyPassword("secret", "md5$1$x$y")
+
+    def testAuth(self):
+        """Users should be authenticated, verified headers cached."""
+        dc = self.dc
+        assert dc.requireAuthentication("/dav", {})
+        assert not dc.requireAuthentication("/other", {})
+        assert dc.isRealmUser("/dav", "tester", {})
+        assert dc.getRealmUserPassword("/dav", "tester", {}) is None
+
+        assert not dc.authDomainUser("/dav", "tester", "wrong", self._environ("wrong"))
+        assert dc.authDomainUser("/dav", "tester", "secret", self._environ("secret"))
+        self.assertEqual(len(dc._cache._entries), 1)
+        # Cached: the password is not checked again
+        assert dc.authDomainUser("/dav", "tester", "-", self._environ("secret"))
+        assert not dc.authDomainUser("/dav", "other", "secret", self._environ("secret"))
+        assert not dc.authDomainUser("/dav2", "tester", "-", self._environ("secret"))
+
+    def testReload(self):
+        """Changing the credential file should invalidate the cache."""
+        dc = self.dc
+        assert dc.authDomainUser("/dav", "tester", "secret", self._environ("secret"))
+        self._write("changed")
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        dc.requireAuthentication("/dav", {})
+        assert not dc.authDomainUser("/dav", "tester", "secret", self._environ("secret"))
+        assert dc.authDomainUser("/dav", "tester", "changed", self._environ("changed"))
+
+    def testReloadDuringVerification(self):
+        """A verification that ends after a reload should not be cached."""
+        dc = self.dc
+        verifyPassword = hashed_domain_controller.verifyPassword
+
+        def verifyAndReload(password, hashValue):
+            result = verifyPassword(password, hashValue)
+            self._write("changed")
+            os.utime(self.path, (time.time() + 10, time.time() + 10))
+            dc.requireAuthentication("/dav", {})
+            return result
+        hashed_domain_controller.verifyPassword = verifyAndReload
+        try:
+            assert dc.authDomainUser("/dav", "tester", "secret", self._environ("secret"))
+        finally:
+            hashed_domain_controller.verifyPassword = verifyPassword
+        assert not dc.authDomainUser("/dav", "tester", "-", self._environ("secret"))
+
+
+if __name__ == "__main__":
+    unittest.main()
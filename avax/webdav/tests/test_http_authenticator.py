@@ -0,0 +1,207 @@
+# -*- coding: iso-8859-1 -*-
+"""Unit test for http_authenticator.py"""
+import re
+import unittest
+from hashlib import md5
+from avax.webdav.wsgidav.domain_controller import WsgiDAVDomainController
+from avax.webdav.wsgidav.http_authenticator import HTTPAuthenticator, NonceManager, SessionCookies
+
+
+class _Provider(object):
+    sharePath = "/dav"
+
+
+def _app(environ, start_response):
+    start_response("200 OK", [("Content-Length", "2")])
+    return ["ok"]
+
+
+def _md5h(s):
+    return md5(s).hexdigest()
+
+
+class DigestTest(unittest.TestCase):
+    """Test digest authentication with HTTPAuthenticator()."""
+
+    def setUp(self):
+        self.dc = WsgiDAVDomainController(
+            {"/dav": {"tester": {"password": "secret"}}})
+        self.nm = NonceManager(lifetime=60)
+        self.auth = HTTPAuthenticator(_app, self.dc, nonceManager=self.nm)
+
+    def _request(self, authorization=None):
+        environ = {"PATH_INFO": "/a.txt",
+                   "REQUEST_METHOD": "GET",
+                   "wsgidav.provider": _Provider(),
+                   "wsgidav.verbose": 0,
+                   }
+        if authorization:
+            environ["HTTP_AUTHORIZATION"] = authorization
+        result = {}
+        def start_response(status, headers, exc_info=None):
+            result["status"] = status
+            result["headers"] = dict(headers)
+        self.auth(environ, start_response)
+        return result
+
+    def _authorization(self, nonce, nc, password="secret"):
+        ha1 = _md5h("tester:/dav:%s" % password)
+        ha2 = _md5h("GET:/dav/a.txt")
+        response = _md5h("%s:%s:%08x:abc:auth:%s" % (ha1, nonce, nc, ha2))
+        return ('Digest username="tester", realm="/dav", nonce="%s", '
+                'uri="/dav/a.txt", qop=auth, nc=%08x, cnonce="abc", '
+                'response="%s"' % (nonce, nc, response))
+
+    def _challenge(self, result):
+        self.assertEqual(result["status"], "401 Not Authorized")
+        header = result["headers"]["WWW-Authenticate"]
+        return re.search(r'nonce="([^"]+)"', header).group(1), "stale=true" in header
+
+    def testDigest(self):
+        """Valid digests should be accepted, replays get a stale nonce."""
+        nonce, stale = self._challenge(self._request())
+        self.assertFalse(stale)
+        self.assertEqual(self._request(self._authorization(nonce, 1))["status"], "200 OK")
+        self.assertEqual(self._request(self._authorization(nonce, 3))["status"], "200 OK")
+        # Out of order, but not seen before
+        self.assertEqual(self._request(self._authorization(nonce, 2))["status"], "200 OK")
+        # Replayed
+        _, stale = self._challenge(self._request(self._authorization(nonce, 2)))
+        self.assertTrue(stale)
+        # Wrong password
+        _, stale = self._challenge(self._request(self._authorization(nonce, 4, "wrong")))
+        self.assertFalse(stale)
+
+    def testExpired(self):
+        """Expired or foreign nonces should be answered with 'stale=true'."""
+        nonce, _ = self._challenge(self._request())
+        self.nm.lifetime = -1
+        _, stale = self._challenge(self._request(self._authorization(nonce, 1)))
+        self.assertTrue(stale)
+        _, stale = self._challenge(self._request(self._authorization("Zm9vOmJhcg==", 1)))
+        self.assertTrue(stale)
+
+    def testNonceManager(self):
+        """Nonces should be signed and their counts tracked."""
+        nm = NonceManager(ncWindow=4)
+        nonce = nm.createNonce()
+        self.assertEqual(nm.check(nonce, "00000001"), NonceManager.NONCE_OK)
+        self.assertEqual(nm.check(nonce, "00000001"), NonceManager.NONCE_STALE)
+        self.assertEqual(nm.check(nonce, "00000009"), NonceManager.NONCE_OK)
+        self.assertEqual(nm.check(nonce, "00000005"), NonceManager.NONCE_STALE)
+        self.assertEqual(nm.check(nonce, "00000006"), NonceManager.NONCE_OK)
+        self.assertEqual(NonceManager(secret="other").check(nonce, "00000001"),
+                         NonceManager.NONCE_INVALID)
+        self.assertEqual(NonceManager(secret=nm.secret).check(nonce, "00000001"),
+                         NonceManager.NONCE_OK)
+        self.assertEqual(nm.check("bogus", None), NonceManager.NONCE_INVALID)
+
+    def testRealmTable(self):
+        """A precomputed realm entry should replace the domain controller calls."""
+        environ = {"PATH_INFO": "/a.txt",
+                   "REQUEST_METHOD": "GET",
+                   "wsgidav.provider": None,
+                   "wsgidav.auth_realm": ("/dav", True),
+                   }
+        result = []
+        self.auth(environ, lambda status, headers, exc_info=None: result.append(status))
+        self.assertEqual(result, ["401 Not Authorized"])
+        environ["wsgidav.auth_realm"] = ("/public", False)
+        self.auth(environ, lambda status, headers, exc_info=None: result.append(status))
+        self.assertEqual(result[-1], "200 OK")
+        self.assertEqual(environ["http_authenticator.realm"], "/public")
+
+    def testHA1(self):
+        """Domain controllers may provide HA1 values instead of passwords."""
+        class _HA1Controller(WsgiDAVDomainController):
+            def getRealmUserPassword(self, realmname, username, environ):
+                raise AssertionError("HA1 should be used")
+
+            def getRealmUserHA1(self, realmname, username, environ):
+                return _md5h("%s:%s:secret" % (username, realmname))
+        self.auth = HTTPAuthenticator(_app, _HA1Controller(self.dc.userMap),
+                                      nonceManager=self.nm)
+        nonce, _ = self._challenge(self._request())
+        self.assertEqual(self._request(self._authorization(nonce, 1))["status"], "200 OK")
+
+    def testPasswordChange(self):
+        """A changed password should be used at once."""
+        nonce, _ = self._challenge(self._request())
+        self.assertEqual(self._request(self._authorization(nonce, 1))["status"], "200 OK")
+        self.dc.userMap["/dav"]["tester"]["password"] = "changed"
+        self._challenge(self._request(self._authorization(nonce, 2)))
+        self.assertEqual(self._request(self._authorization(nonce, 3, "changed"))["status"],
+                         "200 OK")
+
+
+class SessionTest(unittest.TestCase):
+    """Test connection-bound authentication and session cookies."""
+
+    def setUp(self):
+        self.dc = WsgiDAVDomainController(
+            {"/dav": {"tester": {"password": "secret"}}})
+        self.cookies = SessionCookies(maxAge=60)
+        self.auth = HTTPAuthenticator(_app, self.dc, defaultdigest=False,
+                                      connectionAuth=True,
+                                      sessionCookies=self.cookies)
+        self.basic = "Basic " + "tester:secret".encode("base64").strip()
+
+    def _request(self, authorization=None, method="GET", connection=None,
+                 cookie=None):
+        environ = {"PATH_INFO": "/a.txt",
+                   "SCRIPT_NAME": "/dav",
+                   "REQUEST_METHOD": method,
+                   "wsgidav.provider": _Provider(),
+                   "wsgidav.verbose": 0,
+                   }
+        if authorization:
+            environ["HTTP_AUTHORIZATION"] = authorization
+        if connection is not None:
+            environ["wsgiserver.connection_state"] = connection
+        if cookie:
+            environ["HTTP_COOKIE"] = cookie
+        result = {}
+        def start_response(status, headers, exc_info=None):
+            result["status"] = status
+        self.auth(environ, start_response)
+        return result["status"], environ
+
+    def testConnection(self):
+        """Verified users should be bound to the connection."""
+        connection = {}
+        self.assertEqual(self._request(method="PROPFIND", connection=connection)[0],
+                         "401 Not Authorized")
+        self.assertEqual(self._request(self.basic, "PROPFIND", connection)[0], "200 OK")
+        status, environ = self._request(None, "PROPFIND", connection)
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(environ["http_authenticator.username"], "tester")
+        # Other credentials are verified again
+        wrong = "Basic " + "tester:wrong".encode("base64").strip()
+        self.assertEqual(self._request(wrong, "PROPFIND", connection)[0],
+                         "401 Not Authorized")
+        # Other connections are not affected
+        self.assertEqual(self._request(method="PROPFIND", connection={})[0],
+                         "401 Not Authorized")
+
+    def testCookie(self):
+        """Signed cookies should authenticate GET requests only."""
+        status, environ = self._request(self.basic)
+        self.assertEqual(status, "200 OK")
+        setCookie = environ["http_authenticator.set_cookie"]
+        self.assertTrue("; Path=/dav;" in setCookie)
+        cookie = setCookie.split(";")[0]
+        self.assertEqual(self.cookies.getUsername({"HTTP_COOKIE": "a=b; " + cookie}, "/dav"),
+                         "tester")
+        self.assertEqual(self.cookies.getUsername({"HTTP_COOKIE": cookie}, "/other"), None)
+        self.assertEqual(self._request(cookie=cookie)[0], "200 OK")
+        self.assertEqual(self._request(method="DELETE", cookie=cookie)[0],
+                         "401 Not Authorized")
+        forged = cookie.replace(cookie.split("|")[0].split("=")[1], "other".encode("hex"))
+        self.assertEqual(self._request(cookie=forged)[0], "401 Not Authorized")
+        # Removed users are rejected
+        del self.dc.userMap["/dav"]["tester"]
+        self.assertEqual(self._request(cookie=cookie)[0], "401 Not Authorized")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 # -*- coding: iso-8859-1 -*-
 """Unit test for lock_manager.py"""
 import os
+import sqlite3
 import unittest
 from time import sleep
 from tempfile import gettempdir
@@ -170,6 +171,22 @@ class BasicTest(unittest.TestCase):
         assert not lm.isUrlLockedByToken("/dav/", tok), "parent url reported as locked"
 
 
+    def testBulkQuery(self):
+        """Lock manager should find locks for a list of URLs at once."""
+        lm = self.lm
+        urls = ["/dav/res", "/dav/res/", "/dav/other", "/dav"]
+        assert lm.getLocksForUrls(urls) == {}, "unlocked urls reported as locked"
+
+        lockDict = lm._generateLock(self.principal, "write", "exclusive", "infinity",
+                                   self.owner, "/dav/res", self.timeout)
+        tok = lockDict.get("token")
+
+        lockMap = lm.getLocksForUrls(urls)
+        self.assertEqual(sorted(lockMap.keys()), ["/dav/res", "/dav/res/"])
+        self.assertEqual([l["token"] for l in lockMap["/dav/res/"]], [tok])
+        self.assertEqual(lockMap["/dav/res"], lm.getUrlLockList("/dav/res"))
+
+
     def testTimeout(self):
         """Locks should be purged after expiration date."""
         lm = self.lm
@@ -249,6 +266,82 @@ class ShelveTest(BasicTest):
 #             os.remove(self.path)
 
 
+#===============================================================================
+# SqliteTest
+#===============================================================================
+class SqliteTest(BasicTest):
+    """Test lock_manager.LockManager() with lock_storage.LockStorageSqlite()."""
+
+    def setUp(self):
+        self.path = os.path.join(gettempdir(), "wsgidav-locks.sqlite")
+        storage = lock_storage.LockStorageSqlite(self.path)
+        self.lm = lock_manager.LockManager(storage)
+        self.lm._verbose = 1
+
+
+    def tearDown(self):
+        self.lm.storage.clear()
+        self.lm = None
+        os.remove(self.path)
+
+
+    def testShared(self):
+        """Locks should be visible to other storage instances (processes)."""
+        lockDict = self._acquire("/dav/res", "write", "exclusive", "infinity",
+                                 self.owner, self.timeout, self.principal, [])
+        assert lockDict, "Could not acquire lock"
+
+        other = lock_manager.LockManager(lock_storage.LockStorageSqlite(self.path))
+        self.assertEqual(other.getLock(lockDict["token"], "root"), "/dav/res")
+        self.assertRaises(DAVError, other.acquire, "/dav/res/sub", "write",
+                          "exclusive", "infinity", self.owner, self.timeout,
+                          "another principal", [])
+        other.release(lockDict["token"])
+        assert self.lm.getLock(lockDict["token"]) is None, "Lock was not released"
+
+
+    def testBytePaths(self):
+        """Paths that are not UTF-8 should be stored as they are."""
+        storage = self.lm.storage
+        root = "/dav/r\xe4s"
+        lock = storage.create(root + "/sub", {"type": "write", "scope": "exclusive",
+                                              "depth": "infinity", "owner": self.owner,
+                                              "timeout": self.timeout,
+                                              "principal": self.principal})
+        self.assertEqual(storage.get(lock["token"])["root"], root + "/sub")
+        self.assertEqual(storage.getLockList(root, False, True, True), [lock["token"]])
+        self.assertEqual(storage.getLocksForPaths([root + "/sub"]).keys(), [root + "/sub"])
+
+
+    def testOldFormat(self):
+        """Pickled locks of older versions should be discarded, not loaded."""
+        self.lm.storage.close()
+        os.remove(self.path)
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE locks (token TEXT PRIMARY KEY, "
+                     "root TEXT NOT NULL, expire REAL NOT NULL, data BLOB NOT NULL)")
+        conn.execute("INSERT INTO locks VALUES ('t', '/dav/res', -1, 'cos\nsystem\n')")
+        conn.commit()
+        conn.close()
+        storage = lock_storage.LockStorageSqlite(self.path)
+        storage.open()
+        self.assertEqual(storage.countLocks(), 0)
+        self.assertEqual(storage.getLockList("/dav/res", True, True, False), [])
+        storage.close()
+
+
+    @unittest.skipUnless(os.getuid() == 0, "needs permission to change the owner")
+    def testOwner(self):
+        """A database file owned by another user should not be opened."""
+        self.lm.storage.close()
+        os.chown(self.path, 12345, -1)
+        try:
+            storage = lock_storage.LockStorageSqlite(self.path)
+            self.assertRaises(RuntimeError, storage.open)
+        finally:
+            os.chown(self.path, 0, -1)
+
+
 #===============================================================================
 # suite
 #===============================================================================
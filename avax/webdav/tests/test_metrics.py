@@ -0,0 +1,69 @@
+# -*- coding: iso-8859-1 -*-
+"""Unit test for metrics.py"""
+import threading
+import unittest
+from avax.webdav.wsgidav.metrics import MetricsRegistry, StripedCounter, getCacheStats
+
+
+class BasicTest(unittest.TestCase):
+    """Test metrics.MetricsRegistry()."""
+
+    def testStripedCounter(self):
+        counter = StripedCounter(stripes=4)
+
+        def work():
+            for _ in range(1000):
+                counter.add(("a", ))
+            counter.add(("b", ), 5)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(counter.snapshot(), {("a", ): 8000, ("b", ): 40})
+        self.assertEqual(counter.total(), 8040)
+
+    def testRender(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("test_requests_total", "Requests.", ("method", ))
+        requests.add(("GET", ))
+        requests.add(("GET", ))
+        requests.add(('PUT "x"', ))
+        latency = registry.histogram("test_seconds", "Latency.", ("method", ),
+                                     buckets=(0.1, 1.0))
+        latency.observe(("GET", ), 0.05)
+        latency.observe(("GET", ), 0.5)
+        latency.observe(("GET", ), 5)
+        registry.callback("test_queue", "Queue.", lambda: 3)
+        registry.callback("test_skipped", "No value.", lambda: None)
+        self.assertRaises(ValueError, registry.counter, "test_queue", "Again.")
+
+        lines = registry.render().splitlines()
+        self.assertTrue("# TYPE test_requests_total counter" in lines)
+        self.assertTrue('test_requests_total{method="GET"} 2' in lines)
+        self.assertTrue('test_requests_total{method="PUT \\"x\\""} 1' in lines)
+        self.assertTrue('test_seconds_bucket{method="GET",le="0.1"} 1' in lines)
+        self.assertTrue('test_seconds_bucket{method="GET",le="1.0"} 2' in lines)
+        self.assertTrue('test_seconds_bucket{method="GET",le="+Inf"} 3' in lines)
+        self.assertTrue('test_seconds_count{method="GET"} 3' in lines)
+        self.assertTrue('test_seconds_sum{method="GET"} 5.55' in lines)
+        self.assertTrue("test_queue 3" in lines)
+        self.assertFalse([line for line in lines if line.startswith("test_skipped")])
+
+    def testCacheStats(self):
+        stats = getCacheStats("test_cache")
+        self.assertTrue(getCacheStats("test_cache") is stats)
+        before = stats.snapshot()
+        stats.hit()
+        stats.hit()
+        stats.miss()
+        after = stats.snapshot()
+        self.assertEqual(after["hit"] - before["hit"], 2)
+        self.assertEqual(after["miss"] - before["miss"], 1)
+        text = MetricsRegistry().render()
+        self.assertTrue('wsgidav_cache_lookups_total{cache="test_cache",result="hit"}' in text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: iso-8859-1 -*-
+"""Unit test for request_profiler.py"""
+import threading
+import unittest
+from avax.webdav.wsgidav.request_profiler import RequestProfiler
+
+
+def _work():
+    return sum(range(1000))
+
+
+class BasicTest(unittest.TestCase):
+    """Test request_profiler.RequestProfiler()."""
+
+    def _profile(self, profiler, environ):
+        profile = profiler.start(environ)
+        if profile is not None:
+            _work()
+            profiler.stop(profile)
+        return profile is not None
+
+    def testSelection(self):
+        profiler = RequestProfiler(token="s3cret", sampleRate=3)
+        picked = [self._profile(profiler, {}) for _ in range(9)]
+        self.assertEqual(picked.count(True), 3)
+
+        profiler = RequestProfiler(token="s3cret")
+        self.assertFalse(self._profile(profiler, {}))
+        self.assertFalse(self._profile(profiler, {"HTTP_X_WSGIDAV_PROFILE": "wrong"}))
+        self.assertTrue(self._profile(profiler, {"HTTP_X_WSGIDAV_PROFILE": "s3cret"}))
+        self.assertTrue(self._profile(profiler, {"QUERY_STRING": "a=1&wsgidav-profile=s3cret"}))
+        self.assertEqual(profiler.profiled, 2)
+
+        # Without a token, nobody is authorized
+        profiler = RequestProfiler()
+        self.assertFalse(profiler.isAuthorized({"HTTP_X_WSGIDAV_PROFILE": ""}))
+
+    def testMaxActive(self):
+        profiler = RequestProfiler(sampleRate=1, maxActive=1)
+        first = profiler.start({})
+        self.assertTrue(first is not None)
+        self.assertTrue(profiler.start({}) is None)
+        profiler.stop(first)
+        second = profiler.start({})
+        self.assertTrue(second is not None)
+        profiler.stop(second)
+
+    def testThread(self):
+        """A profile must be stopped by the thread that started it."""
+        profiler = RequestProfiler(sampleRate=1)
+        profile = profiler.start({})
+        errors = []
+
+        def stop():
+            try:
+                profiler.stop(profile)
+            except RuntimeError, e:
+                errors.append(e)
+        t = threading.Thread(target=stop)
+        t.start()
+        t.join()
+        self.assertEqual(len(errors), 1)
+        profiler.stop(profile)
+        self.assertEqual(profiler.profiled, 1)
+
+    def testReport(self):
+        profiler = RequestProfiler(token="s3cret", sampleRate=1)
+        self._profile(profiler, {})
+        self.assertTrue("_work" in profiler.getReport(limit=20))
+
+        result = {}
+
+        def start_response(status, headers):
+            result["status"] = status
+
+        body = "".join(profiler.handleReportRequest({"QUERY_STRING": "reset=1"},
+                                                    start_response))
+        self.assertTrue(result["status"].startswith("403"))
+        body = "".join(profiler.handleReportRequest(
+            {"QUERY_STRING": "wsgidav-profile=s3cret&limit=20&reset=1"}, start_response))
+        self.assertTrue(result["status"].startswith("200"))
+        self.assertTrue(body.startswith("1 profiled requests"))
+        self.assertTrue("_work" in body)
+        self.assertEqual(profiler.profiled, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+# -*- coding: iso-8859-1 -*-
+"""Unit test for rw_lock.py"""
+import threading
+import time
+import unittest
+from avax.webdav.wsgidav import rw_lock
+from avax.webdav.wsgidav.rw_lock import (ReadWriteLock, LockStripes, LockInstrumentation,
+                                         enableInstrumentation, getLockHolders)
+
+
+class BasicTest(unittest.TestCase):
+    """Test rw_lock.ReadWriteLock() instrumentation."""
+
+    def setUp(self):
+        self.instrumentation = LockInstrumentation()
+        enableInstrumentation(self.instrumentation)
+
+    def tearDown(self):
+        enableInstrumentation(None)
+
+    def testUnnamed(self):
+        lock = ReadWriteLock()
+        lock.acquireRead()
+        lock.acquireWrite()
+        lock.release()
+        lock.release()
+        self.assertEqual(self.instrumentation.waits.snapshot(), {})
+        self.assertEqual(lock._holdStart, {})
+
+    def testWaitAndHold(self):
+        lock = ReadWriteLock("test")
+        lock.acquireWrite()
+        self.assertEqual(getLockHolders()[("test", "write")], 1)
+
+        def read():
+            lock.acquireRead()
+            lock.acquireRead()
+            lock.release()
+            lock.release()
+
+        t = threading.Thread(target=read)
+        t.start()
+        time.sleep(0.05)
+        self.assertEqual(self.instrumentation.waiting.snapshot()[("test", "read")], 1)
+        lock.release()
+        t.join()
+
+        self.assertEqual(getLockHolders()[("test", "write")], 0)
+        self.assertEqual(self.instrumentation.waiting.total(), 0)
+        waits = self.instrumentation.waits.snapshot()
+        self.assertEqual(waits[("test", "read")][0][-1], 2)
+        self.assertTrue(waits[("test", "read")][1] >= 0.04)
+        holds = self.instrumentation.holds.snapshot()
+        # Nested acquisitions are held once
+        self.assertEqual(holds[("test", "write")][0][-1], 1)
+        self.assertEqual(holds[("test", "read")][0][-1], 1)
+        self.assertTrue(holds[("test", "write")][1] >= 0.04)
+        self.assertEqual(lock._holdStart, {})
+
+    def testTimeout(self):
+        lock = ReadWriteLock("test")
+        lock.acquireWrite()
+
+        def write():
+            self.assertRaises(RuntimeError, lock.acquireWrite, 0.01)
+
+        t = threading.Thread(target=write)
+        t.start()
+        t.join()
+        lock.release()
+        self.assertEqual(self.instrumentation.timeouts.snapshot(), {("test", "write"): 1})
+        self.assertEqual(self.instrumentation.waiting.total(), 0)
+
+    def testDisabled(self):
+        enableInstrumentation(None)
+        lock = ReadWriteLock("test")
+        lock.acquireRead()
+        lock.release()
+        self.assertEqual(self.instrumentation.waits.snapshot(), {})
+        self.assertTrue(lock in rw_lock._namedLocks)
+
+    def testStripes(self):
+        stripes = LockStripes(4, "test")
+        keys = ["/a/%s" % i for i in range(20)]
+        with stripes.hold(*keys):
+            self.assertEqual(getLockHolders()[("test", "write")], 4)
+        with stripes.holdAll():
+            self.assertEqual(getLockHolders()[("test", "write")], 4)
+        with stripes.hold(keys[0]):
+            self.assertEqual(getLockHolders()[("test", "write")], 1)
+        self.assertEqual(getLockHolders()[("test", "write")], 0)
+        holds = self.instrumentation.holds.snapshot()
+        self.assertEqual(holds[("test", "write")][0][-1], 9)
+
+        # Threads holding several keys must not deadlock
+        def work(keys):
+            for _ in range(500):
+                with stripes.hold(*keys):
+                    pass
+
+        threads = [threading.Thread(target=work, args=(keys[i:i + 3], ))
+                   for i in range(8)]
+        threads.append(threading.Thread(target=work, args=(reversed(keys), )))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+            self.assertFalse(t.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
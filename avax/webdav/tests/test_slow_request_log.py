@@ -0,0 +1,57 @@
+# -*- coding: iso-8859-1 -*-
+"""Unit test for slow_request_log.py"""
+import logging
+import unittest
+from avax.webdav.wsgidav.slow_request_log import SlowRequestLog
+from avax.webdav.wsgidav.timing import RequestTimer
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class BasicTest(unittest.TestCase):
+    """Test slow_request_log.SlowRequestLog()."""
+
+    def testLog(self):
+        logger = logging.getLogger("avax.webdav.test.slow_requests")
+        logger.propagate = False
+        handler = _ListHandler()
+        logger.addHandler(handler)
+        slowLog = SlowRequestLog(threshold=1.0, logger=logger)
+
+        timer = RequestTimer()
+        timer.stop("resource", timer.start())
+        timer.count("descendants", 1200)
+        timer.finish()
+        self.assertFalse(slowLog.isSlow(timer))
+        timer.total = 2.5
+        self.assertTrue(slowLog.isSlow(timer))
+
+        environ = {"REQUEST_METHOD": "PROPFIND",
+                   "SCRIPT_NAME": "/dav",
+                   "PATH_INFO": "/big tree/",
+                   "HTTP_DEPTH": "infinity",
+                   "HTTP_USER_AGENT": "Test agent",
+                   "http_authenticator.username": "tester",
+                   "wsgidav.response_status": "207 Multistatus",
+                   }
+        slowLog.log(environ, timer, bytesIn=0, bytesOut=1234)
+        self.assertEqual(slowLog.logged, 1)
+        self.assertEqual(len(handler.messages), 1)
+        message = handler.messages[0]
+        self.assertTrue(message.startswith("Slow request: method=PROPFIND "
+                                           'path="/dav/big tree/" depth=infinity '
+                                           'user=tester agent="Test agent" status=207 '
+                                           "elapsed=2.500 bytes_in=0 bytes_out=1234 "
+                                           'phases="resource='), message)
+        self.assertTrue(message.endswith('calls="descendants=1200 resource=1"'), message)
+
+
+if __name__ == "__main__":
+    unittest.main()
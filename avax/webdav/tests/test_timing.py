@@ -0,0 +1,91 @@
+# -*- coding: iso-8859-1 -*-
+"""Unit test for timing.py"""
+import unittest
+from avax.webdav.wsgidav.timing import RequestTimer, TimingStats, getTimer, timed, \
+    counted, setCurrentTimer, NULL_TIMER
+
+
+class _Handler(object):
+    @timed("work", 1)
+    def work(self, environ, result):
+        return result
+
+    @counted("manager")
+    def manage(self):
+        return 1
+
+    @counted("manager")
+    def manageNested(self):
+        return self.manage() + self.manage()
+
+
+class BasicTest(unittest.TestCase):
+    """Test timing.RequestTimer(), timed() and TimingStats()."""
+
+    def testTimer(self):
+        timer = RequestTimer()
+        t = timer.start()
+        timer.stop("a", t)
+        timer.begin("b")
+        timer.stop("a", t)
+        timer.begin("c")
+        timer.end("c")
+        timer.end("unknown")
+        timer.finish()
+        self.assertEqual([name for name, _ in timer.items()], ["a", "c", "b"])
+        self.assertTrue(timer.total >= timer.durations["a"] >= 0)
+        self.assertEqual(len(timer.format().split(" ")), 3)
+        self.assertTrue(timer.formatServerTiming().startswith("a;dur="))
+
+    def testTimed(self):
+        handler = _Handler()
+        # Without a timer the call is passed through
+        self.assertEqual(handler.work({}, 1), 1)
+        self.assertEqual(handler.work(None, 2), 2)
+        self.assertTrue(getTimer({}) is NULL_TIMER)
+        self.assertTrue(getTimer(None) is NULL_TIMER)
+
+        environ = {"wsgidav.timer": RequestTimer()}
+        self.assertEqual(handler.work(environ, 3), 3)
+        self.assertEqual(handler.work(environ=environ, result=4), 4)
+        self.assertEqual(environ["wsgidav.timer"].order, ["work"])
+        self.assertTrue(getTimer(environ) is environ["wsgidav.timer"])
+
+    def testCounts(self):
+        handler = _Handler()
+        environ = {"wsgidav.timer": RequestTimer()}
+        timer = environ["wsgidav.timer"]
+        handler.work(environ, 1)
+        handler.work(environ, 2)
+        timer.count("descendants", 10)
+        # Counted only while the timer is the current one
+        handler.manage()
+        setCurrentTimer(timer)
+        try:
+            handler.manage()
+            handler.manage()
+            # Nested calls are counted once
+            self.assertEqual(handler.manageNested(), 2)
+        finally:
+            setCurrentTimer(None)
+        handler.manage()
+        self.assertEqual(timer.counts, {"work": 2, "descendants": 10, "manager": 3})
+        self.assertEqual(timer.formatCounts(), "descendants=10 manager=3 work=2")
+
+    def testStats(self):
+        stats = TimingStats()
+        for _ in range(3):
+            timer = RequestTimer()
+            timer.stop("a", timer.start())
+            timer.finish()
+            stats.add(timer)
+        snapshot = stats.snapshot(reset=True)
+        self.assertEqual(sorted(snapshot), ["a", "total"])
+        count, total, maximum = snapshot["a"]
+        self.assertEqual(count, 3)
+        self.assertTrue(total >= maximum >= 0)
+        self.assertEqual(stats.snapshot(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,6 +6,9 @@
 # from unittest import TestCase, TestSuite, TextTestRunner
 import unittest
 from avax.webdav.wsgidav.util import * #@UnusedWildImport
+from avax.webdav.wsgidav import xml_tools
+from avax.webdav.wsgidav.dav_error import DAVError, HTTP_NOT_FOUND, \
+    HTTP_FORBIDDEN
 
 
 class BasicTest(unittest.TestCase):
@@ -76,6 +79,25 @@ class BasicTest(unittest.TestCase):
         self.assertEqual(shiftPath("/a/b/c", ""),
                          ("", "/a/b/c", ""))
 
+    def testClosingIterator(self):
+        """ClosingIterator passes iteration through and runs callbacks on close."""
+        closed = []
+        def gen():
+            try:
+                yield "a"
+                yield "b"
+            finally:
+                closed.append("gen")
+        it = ClosingIterator(gen(), lambda: closed.append("callback"))
+        self.assertEqual(iter(it).next(), "a")
+        it.close()
+        self.assertEqual(closed, ["gen", "callback"])
+
+        it = ClosingIterator(["a", "b"], lambda: closed.append("list"))
+        self.assertEqual("".join(it), "ab")
+        it.close()
+        self.assertEqual(closed[-1], "list")
+
     def test_logging(self):
         enable_loggers = ["test",
                       ]
@@ -109,6 +131,117 @@ class BasicTest(unittest.TestCase):
         note("util.note()")
         debug("util.debug()")
 
+#===============================================================================
+# MultiStatusTest
+#===============================================================================
+def _makePropLists():
+    """Return a list of (href, propList) tuples (new elements on every call)."""
+    def resourcetype(isCollection):
+        el = etree.Element("{DAV:}resourcetype")
+        if isCollection:
+            etree.SubElement(el, "{DAV:}collection")
+        return el
+
+    def supportedlock():
+        el = etree.Element("{DAV:}supportedlock")
+        for scope in ("exclusive", "shared"):
+            entryEL = etree.SubElement(el, "{DAV:}lockentry")
+            etree.SubElement(etree.SubElement(entryEL, "{DAV:}lockscope"), 
+                             "{DAV:}" + scope)
+            etree.SubElement(etree.SubElement(entryEL, "{DAV:}locktype"), 
+                             "{DAV:}write")
+        return el
+
+    def lockdiscovery(owner):
+        el = etree.Element("{DAV:}lockdiscovery")
+        if owner:
+            activeEL = etree.SubElement(el, "{DAV:}activelock")
+            etree.SubElement(activeEL, "{DAV:}depth").text = "infinity"
+            activeEL.append(xml_tools.stringToXML(owner))
+            etree.SubElement(activeEL, "{DAV:}timeout").text = "Second-600"
+        return el
+
+    return [("/", [("{DAV:}resourcetype", resourcetype(True)),
+                   ("{DAV:}displayname", ""),
+                   ("{DAV:}lockdiscovery", lockdiscovery(None)),
+                   ("{DAV:}supportedlock", supportedlock()),
+                   ]),
+            ("/dav/file%20name.txt", 
+             [("{DAV:}resourcetype", resourcetype(False)),
+              ("{DAV:}creationdate", "2014-02-05T10:11:12Z"),
+              ("{DAV:}getcontentlength", "1234"),
+              ("{DAV:}getcontenttype", "text/plain"),
+              ("{DAV:}getlastmodified", "Wed, 05 Feb 2014 10:11:12 GMT"),
+              ("{DAV:}displayname", "file name.txt"),
+              ("{DAV:}getetag", '"a1b2c3"'),
+              ("{DAV:}getcontentlanguage", DAVError(HTTP_NOT_FOUND)),
+              ("{DAV:}quota", DAVError(HTTP_FORBIDDEN)),
+              ]),
+            ("/dav/a&b<c>", [("{DAV:}displayname", u"Umlaute(\xe4\xf6\xfc\xdf) Euro(\u20ac) & <x> ]]> \"'"),
+                             ("{DAV:}getetag", "line1\r\nline2\tend"),
+                             ("{DAV:}getcontenttype", "latin-1 \xe4"),
+                             ]),
+            ("/dav/propname", [("{DAV:}resourcetype", None),
+                               ("{DAV:}getetag", None),
+                               ]),
+            # Not handled by the templates: namespaces other than DAV:
+            ("/dav/dead", [("{DAV:}getetag", '"x"'),
+                           ("{http://example.com/ns}foo", "bar"),
+                           ("{http://example.com/ns}baz", DAVError(HTTP_NOT_FOUND)),
+                           ]),
+            ("/dav/complex", [("{DAV:}lockdiscovery", 
+                               lockdiscovery('<owner xmlns="DAV:">litmus <href>mailto:x</href></owner>')),
+                              ("{DAV:}foreign", 
+                               xml_tools.stringToXML('<D:foreign xmlns:D="DAV:" xmlns:X="urn:x"><X:a X:b="c"/></D:foreign>')),
+                              ]),
+            ]
+
+
+class MultiStatusTest(unittest.TestCase):
+    """Test MultiStatusWriter against the element tree serialization."""
+
+    def _serializeTree(self, propLists):
+        multistatusEL = xml_tools.makeMultistatusEL()
+        for href, propList in propLists:
+            addPropertyResponse(multistatusEL, href, propList)
+        return xmlToString(multistatusEL)
+
+    def _serializeWriter(self, propLists):
+        writer = MultiStatusWriter(useFastPath=True)
+        for href, propList in propLists:
+            writer.addPropertyResponse(href, propList)
+        return writer.getXml()
+
+    @unittest.skipUnless(xml_tools.useLxml, "templates reproduce lxml output")
+    def testDifferential(self):
+        """MultiStatusWriter output must be byte-identical to lxml."""
+        # Whole document
+        self.assertEqual(self._serializeWriter(_makePropLists()), 
+                         self._serializeTree(_makePropLists()))
+        # Single responses, and an empty body
+        for i in range(len(_makePropLists())):
+            self.assertEqual(self._serializeWriter(_makePropLists()[i:i + 1]), 
+                             self._serializeTree(_makePropLists()[i:i + 1]))
+        self.assertEqual(self._serializeWriter([]), self._serializeTree([]))
+
+    @unittest.skipUnless(xml_tools.useLxml, "templates reproduce lxml output")
+    def testFastPath(self):
+        """Standard live properties must not need the element tree."""
+        propLists = _makePropLists()
+        for href, propList in propLists[:4]:
+            assert renderPropertyResponse(href, propList) is not None, href
+        for href, propList in propLists[4:]:
+            assert renderPropertyResponse(href, propList) is None, href
+
+    @unittest.skipUnless(xml_tools.useLxml, "templates reproduce lxml output")
+    def testInvalidCharacters(self):
+        """Values that lxml rejects must not be rendered by the templates."""
+        propList = [("{DAV:}displayname", "null\x00byte")]
+        assert renderPropertyResponse("/x", propList) is None
+        self.assertRaises(ValueError, self._serializeWriter, [("/x", propList)])
+        self.assertRaises(ValueError, self._serializeTree, [("/x", propList)])
+
+
 #===============================================================================
 # suite
 #===============================================================================
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered access log.
+
+Request threads only record a small entry per request and append it to a
+bounded queue. A background thread formats the entries and writes them to the
+log stream in batches, flushing at most once per `flushInterval` seconds.
+
+If the stream is too slow and the queue is full, new entries are dropped and
+counted; the number of dropped entries is written to the log as soon as the
+writer catches up. Request threads never wait for log I/O.
+
+By default the classic WsgiDAV line is written::
+
+    <140234> 127.0.0.1 - tester - [2014-05-20 12:00:00] "GET /dav/a.txt" length=0, elap=0.002sec -> 200 OK
+
+If a list of `fields` is configured, one ``name=value`` pair per field is
+written instead::
+
+    time=2014-05-20T12:00:00Z method=GET path=/dav/a.txt status=200 bytes=1234 elapsed=0.002
+
+The 'timing' field holds the durations of the request phases in milliseconds
+(see `timing`).
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://wsgidav.readthedocs.org/en/latest/develop.html
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import atexit
+import sys
+import threading
+import time
+from collections import deque
+
+from . import util
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+# Request headers that are stored with every entry {entry key: environ key}
+_ENVIRON_KEYS = (
+    ("remote_addr", b"REMOTE_ADDR"),
+    ("method", b"REQUEST_METHOD"),
+    ("script_name", b"SCRIPT_NAME"),
+    ("path", b"PATH_INFO"),
+    ("query", b"QUERY_STRING"),
+    ("user", b"http_authenticator.username"),
+    ("length", b"CONTENT_LENGTH"),
+    ("destination", b"HTTP_DESTINATION"),
+    ("depth", b"HTTP_DEPTH"),
+    ("range", b"HTTP_RANGE"),
+    ("overwrite", b"HTTP_OVERWRITE"),
+    ("expect", b"HTTP_EXPECT"),
+    ("connection", b"HTTP_CONNECTION"),
+    ("agent", b"HTTP_USER_AGENT"),
+    ("referer", b"HTTP_REFERER"),
+    ("transfer_encoding", b"HTTP_TRANSFER_ENCODING"),
+    )
+
+
+def _fieldValue(entry, name):
+    """Return the value of a configured field, or None if it is unknown."""
+    if name == "time":
+        return time.strftime(b"%Y-%m-%dT%H:%M:%SZ", time.gmtime(entry["start"]))
+    elif name == "elapsed":
+        return b"%.3f" % entry["elapsed"]
+    elif name == "status":
+        return entry["status"].split(b" ", 1)[0]
+    elif name == "uri":
+        uri = (entry["script_name"] or b"") + (entry["path"] or b"")
+        if entry["query"]:
+            uri += b"?" + entry["query"]
+        return uri
+    elif name in entry:
+        value = entry[name]
+        return None if value is None else b"%s" % (value, )
+    raise ValueError("Unknown access log field: %r" % name)
+
+
+def _quote(value):
+    if value is None or value == b"":
+        return b"-"
+    if b" " in value or b'"' in value or b"=" in value:
+        return b'"%s"' % value.replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+    return value
+
+
+#===============================================================================
+# AccessLogger
+#===============================================================================
+class AccessLogger(object):
+    """Write access log entries from a background thread.
+
+    Usage::
+
+        entry = logger.makeEntry(environ, status, response_headers, start)
+        ... send the response, set entry["bytes"] ...
+        logger.log(entry)
+    """
+
+    def __init__(self, stream=None, fields=None, maxQueued=10000,
+                 flushInterval=1.0, verbose=1):
+        self.stream = stream or sys.stdout
+        self.fields = fields
+        self.maxQueued = maxQueued
+        self.flushInterval = flushInterval
+        self.verbose = verbose
+        self.written = 0
+        self.dropped = 0
+        self._reportedDropped = 0
+        self._dropLock = threading.Lock()
+        self._pending = deque()
+        self._stopEvent = threading.Event()
+        self._thread = None
+        if fields:
+            # Fail early on typos in the configuration
+            entry = dict((key, None) for key, _ in _ENVIRON_KEYS)
+            entry.update(start=0, elapsed=0, status=b"200 OK", bytes=None,
+                         thread=0, timing=None)
+            for name in fields:
+                _fieldValue(entry, name)
+
+    def __repr__(self):
+        return "%s(queued=%s, written=%s, dropped=%s)" % (
+            self.__class__.__name__, len(self._pending), self.written,
+            self.dropped)
+
+    def start(self):
+        """Start the writer thread (called on the first log() as well)."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run,
+                                        name="wsgidav-access-log")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        """Write all pending entries and stop the writer thread."""
+        self._stopEvent.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(max(1.0, 2 * self.flushInterval))
+
+    def makeEntry(self, environ, status, responseHeaders, startTime):
+        """Return a new entry for a request whose response was just started.
+
+        `entry["bytes"]` is set from the Content-Length header; the caller may
+        replace it with the number of bytes that were actually sent.
+        """
+        entry = dict((key, environ.get(envKey)) for key, envKey in _ENVIRON_KEYS)
+        entry["thread"] = threading._get_ident()
+        entry["start"] = startTime
+        entry["elapsed"] = None
+        entry["status"] = status
+        size = None
+        for name, value in responseHeaders:
+            if name.lower() == b"content-length":
+                size = value
+                break
+        entry["bytes"] = size
+        # Phase durations 'name=ms ...' (see timing.RequestTimer.format)
+        entry["timing"] = None
+        return entry
+
+    def log(self, entry):
+        """Queue an entry; drop it if the queue is full. Never blocks."""
+        if entry["elapsed"] is None:
+            entry["elapsed"] = time.time() - entry["start"]
+        # deque.append is atomic, the length check is good enough as a bound
+        if len(self._pending) >= self.maxQueued:
+            with self._dropLock:
+                self.dropped += 1
+            return
+        self._pending.append(entry)
+        if self._thread is None:
+            self.start()
+
+    def formatEntry(self, entry):
+        """Return the log line for an entry (without line break)."""
+        if self.fields:
+            return b" ".join(b"%s=%s" % (name, _quote(_fieldValue(entry, name)))
+                             for name in self.fields)
+
+        verbose = self.verbose
+        extra = []
+        if entry["destination"] is not None:
+            extra.append(b'dest="%s"' % entry["destination"])
+        if entry["length"]:
+            extra.append(b"length=%s" % entry["length"])
+        if entry["depth"] is not None:
+            extra.append(b"depth=%s" % entry["depth"])
+        if entry["range"] is not None:
+            extra.append(b"range=%s" % entry["range"])
+        if entry["overwrite"] is not None:
+            extra.append(b"overwrite=%s" % entry["overwrite"])
+        if entry["expect"] is not None:
+            extra.append(b'expect="%s"' % entry["expect"])
+        if verbose >= 2 and entry["connection"] is not None:
+            extra.append(b'connection="%s"' % entry["connection"])
+        if verbose >= 2 and entry["agent"] is not None:
+            extra.append(b'agent="%s"' % entry["agent"])
+        if verbose >= 2 and entry["transfer_encoding"] is not None:
+            extra.append(b"transfer-enc=%s" % entry["transfer_encoding"])
+        if entry["bytes"] is not None:
+            extra.append(b"bytes=%s" % entry["bytes"])
+        extra.append(b"elap=%.3fsec" % entry["elapsed"])
+        if entry["timing"]:
+            extra.append(b'phases="%s"' % entry["timing"])
+
+#       This is the CherryPy format:
+#        127.0.0.1 - - [08/Jul/2009:17:25:23] "GET /loginPrompt?redirect=/renderActionList%3Frelation%3Dpersonal%26key%3D%26filter%3DprivateSchedule&reason=0 HTTP/1.1" 200 1944 "http://127.0.0.1:8002/command?id=CMD_Schedule" "Mozilla/5.0 (Windows; U; Windows NT 6.0; de; rv:1.9.1) Gecko/20090624 Firefox/3.5"
+        return b'<%s> %s - %s - [%s] "%s %s" %s -> %s' % (
+            entry["thread"],
+            entry["remote_addr"] or b"",
+            entry["user"] or b"(anonymous)",
+            util.getLogTime(entry["start"]),
+            entry["method"], entry["path"] or b"",
+            b", ".join(extra),
+            entry["status"])
+
+    def _run(self):
+        while not self._stopEvent.is_set():
+            self._stopEvent.wait(self.flushInterval)
+            self._writePending()
+        self._writePending()
+
+    def _writePending(self):
+        """Write all queued entries as one batch."""
+        pending = self._pending
+        lines = []
+        count = 0
+        while pending:
+            entry = pending.popleft()
+            try:
+                lines.append(self.formatEntry(entry))
+                count += 1
+            except Exception:
+                _logger.exception("Could not format access log entry %r" % entry)
+        dropped = self.dropped - self._reportedDropped
+        if dropped:
+            self._reportedDropped += dropped
+            lines.append(b"<access log> %s entries dropped (%s total): log stream too slow"
+                         % (dropped, self.dropped))
+        if not lines:
+            return
+        lines.append(b"")
+        try:
+            self.stream.write(b"\n".join(lines))
+            self.stream.flush()
+            self.written += count
+        except Exception:
+            _logger.exception("Could not write access log")
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Implementation of a domain controller that checks passwords against salted
+PBKDF2 hashes from a credential file (used by HTTPAuthenticator).
+
+Usage::
+
+   from avax.webdav.wsgidav.addons.hashed_domain_controller import HashedDomainController
+   domaincontroller = HashedDomainController("/etc/wsgidav/credentials")
+
+The credential file contains one line per realm and user::
+
+   # realm:username:hash
+   /dav:tester:pbkdf2_sha256$100000$YWJjZGVmZ2g=$N2Y...
+
+New hash values are created with `hashPassword()`::
+
+   python -c "from avax.webdav.wsgidav.addons import hashed_domain_controller as h; print h.hashPassword('secret')"
+
+The file is read again when it was modified (checked every `reloadInterval`
+seconds).
+
+Verified credentials cache
+--------------------------
+
+Hashing a password takes tens of milliseconds on purpose, and clients send
+their credentials with every single request. So successful verifications are
+remembered for `cacheTTL` seconds: the cache key is an HMAC (with a random
+key that never leaves the process) of the realm and the complete
+Authorization header. Neither passwords nor the headers themselves are
+stored. The cache is cleared when the credential file changes.
+
+**Digest Authentication**
+   Digest authentication requires the plain password (or md5 of it), which
+   is not stored. Use this class with ``acceptdigest = False``.
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://wsgidav.readthedocs.org/en/latest/develop.html
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from avax.webdav.wsgidav import util
+from avax.webdav.wsgidav.metrics import getCacheStats
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+HASH_ALGORITHM = b"pbkdf2_sha256"
+DEFAULT_ITERATIONS = 100000
+
+
+def hashPassword(password, iterations=DEFAULT_ITERATIONS, salt=None):
+    """Return a hash value for the credential file."""
+    if salt is None:
+        salt = os.urandom(12)
+    dk = hashlib.pbkdf2_hmac(b"sha256", password, salt, iterations)
+    return b"%s$%d$%s$%s" % (HASH_ALGORITHM, iterations,
+                             base64.b64encode(salt), base64.b64encode(dk))
+
+
+def verifyPassword(password, hashValue):
+    """Return True if the password matches a value created by hashPassword()."""
+    try:
+        algorithm, iterations, salt, dk = hashValue.split(b"$")
+        iterations = int(iterations)
+        salt = base64.b64decode(salt)
+        dk = base64.b64decode(dk)
+    except (TypeError, ValueError):
+        _logger.error("Invalid password hash: %r" % hashValue)
+        return False
+    if algorithm != HASH_ALGORITHM:
+        _logger.error("Unsupported password hash algorithm: %r" % algorithm)
+        return False
+    return hmac.compare_digest(
+        hashlib.pbkdf2_hmac(b"sha256", password, salt, iterations), dk)
+
+
+#===============================================================================
+# VerifiedCredentialCache
+#===============================================================================
+class VerifiedCredentialCache(object):
+    """Remember Authorization headers that were verified recently.
+
+    clear() starts a new generation: entries that are added for an older
+    one (by a verification that began before the credentials changed) are
+    never returned.
+    """
+
+    def __init__(self, ttl=300, maxEntries=10000):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.generation = 0
+        self._key = os.urandom(32)
+        self._stats = getCacheStats(b"verified_credentials")
+        # {HMAC(realm, authorization): (username, expiration time, generation)}
+        self._entries = {}
+
+    def __repr__(self):
+        return "%s(entries=%s, ttl=%s)" % (self.__class__.__name__,
+                                          len(self._entries), self.ttl)
+
+    def _makeKey(self, realmname, authorization):
+        return hmac.new(self._key, b"%s\0%s" % (realmname, authorization),
+                        hashlib.sha256).digest()
+
+    def get(self, realmname, authorization):
+        """Return the user name, if this header was verified for the realm."""
+        key = self._makeKey(realmname, authorization)
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats.miss()
+            return None
+        if entry[1] < time.time() or entry[2] != self.generation:
+            self._entries.pop(key, None)
+            self._stats.miss()
+            return None
+        self._stats.hit()
+        return entry[0]
+
+    def add(self, realmname, authorization, username, generation):
+        """Remember a header that was verified with credentials of `generation`."""
+        if generation != self.generation:
+            return
+        if len(self._entries) >= self.maxEntries:
+            self._entries.clear()
+        self._entries[self._makeKey(realmname, authorization)] = (
+            username, time.time() + self.ttl, generation)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+
+#===============================================================================
+# HashedDomainController
+#===============================================================================
+class HashedDomainController(object):
+
+    def __init__(self, path, cacheTTL=300, maxCached=10000, reloadInterval=5):
+        self.path = path
+        self.reloadInterval = reloadInterval
+        self._cache = VerifiedCredentialCache(cacheTTL, maxCached)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._nextCheck = 0
+        # {realm: {username: hash value}}
+        self._users = {}
+        self._load()
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    def _load(self):
+        users = {}
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, "rb") as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith(b"#"):
+                    continue
+                try:
+                    realm, username, hashValue = line.rsplit(b":", 2)
+                except ValueError:
+                    _logger.error("%s, line %s: expected 'realm:username:hash'"
+                                  % (self.path, lineno))
+                    continue
+                users.setdefault(realm, {})[username] = hashValue
+        self._users = users
+        self._mtime = mtime
+        self._cache.clear()
+        _logger.info("Loaded credentials for %s realms from %s"
+                     % (len(users), self.path))
+
+    def _checkReload(self):
+        """Read the credential file again, if it was modified."""
+        now = time.time()
+        if now < self._nextCheck:
+            return
+        with self._lock:
+            if now < self._nextCheck:
+                return
+            self._nextCheck = now + self.reloadInterval
+            try:
+                if os.stat(self.path).st_mtime != self._mtime:
+                    self._load()
+            except (IOError, OSError):
+                _logger.exception("Could not reload %s" % self.path)
+
+    def getDomainRealm(self, inputURL, environ):
+        """Resolve a relative url to the appropriate realm name (share path)."""
+        davProvider = environ[b"wsgidav.provider"]
+        if not davProvider:
+            return None
+        realm = davProvider.sharePath
+        if realm == b"":
+            realm = b"/"
+        return realm
+
+    def requireAuthentication(self, realmname, environ):
+        self._checkReload()
+        return realmname in self._users
+
+    def isRealmUser(self, realmname, username, environ):
+        return username in self._users.get(realmname, {})
+
+    def getRealmUserPassword(self, realmname, username, environ):
+        """Not available: only password hashes are stored."""
+        return None
+
+    def authDomainUser(self, realmname, username, password, environ):
+        """Returns True if this username/password pair is valid for the realm,
+        False otherwise. Used for basic authentication."""
+        authorization = environ.get(b"HTTP_AUTHORIZATION")
+        if authorization and self._cache.get(realmname, authorization) == username:
+            return True
+        # Generation first: _load() replaces the users, then clears the cache
+        generation = self._cache.generation
+        hashValue = self._users.get(realmname, {}).get(username)
+        if hashValue is None or not verifyPassword(password, hashValue):
+            return False
+        if authorization:
+            self._cache.add(realmname, authorization, username, generation)
+        return True
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control for expensive tree operations.
+
+PROPFIND with 'Depth: infinity' and recursive COPY, MOVE or DELETE requests
+may walk a complete archive. `AdmissionController` limits how many of these
+*heavy* operations run at the same time (per server and per client). Requests
+over the limit wait for a free slot; if none becomes available in time, they
+are rejected with '503 Service Unavailable' and a 'Retry-After' header.
+
+The cost of an operation is the number of resources in the subtree. It is
+taken from a cache of subtree sizes that were counted by earlier requests.
+A subtree of unknown size (not walked yet, or its size has expired) may be
+huge, so its first walk is a *cold walk*: it needs one of `maxUnknown`
+separate slots and counts against the per-client limit. Only one cold walk
+of the same subtree runs at a time; other requests for it wait and are then
+estimated with the size the walk recorded.
+
+A client is the authenticated user, or the remote address for anonymous
+requests (otherwise all anonymous clients would share one slot).
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://wsgidav.readthedocs.org/en/latest/develop.html
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import time
+from threading import Condition, Lock
+
+from . import util
+from .dav_error import DAVError, HTTP_SERVICE_UNAVAILABLE
+from .metrics import getCacheStats
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+
+class AdmissionController(object):
+    """Limit the number of concurrent heavy tree operations.
+
+    Usage::
+
+        ticket = controller.admit(environ, res, depth)
+        try:
+            ... walk the tree ...
+        finally:
+            controller.release(ticket)
+    """
+
+    def __init__(self, maxHeavy=4, maxHeavyPerUser=1, queueTimeout=10,
+                 retryAfter=30, heavyCost=500, countTTL=600,
+                 maxCachedCounts=4096, maxUnknown=8):
+        self.maxHeavy = maxHeavy
+        self.maxUnknown = maxUnknown
+        self.maxHeavyPerUser = maxHeavyPerUser
+        self.queueTimeout = queueTimeout
+        self.retryAfter = retryAfter
+        self.heavyCost = heavyCost
+        self.countTTL = countTTL
+        self.maxCachedCounts = maxCachedCounts
+        self._condition = Condition(Lock())
+        self._running = 0
+        self._runningPerUser = {}
+        # refUrls of the running cold walks
+        self._coldWalks = set()
+        # Cached subtree sizes {refUrl: (count, timestamp)}
+        self._counts = {}
+        self._countStats = getCacheStats(b"subtree_size")
+
+    def __repr__(self):
+        return "%s(running=%s, maxHeavy=%s, maxHeavyPerUser=%s)" % (
+            self.__class__.__name__, self._running, self.maxHeavy,
+            self.maxHeavyPerUser)
+
+    @property
+    def running(self):
+        """Number of heavy operations (including cold walks) that are running."""
+        return self._running + len(self._coldWalks)
+
+    def estimateCost(self, res, depth):
+        """Return the number of resources touched, or None if unknown."""
+        if not res.isCollection or depth != b"infinity":
+            return 1
+        count = self._getCount(res.getRefUrl())
+        if count is None:
+            self._countStats.miss()
+        else:
+            self._countStats.hit()
+        return count
+
+    def _getCount(self, refUrl):
+        entry = self._counts.get(refUrl)
+        if entry is None or time.time() - entry[1] > self.countTTL:
+            return None
+        return entry[0]
+
+    def recordCost(self, res, count):
+        """Remember the subtree size of a collection for later estimates."""
+        if not res.isCollection:
+            return
+        if len(self._counts) >= self.maxCachedCounts:
+            self._counts.clear()
+        self._counts[res.getRefUrl()] = (count, time.time())
+
+    def isHeavy(self, cost):
+        """Return True if an operation needs a slot (unknown cost: True)."""
+        return cost is None or cost >= self.heavyCost
+
+    def getClientKey(self, environ):
+        """Return the key of the per-client limit."""
+        user = environ.get(b"http_authenticator.username")
+        if user:
+            return user
+        return (b"remote", environ.get(b"REMOTE_ADDR"))
+
+    def admit(self, environ, res, depth):
+        """Wait for a slot if the operation is heavy.
+
+        Return a ticket that must be passed to release(), or None if the
+        operation is cheap and was admitted without a slot.
+        Raise DAVError(HTTP_SERVICE_UNAVAILABLE) if no slot became available
+        within queueTimeout seconds.
+        """
+        cost = self.estimateCost(res, depth)
+        if not self.isHeavy(cost):
+            return None
+
+        user = self.getClientKey(environ)
+        refUrl = res.getRefUrl()
+        endtime = time.time() + self.queueTimeout
+        self._condition.acquire()
+        try:
+            while True:
+                if self._runningPerUser.get(user, 0) < self.maxHeavyPerUser:
+                    if cost is not None:
+                        if self._running < self.maxHeavy:
+                            break
+                    elif (len(self._coldWalks) < self.maxUnknown
+                          and refUrl not in self._coldWalks):
+                        break
+                remaining = endtime - time.time()
+                if remaining <= 0:
+                    _logger.warning("Rejecting %s %s (cost: %s, running: %s)"
+                                    % (environ.get(b"REQUEST_METHOD"),
+                                       res.getRefUrl(), cost, self._running))
+                    raise DAVError(HTTP_SERVICE_UNAVAILABLE,
+                                   b"Too many expensive operations, please retry later.",
+                                   headers=[(b"Retry-After", str(self.retryAfter))])
+                self._condition.wait(remaining)
+                if cost is None:
+                    # A cold walk of this subtree may have recorded its size
+                    cost = self._getCount(refUrl)
+                    if not self.isHeavy(cost):
+                        return None
+            if cost is None:
+                self._coldWalks.add(refUrl)
+            else:
+                self._running += 1
+                refUrl = None
+            self._runningPerUser[user] = self._runningPerUser.get(user, 0) + 1
+        finally:
+            self._condition.release()
+        return (user, refUrl)
+
+    def release(self, ticket):
+        """Free the slot acquired by admit()."""
+        if ticket is None:
+            return
+        user, coldUrl = ticket
+        self._condition.acquire()
+        try:
+            if coldUrl is None:
+                self._running -= 1
+            else:
+                self._coldWalks.discard(coldUrl)
+            n = self._runningPerUser[user] - 1
+            if n:
+                self._runningPerUser[user] = n
+            else:
+                del self._runningPerUser[user]
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
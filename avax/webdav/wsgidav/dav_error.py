@@ -162,11 +162,13 @@ class DAVError(Exception):
                  statusCode, 
                  contextinfo=None, 
                  srcexception=None,
-                 errcondition=None):  # allow passing of Pre- and Postconditions, see http://www.webdav.org/specs/rfc4918.html#precondition.postcondition.xml.elements
+                 errcondition=None,  # allow passing of Pre- and Postconditions, see http://www.webdav.org/specs/rfc4918.html#precondition.postcondition.xml.elements
+                 headers=None):  # additional response headers, e.g. [("Retry-After", "30")]
         self.value = int(statusCode)
         self.contextinfo = contextinfo
         self.srcexception = srcexception
         self.errcondition = errcondition
+        self.headers = headers or []
         if type(errcondition) is str:
             self.errcondition = DAVErrorCondition(errcondition)
         assert self.errcondition is None or type(self.errcondition) is DAVErrorCondition
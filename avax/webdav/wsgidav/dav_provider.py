@@ -91,6 +91,7 @@ if False: from xml.etree import ElementTree as etree     #@Reimport @UnresolvedI
 from .dav_error import DAVError, \
     HTTP_NOT_FOUND, HTTP_FORBIDDEN,\
     PRECONDITION_CODE_ProtectedProperty, asDAVError
+from .timing import getTimer
 
 __docformat__ = "reStructuredText"
 
@@ -109,6 +110,16 @@ _standardLivePropNames = [b"{DAV:}creationdate",
 _lockPropertyNames = [b"{DAV:}lockdiscovery",
                       b"{DAV:}supportedlock"]
 
+# Live properties that are collected by _DAVResource.getLivePropertySnapshot(),
+# in the order they are reported by getPropertyNames()
+_snapshotPropNames = (b"{DAV:}creationdate",
+                      b"{DAV:}getcontentlength",
+                      b"{DAV:}getcontenttype",
+                      b"{DAV:}getlastmodified",
+                      b"{DAV:}displayname",
+                      b"{DAV:}getetag",
+                      )
+
 #DAVHRES_Continue = "continue"
 #DAVHRES_Done = "done"
 
@@ -172,6 +183,8 @@ class _DAVResource(object):
         self.isCollection = isCollection
         self.environ = environ
         self.name = util.getUriName(self.path)
+        self._liveProps = None
+        self._lockList = None
     
     def __repr__(self):
         return b"%s(%r)" % (self.__class__.__name__, self.path)
@@ -448,7 +461,9 @@ class _DAVResource(object):
         if addSelf and not depthFirst:
             res.append(self)
         if depth != b"0" and self.isCollection:
-            for child in self.getMemberList():
+            memberList = self.getMemberList()
+            getTimer(self.environ).count(b"descendants", len(memberList))
+            for child in memberList:
                 if not child:
                     _ = self.getMemberList()
                 want = (collections and child.isCollection) or (resources and not child.isCollection)
@@ -464,6 +479,50 @@ class _DAVResource(object):
 
 
     # --- Properties -----------------------------------------------------------
+
+    def getLivePropertySnapshot(self, refresh=False):
+        """Return a dictionary of formatted standard live property values.
+
+        The getters (getCreationDate(), getContentLength(), ...) are called 
+        only once and the results are formatted as they appear in a 
+        PROPFIND response (RFC 3339 / RFC 1123 dates, numeric strings).
+        Keys are property names in Clark notation; unsupported properties 
+        (i.e. the getter returned None) are omitted. {DAV:}resourcetype is
+        not part of the snapshot.
+
+        The snapshot is cached on the resource instance, which normally lives 
+        for a single request. Pass refresh=True to re-read the getters, e.g. 
+        after the resource was modified.
+        """
+        if self._liveProps is not None and not refresh:
+            return self._liveProps
+
+        props = {}
+        creationDate = self.getCreationDate()
+        if creationDate is not None:
+            # Note: uses RFC3339 format (ISO 8601)
+            props[b"{DAV:}creationdate"] = util.getRfc3339Time(creationDate)
+        contentLength = self.getContentLength()
+        if contentLength is not None:
+            assert not self.isCollection
+            # Note: must be a numeric string
+            props[b"{DAV:}getcontentlength"] = str(contentLength)
+        contentType = self.getContentType()
+        if contentType is not None:
+            props[b"{DAV:}getcontenttype"] = contentType
+        lastModified = self.getLastModified()
+        if lastModified is not None:
+            # Note: uses RFC1123 format
+            props[b"{DAV:}getlastmodified"] = util.getRfc1123Time(lastModified)
+        displayName = self.getDisplayName()
+        if displayName is not None:
+            props[b"{DAV:}displayname"] = displayName
+        etag = self.getEtag()
+        if etag is not None:
+            props[b"{DAV:}getetag"] = etag
+
+        self._liveProps = props
+        return props
      
     def getPropertyNames(self, isAllProp):
         """Return list of supported property names in Clark Notation.
@@ -475,7 +534,8 @@ class _DAVResource(object):
         This default implementation returns a combination of:
         
         - Supported standard live properties in the {DAV:} namespace, if the 
-          related getter method returns not None.
+          related getter method returns not None (see 
+          getLivePropertySnapshot()).
         - {DAV:}lockdiscovery and {DAV:}supportedlock, if a lock manager is 
           present
         - If a property manager is present, then a list of dead properties is 
@@ -488,20 +548,11 @@ class _DAVResource(object):
         propNameList = []
         
         propNameList.append(b"{DAV:}resourcetype")
-        
-        if self.getCreationDate() is not None:
-            propNameList.append(b"{DAV:}creationdate")
-        if self.getContentLength() is not None:
-            assert not self.isCollection
-            propNameList.append(b"{DAV:}getcontentlength")
-        if self.getContentType() is not None:
-            propNameList.append(b"{DAV:}getcontenttype")
-        if self.getLastModified() is not None:
-            propNameList.append(b"{DAV:}getlastmodified")
-        if self.getDisplayName() is not None:
-            propNameList.append(b"{DAV:}displayname")
-        if self.getEtag() is not None:
-            propNameList.append(b"{DAV:}getetag")
+
+        liveProps = self.getLivePropertySnapshot()
+        for name in _snapshotPropNames:
+            if name in liveProps:
+                propNameList.append(name)
             
         ## Locking properties 
         if self.provider.lockManager and not self.preventLocking():
@@ -579,7 +630,8 @@ class _DAVResource(object):
         ``{DAV:}supportedlock`` using the associated lock manager.
         
         All other *live* properties (i.e. propname starts with ``{DAV:}``) are 
-        delegated to the self.xxx() getters.
+        taken from getLivePropertySnapshot(), which calls the self.xxx() 
+        getters once per resource.
         
         Finally, other properties are considered *dead*, and are handled  by 
         the associated property manager. 
@@ -590,7 +642,9 @@ class _DAVResource(object):
         lm = self.provider.lockManager     
         if lm and propname == b"{DAV:}lockdiscovery":
             # TODO: we return HTTP_NOT_FOUND if no lockmanager is present. Correct?
-            activelocklist = lm.getUrlLockList(refUrl)
+            activelocklist = self._lockList
+            if activelocklist is None:
+                activelocklist = lm.getUrlLockList(refUrl)
             lockdiscoveryEL = etree.Element(propname)
             for lock in activelocklist:
                 activelockEL = etree.SubElement(lockdiscoveryEL, b"{DAV:}activelock")
@@ -653,27 +707,15 @@ class _DAVResource(object):
 
         elif propname.startswith(b"{DAV:}"):
             # Standard live property (raises HTTP_NOT_FOUND if not supported)
-            if propname == b"{DAV:}creationdate" and self.getCreationDate() is not None:
-                # Note: uses RFC3339 format (ISO 8601)
-                return util.getRfc3339Time(self.getCreationDate())
-            elif propname == b"{DAV:}getcontenttype" and self.getContentType() is not None:
-                return self.getContentType()
-            elif propname == b"{DAV:}resourcetype":
+            if propname == b"{DAV:}resourcetype":
                 if self.isCollection:
                     resourcetypeEL = etree.Element(propname)
                     etree.SubElement(resourcetypeEL, b"{DAV:}collection")
                     return resourcetypeEL            
                 return b""
-            elif propname == b"{DAV:}getlastmodified" and self.getLastModified() is not None:
-                # Note: uses RFC1123 format
-                return util.getRfc1123Time(self.getLastModified())
-            elif propname == b"{DAV:}getcontentlength" and self.getContentLength() is not None:
-                # Note: must be a numeric string
-                return str(self.getContentLength())
-            elif propname == b"{DAV:}getetag" and self.getEtag() is not None:
-                return self.getEtag()
-            elif propname == b"{DAV:}displayname" and self.getDisplayName() is not None:
-                return self.getDisplayName()
+            liveProps = self.getLivePropertySnapshot()
+            if propname in liveProps:
+                return liveProps[propname]
     
             # Unsupported, no persistence available, or property not found
             raise DAVError(HTTP_NOT_FOUND)               
@@ -747,6 +789,15 @@ class _DAVResource(object):
         """
         return False               
 
+    def setLockList(self, lockList):
+        """Pass the list of direct locks, that was queried in advance.
+        
+        This is used by bulk requests (e.g. PROPFIND, see 
+        LockManager.getLocksForUrls()), so {DAV:}lockdiscovery does not have to 
+        query the lock manager for every single resource.
+        """
+        self._lockList = lockList
+
     def isLocked(self):
         """Return True, if URI is locked."""
         if self.provider.lockManager is None:
@@ -252,12 +252,18 @@ class WsgiDavDirBrowser(object):
             for res in childList:
                 di = res.getDisplayInfo()
                 href = res.getHref()
+                # Query the live properties in one pass; dates come 
+                # pre-formatted
+                liveProps = res.getLivePropertySnapshot()
+                contentLength = liveProps.get(b"{DAV:}getcontentlength")
+                if contentLength is not None:
+                    contentLength = long(contentLength)
                 infoDict = {b"href": href,
                             b"class": b"",
-                            b"displayName": res.getDisplayName(),
-                            b"lastModified": res.getLastModified(),
+                            b"displayName": liveProps.get(b"{DAV:}displayname"),
+                            b"strModified": liveProps.get(b"{DAV:}getlastmodified", b""),
                             b"isCollection": res.isCollection,
-                            b"contentLength": res.getContentLength(),
+                            b"contentLength": contentLength,
                             b"displayType": di.get(b"type"),
                             b"displayTypeComment": di.get(b"typeComment"),
                             }
@@ -276,11 +282,12 @@ class WsgiDavDirBrowser(object):
                 dirInfoList.append(infoDict)
         # 
         for infoDict in dirInfoList:
-            lastModified = infoDict.get(b"lastModified")
-            if lastModified is None:
-                infoDict[b"strModified"] = b""
-            else:
-                infoDict[b"strModified"] = util.getRfc1123Time(lastModified)
+            if b"strModified" not in infoDict:
+                lastModified = infoDict.get(b"lastModified")
+                if lastModified is None:
+                    infoDict[b"strModified"] = b""
+                else:
+                    infoDict[b"strModified"] = util.getRfc1123Time(lastModified)
             
             infoDict[b"strSize"] = b"-"
             if not infoDict.get(b"isCollection"):
@@ -312,8 +319,13 @@ class WsgiDavDirBrowser(object):
 
         html.append(b"</body></html>")
         body = b"\n".join(html)
-        start_response(b"200 OK", [(b"Content-Type", b"text/html"),
-                                   (b"Content-Length", str(len(body))),
-                                   (b"Date", util.getRfc1123Time()),
-                                   ])
+        headers = [(b"Content-Type", b"text/html"),
+                   (b"Content-Length", str(len(body))),
+                   (b"Date", util.getRfc1123Time()),
+                   ]
+        # Signed session cookie, so the browser may skip authentication
+        cookie = environ.get(b"http_authenticator.set_cookie")
+        if cookie:
+            headers.append((b"Set-Cookie", cookie))
+        start_response(b"200 OK", headers)
         return [body]
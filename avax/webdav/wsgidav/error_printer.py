@@ -14,6 +14,7 @@ __docformat__ = "reStructuredText"
 import sys
 import traceback
 import logging
+from itertools import chain
 
 from . import util
 from .dav_error import DAVError, getHttpStatusString, asDAVError,\
@@ -79,37 +80,77 @@ class ErrorPrinter(object):
                     traceback.print_exc(10, sys.stderr) 
                     raise
         except DAVError, e:
-            _logger.error(b"caught %s" % e)
-
-            status = getHttpStatusString(e)
-            # Dump internal errors to console
-            if e.value == HTTP_INTERNAL_ERROR:
-                print(b"ErrorPrinter: caught HTTPRequestException(HTTP_INTERNAL_ERROR)")
-                traceback.print_exc(10, environ.get(b"wsgi.errors") or sys.stdout)
-                print(b"e.srcexception:\n%s" % e.srcexception)
-            elif e.value in (HTTP_NOT_MODIFIED, HTTP_NO_CONTENT):
-#                util.log("ErrorPrinter: forcing empty error response for %s" % e.value)
-                # See paste.lint: these code don't have content
-                start_response(status, [(b"Content-Length", b"0"),
-                                        (b"Date", util.getRfc1123Time()),
-                                        ])
-                yield b""
-                return
+            for v in self._errorResponse(e, environ, start_response):
+                yield v
+            return
 
-            # If exception has pre-/post-condition: return as XML response, 
-            # else return as HTML 
-            content_type, body = e.getResponsePage()            
+    def callFlat(self, environ, start_response):
+        """Same as __call__, but return the response iterable without re-yielding.
 
-            # TODO: provide exc_info=sys.exc_info()?
-            start_response(status, [(b"Content-Type", content_type),
-                                    (b"Content-Length", str(len(body))),
+        The application is run up to its first chunk, so DAVErrors raised
+        before the response started are still turned into error responses.
+        The remaining chunks are passed through untouched (errors raised
+        after the first chunk are left to the server).
+        """
+        sub_app_start_response = util.SubAppStartResponse()
+        try:
+            try:
+                app_iter = self._application(environ, sub_app_start_response)
+                it = iter(app_iter)
+                try:
+                    first = [next(it)]
+                except StopIteration:
+                    first = []
+            except DAVError, e:
+                _logger.debug(b"re-raising %s" % e)
+                raise
+            except Exception, e:
+                if self._catch_all_exceptions:
+                    traceback.print_exc(10, sys.stderr)
+                    raise asDAVError(e)
+                util.warn(b"ErrorPrinter: caught Exception")
+                traceback.print_exc(10, sys.stderr) 
+                raise
+        except DAVError, e:
+            return self._errorResponse(e, environ, start_response)
+
+        start_response(sub_app_start_response.status,
+                       sub_app_start_response.response_headers,
+                       sub_app_start_response.exc_info)
+        if hasattr(app_iter, b"close"):
+            return util.ClosingIterator(chain(first, it), app_iter.close)
+        return chain(first, it)
+
+    def _errorResponse(self, e, environ, start_response):
+        """Start an error response for DAVError e and return its body."""
+        _logger.error(b"caught %s" % e)
+
+        status = getHttpStatusString(e)
+        # Dump internal errors to console
+        if e.value == HTTP_INTERNAL_ERROR:
+            print(b"ErrorPrinter: caught HTTPRequestException(HTTP_INTERNAL_ERROR)")
+            traceback.print_exc(10, environ.get(b"wsgi.errors") or sys.stdout)
+            print(b"e.srcexception:\n%s" % e.srcexception)
+        elif e.value in (HTTP_NOT_MODIFIED, HTTP_NO_CONTENT):
+#            util.log("ErrorPrinter: forcing empty error response for %s" % e.value)
+            # See paste.lint: these code don't have content
+            start_response(status, [(b"Content-Length", b"0"),
                                     (b"Date", util.getRfc1123Time()),
                                     ])
-
-            method = environ[b"REQUEST_METHOD"]
-            if method == b'HEAD':
-                # body should not be returned for HEAD request.
-                yield b''
-            else:
-                yield body
-            return
+            return [b""]
+
+        # If exception has pre-/post-condition: return as XML response, 
+        # else return as HTML 
+        content_type, body = e.getResponsePage()            
+
+        # TODO: provide exc_info=sys.exc_info()?
+        start_response(status, [(b"Content-Type", content_type),
+                                (b"Content-Length", str(len(body))),
+                                (b"Date", util.getRfc1123Time()),
+                                ] + e.headers)
+
+        method = environ[b"REQUEST_METHOD"]
+        if method == b'HEAD':
+            # body should not be returned for HEAD request.
+            return [b'']
+        return [body]
@@ -24,6 +24,7 @@ from ..wsgidav.dav_error import DAVError, HTTP_FORBIDDEN
 from ..wsgidav.dav_provider import DAVProvider, DAVCollection, DAVNonCollection
 
 from . import util
+from .timing import timed
 
 __docformat__ = "reStructuredText"
 
@@ -349,6 +350,7 @@ class FilesystemProvider(DAVProvider):
     def isReadOnly(self):
         return self.readonly
 
+    @timed(b"resource", 2)
     def getResourceInst(self, path, environ):
         """Return info dictionary for path.
 
@@ -31,6 +31,22 @@ environ dictionary::
    
    environ["http_authenticator.realm"] = realm name
    environ["http_authenticator.username"] = username
+
+Two opt-in modes save the verification (and the 401 round trip of clients
+that always start without credentials, like the Windows MiniRedir):
+
+connectionAuth
+   The verified user is bound to the keep-alive connection (the server must
+   pass a ``environ["wsgiserver.connection_state"]`` dictionary, as the
+   bundled CherryPy server does). Later requests for the same realm on this
+   connection are accepted if they carry the same Authorization header, or
+   none at all. Do not use this behind proxies that send requests of
+   different users over one connection.
+
+sessionCookies
+   A `SessionCookies` object. After a successful login, directory listings
+   set a signed cookie; GET and HEAD requests without Authorization header
+   are accepted with a valid cookie (browser access).
    
 
 **Domain Controllers**
@@ -79,14 +95,17 @@ from __future__ import absolute_import, division, unicode_literals
 
 __docformat__ = "reStructuredText"
 
-import random
+import os
 import base64
+import hmac
 try:
-    from hashlib import md5
+    from hashlib import md5, sha1
 except ImportError:
     from md5 import md5
+    import sha as sha1
 import time
 import re
+import threading
 
 from . import util
 
@@ -103,6 +122,163 @@ HOTFIX_WINXP_AcceptRootShareLogin = True
 HOTFIX_WIN_AcceptAnonymousOptions = False
 
 
+#===============================================================================
+# NonceManager
+#===============================================================================
+class NonceManager(object):
+    """Issue digest nonces and check them when they are used.
+
+    A nonce contains its creation time and is signed with a server secret, so
+    it can be checked without server-side state (for example after it was
+    evicted, or when it was issued by another worker process that uses the
+    same secret).
+    For every nonce the nonce counts (nc) seen recently are remembered, so a
+    request cannot be replayed. Counts may arrive out of order (clients send
+    requests over several connections), as long as they are within a window
+    of `ncWindow` below the highest count seen.
+
+    check() returns one of:
+
+    NONCE_OK
+        The nonce and nonce count are valid.
+    NONCE_STALE
+        The nonce was issued by us but has expired, or the nonce count was
+        already used. If the digest was correct, the client should be asked
+        to retry with a new nonce without prompting the user ('stale=true').
+    NONCE_INVALID
+        The nonce was not issued by us.
+    """
+    NONCE_OK = 0
+    NONCE_STALE = 1
+    NONCE_INVALID = 2
+
+    def __init__(self, lifetime=900, maxNonces=10000, secret=None, ncWindow=64):
+        self.lifetime = lifetime
+        self.maxNonces = maxNonces
+        self.secret = secret or os.urandom(20)
+        self.ncWindow = ncWindow
+        self._lock = threading.Lock()
+        # Nonce count state {nonce: [highest nc, bitmask of seen counts]}
+        self._nonces = {}
+
+    def __repr__(self):
+        return "%s(nonces=%s, lifetime=%s)" % (
+            self.__class__.__name__, len(self._nonces), self.lifetime)
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload, sha1).hexdigest()
+
+    def createNonce(self):
+        """Return a new nonce."""
+        payload = b"%x:%s" % (int(time.time()), os.urandom(8).encode(b"hex"))
+        return base64.b64encode(payload + b":" + self._sign(payload))
+
+    def check(self, nonce, nc):
+        """Check a nonce and its count (nc is None if qop was not sent)."""
+        try:
+            payload, signature = base64.b64decode(nonce).rsplit(b":", 1)
+            created = int(payload.split(b":", 1)[0], 16)
+        except (TypeError, ValueError):
+            return self.NONCE_INVALID
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return self.NONCE_INVALID
+        if time.time() - created > self.lifetime:
+            with self._lock:
+                self._nonces.pop(nonce, None)
+            return self.NONCE_STALE
+        if nc is None:
+            return self.NONCE_OK
+        try:
+            nc = int(nc, 16)
+        except ValueError:
+            return self.NONCE_INVALID
+
+        with self._lock:
+            state = self._nonces.get(nonce)
+            if state is None:
+                if len(self._nonces) >= self.maxNonces:
+                    self._purge()
+                self._nonces[nonce] = [nc, 1]
+                return self.NONCE_OK
+            highest, seen = state
+            if nc > highest:
+                shift = nc - highest
+                state[0] = nc
+                state[1] = ((seen << shift) | 1) & ((1 << self.ncWindow) - 1)
+                return self.NONCE_OK
+            offset = highest - nc
+            if offset >= self.ncWindow or seen & (1 << offset):
+                return self.NONCE_STALE
+            state[1] = seen | (1 << offset)
+            return self.NONCE_OK
+
+    def _purge(self):
+        """Drop the state of expired nonces, or of all if none expired."""
+        cutoff = time.time() - self.lifetime
+        for nonce in self._nonces.keys():
+            try:
+                created = int(base64.b64decode(nonce).split(b":", 1)[0], 16)
+            except (TypeError, ValueError):
+                created = 0
+            if created < cutoff:
+                del self._nonces[nonce]
+        if len(self._nonces) >= self.maxNonces:
+            self._nonces.clear()
+
+
+#===============================================================================
+# SessionCookies
+#===============================================================================
+class SessionCookies(object):
+    """Create and check signed cookies that carry a verified user name.
+
+    The cookie value is 'hex(username)|expiration|signature'. The signature
+    covers the realm as well, so a cookie is only valid for the realm it was
+    issued for.
+    """
+
+    def __init__(self, secret=None, maxAge=3600, name=b"wsgidav_session"):
+        self.secret = secret or os.urandom(20)
+        self.maxAge = maxAge
+        self.name = name
+
+    def __repr__(self):
+        return "%s(%r, maxAge=%s)" % (self.__class__.__name__, self.name,
+                                     self.maxAge)
+
+    def _sign(self, realmname, payload):
+        return hmac.new(self.secret, realmname + b"|" + payload, sha1).hexdigest()
+
+    def makeCookie(self, environ, realmname, username):
+        """Return a Set-Cookie header value for the user."""
+        payload = b"%s|%x" % (username.encode(b"hex"), int(time.time()) + self.maxAge)
+        cookie = b"%s=%s|%s; Path=%s; Max-Age=%d; HttpOnly" % (
+            self.name, payload, self._sign(realmname, payload),
+            environ.get(b"SCRIPT_NAME") or b"/", self.maxAge)
+        if environ.get(b"wsgi.url_scheme") == b"https":
+            cookie += b"; Secure"
+        return cookie
+
+    def getUsername(self, environ, realmname):
+        """Return the user name of a valid session cookie, or None."""
+        prefix = self.name + b"="
+        for cookie in environ.get(b"HTTP_COOKIE", b"").split(b";"):
+            cookie = cookie.strip()
+            if not cookie.startswith(prefix):
+                continue
+            try:
+                username, expires, signature = cookie[len(prefix):].split(b"|")
+                if int(expires, 16) < time.time():
+                    continue
+                if not hmac.compare_digest(
+                        signature, self._sign(realmname, username + b"|" + expires)):
+                    continue
+                return username.decode(b"hex")
+            except (TypeError, ValueError):
+                continue
+        return None
+
+
 class SimpleDomainController(object):
     """SimpleDomainController : Simple domain controller for HTTPAuthenticator."""
     def __init__(self, dictusers = None, realmname = b"SimpleDomain"):
@@ -137,12 +313,25 @@ class SimpleDomainController(object):
 #===============================================================================
 class HTTPAuthenticator(object):
     """WSGI Middleware for basic and digest authenticator."""
-    def __init__(self, application, domaincontroller, acceptbasic=True, acceptdigest=True, defaultdigest=True):
+    def __init__(self, application, domaincontroller, acceptbasic=True, acceptdigest=True, defaultdigest=True,
+                 nonceManager=None, connectionAuth=False, sessionCookies=None):
         self._domaincontroller = domaincontroller
-        self._application = application
-        self._noncedict = dict([])
-
-        self._headerparser = re.compile(r"([\w]+)=([^,]*),")
+        self._nonceManager = nonceManager or NonceManager()
+        self._connectionAuth = connectionAuth
+        self._sessionCookies = sessionCookies
+
+        def _application(environ, start_response):
+            # End of the 'auth' phase (started in __call__)
+            timer = environ.get(b"wsgidav.timer")
+            if timer is not None:
+                timer.end(b"auth")
+            return application(environ, start_response)
+        self._application = _application
+
+        # Domain controllers may provide precomputed HA1 values
+        self._getRealmUserHA1 = getattr(domaincontroller, "getRealmUserHA1", None)
+
+        self._headerparser = re.compile(r'(\w+)\s*=\s*(?:"([^"]*)"|([^\s,]*))')
         self._headermethod = re.compile(r"^([\w]+)")
         
         self._acceptbasic = acceptbasic
@@ -151,9 +340,20 @@ class HTTPAuthenticator(object):
 
    
     def __call__(self, environ, start_response):
-        realmname = self._domaincontroller.getDomainRealm(environ[b"PATH_INFO"], environ)
+        timer = environ.get(b"wsgidav.timer")
+        if timer is not None:
+            timer.begin(b"auth")
+
+        # WsgiDAVApp passes a precomputed (realm, required) entry for domain
+        # controllers that only look at the share
+        realminfo = environ.get(b"wsgidav.auth_realm")
+        if realminfo is None:
+            realmname = self._domaincontroller.getDomainRealm(environ[b"PATH_INFO"], environ)
+            required = None
+        else:
+            realmname, required = realminfo
         
-        _logger.debug("realm '%s'" % realmname)
+        _logger.debug("realm '%s'", realmname)
         # _logger.debug("%s" % environ)
 
         force_allow = False
@@ -161,26 +361,47 @@ class HTTPAuthenticator(object):
             _logger.warning("No authorization required for OPTIONS method")
             force_allow = True
 
-        if force_allow or not self._domaincontroller.requireAuthentication(realmname, environ):
+        if required is None and not force_allow:
+            required = self._domaincontroller.requireAuthentication(realmname, environ)
+
+        if force_allow or not required:
             # no authentication needed
             _logger.debug("No authorization required for realm '%s'" % realmname)
             environ[b"http_authenticator.realm"] = realmname
             environ[b"http_authenticator.username"] = b""
             return self._application(environ, start_response)
+
+        authheader = environ.get(b"HTTP_AUTHORIZATION")
+        if self._connectionAuth:
+            # User verified by an earlier request on this connection
+            bound = environ.get(b"wsgiserver.connection_state", {}).get(b"http_authenticator")
+            if bound and bound[0] == realmname and authheader in (None, bound[2]):
+                environ[b"http_authenticator.realm"] = realmname
+                environ[b"http_authenticator.username"] = bound[1]
+                return self._application(environ, start_response)
+
+        if (authheader is None and self._sessionCookies
+                and environ[b"REQUEST_METHOD"] in (b"GET", b"HEAD")):
+            username = self._sessionCookies.getUsername(environ, realmname)
+            # Users may have been removed since the cookie was issued
+            if (username is not None
+                    and self._domaincontroller.isRealmUser(realmname, username, environ)):
+                environ[b"http_authenticator.realm"] = realmname
+                environ[b"http_authenticator.username"] = username
+                return self._application(environ, start_response)
         
-        if b"HTTP_AUTHORIZATION" in environ:
-            authheader = environ[b"HTTP_AUTHORIZATION"]
+        if authheader is not None:
             authmatch = self._headermethod.search(authheader)          
             authmethod = b"None"
             if authmatch:
                 authmethod = authmatch.group(1).lower()
                 
             if authmethod == b"digest" and self._acceptdigest:
-                return self.authDigestAuthRequest(environ, start_response)
+                return self.authDigestAuthRequest(environ, start_response, realmname)
             elif authmethod == b"digest" and self._acceptbasic:
-                return self.sendBasicAuthResponse(environ, start_response)
+                return self.sendBasicAuthResponse(environ, start_response, realmname)
             elif authmethod == b"basic" and self._acceptbasic:
-                return self.authBasicAuthRequest(environ, start_response)
+                return self.authBasicAuthRequest(environ, start_response, realmname)
 
             util.log("HTTPAuthenticator: respond with 400 Bad request; Auth-Method: %s" % authmethod)
             
@@ -190,12 +411,18 @@ class HTTPAuthenticator(object):
             return [b""]
 
         if self._defaultdigest:
-            return self.sendDigestAuthResponse(environ, start_response)
-        return self.sendBasicAuthResponse(environ, start_response)
+            return self.sendDigestAuthResponse(environ, start_response, realmname=realmname)
+        return self.sendBasicAuthResponse(environ, start_response, realmname)
+
 
+    def _getRealm(self, environ, realmname):
+        if realmname is None:
+            realmname = self._domaincontroller.getDomainRealm(environ[b"PATH_INFO"] , environ)
+        return realmname
 
-    def sendBasicAuthResponse(self, environ, start_response):
-        realmname = self._domaincontroller.getDomainRealm(environ[b"PATH_INFO"] , environ)
+
+    def sendBasicAuthResponse(self, environ, start_response, realmname=None):
+        realmname = self._getRealm(environ, realmname)
         _logger.debug("401 Not Authorized for realm '%s' (basic)" % realmname)
         wwwauthheaders = b"Basic realm=\"" + realmname + b"\""
         
@@ -208,8 +435,8 @@ class HTTPAuthenticator(object):
         return [ body ]
 
 
-    def authBasicAuthRequest(self, environ, start_response):
-        realmname = self._domaincontroller.getDomainRealm(environ[b"PATH_INFO"] , environ)
+    def authBasicAuthRequest(self, environ, start_response, realmname=None):
+        realmname = self._getRealm(environ, realmname)
         authheader = environ[b"HTTP_AUTHORIZATION"]
         authvalue = b""
         try:
@@ -220,21 +447,18 @@ class HTTPAuthenticator(object):
         username, password = authvalue.split(b":",1)
         
         if self._domaincontroller.authDomainUser(realmname, username, password, environ):
-            environ[b"http_authenticator.realm"] = realmname
-            environ[b"http_authenticator.username"] = username
-            return self._application(environ, start_response)
-        return self.sendBasicAuthResponse(environ, start_response)
+            return self._authenticated(environ, start_response, realmname, username)
+        return self.sendBasicAuthResponse(environ, start_response, realmname)
         
 
-    def sendDigestAuthResponse(self, environ, start_response):    
-        realmname = self._domaincontroller.getDomainRealm(environ[b"PATH_INFO"] , environ)
-        random.seed()
-        serverkey = hex(random.getrandbits(32))[2:]
-        etagkey = md5(environ[b"PATH_INFO"]).hexdigest()
-        timekey = str(time.time())  
-        nonce = base64.b64encode(timekey + md5(timekey + b":" + etagkey + b":" + serverkey).hexdigest())
+    def sendDigestAuthResponse(self, environ, start_response, stale=False, realmname=None):
+        realmname = self._getRealm(environ, realmname)
+        nonce = self._nonceManager.createNonce()
         wwwauthheaders = b"Digest realm=\"" + realmname + b"\", nonce=\"" + nonce + \
             b"\", algorithm=\"MD5\", qop=\"auth\""
+        if stale:
+            # The credentials were right: clients retry without asking the user
+            wwwauthheaders += b", stale=true"
         _logger.debug(b"401 Not Authorized for realm '%s' (digest): %s" % (realmname, wwwauthheaders))
 
         body = self.getErrorMessage()
@@ -247,24 +471,22 @@ class HTTPAuthenticator(object):
         return [ body ]
         
 
-    def authDigestAuthRequest(self, environ, start_response):  
+    def authDigestAuthRequest(self, environ, start_response, realmname=None):
 
-        realmname = self._domaincontroller.getDomainRealm(environ[b"PATH_INFO"] , environ)
+        realmname = self._getRealm(environ, realmname)
         
         isinvalidreq = False
+        req_username = None
          
         authheaderdict = dict([])
-        authheaders = environ[b"HTTP_AUTHORIZATION"] + b","
+        authheaders = environ[b"HTTP_AUTHORIZATION"]
         if not authheaders.lower().strip().startswith(b"digest"):
             isinvalidreq = True
-        authheaderlist = self._headerparser.findall(authheaders)
-        for authheader in authheaderlist:
-            authheaderkey = authheader[0]
-            authheadervalue = authheader[1].strip().strip(b"\"")
-            authheaderdict[authheaderkey] = authheadervalue
-
-        _logger.debug("authDigestAuthRequest: %s" % environ["HTTP_AUTHORIZATION"])
-        _logger.debug("  -> %s" % authheaderdict)
+        for authheaderkey, quotedvalue, tokenvalue in self._headerparser.findall(authheaders):
+            authheaderdict[authheaderkey] = quotedvalue or tokenvalue
+
+        _logger.debug("authDigestAuthRequest: %s", environ["HTTP_AUTHORIZATION"])
+        _logger.debug("  -> %s", authheaderdict)
          
         if b"username" in authheaderdict:
             req_username = authheaderdict[b"username"]
@@ -301,6 +523,8 @@ class HTTPAuthenticator(object):
         
         if b"uri" in authheaderdict:
             req_uri = authheaderdict[b"uri"]
+        else:
+            isinvalidreq = True
 
         if b"nonce" in authheaderdict:
             req_nonce = authheaderdict[b"nonce"]
@@ -323,7 +547,7 @@ class HTTPAuthenticator(object):
             if req_hasqop:
                 isinvalidreq = True
          
-        if b"nc" in authheaderdict:    # is read but nonce-count checking not implemented
+        if b"nc" in authheaderdict:
             req_nc = authheaderdict[b"nc"]
         else:
             req_nc = None
@@ -336,17 +560,22 @@ class HTTPAuthenticator(object):
             isinvalidreq = True
              
         if not isinvalidreq:
-            req_password = self._domaincontroller.getRealmUserPassword(realmname, req_username, environ)
+            if self._getRealmUserHA1:
+                req_ha1 = self._getRealmUserHA1(realmname, req_username, environ)
+            else:
+                req_password = self._domaincontroller.getRealmUserPassword(realmname, req_username, environ)
+                req_ha1 = req_password is not None and self.md5h(req_username + b":" + realmname + b":" + req_password)
 
             req_method = environ[b"REQUEST_METHOD"]
             
-            required_digest = self.computeDigestResponse(req_username, realmname, req_password, req_method, req_uri, req_nonce, req_cnonce, req_qop, req_nc)
+            required_digest = req_ha1 and self.computeDigestResponseHA1(req_ha1, req_method, req_uri, req_nonce, req_cnonce, req_qop, req_nc)
             
             if required_digest != req_response:
                 _logger.warning("computeDigestResponse('%s', '%s', ...): %s != %s" % (realmname, req_username, required_digest, req_response))
                 if HOTFIX_WINXP_AcceptRootShareLogin:
                     # Hotfix: also accept '/' digest
-                    root_digest = self.computeDigestResponse(req_username, "/", req_password, req_method, req_uri, req_nonce, req_cnonce, req_qop, req_nc)
+                    req_password = self._domaincontroller.getRealmUserPassword(realmname, req_username, environ)
+                    root_digest = req_password is not None and self.computeDigestResponse(req_username, "/", req_password, req_method, req_uri, req_nonce, req_cnonce, req_qop, req_nc)
                     if root_digest == req_response:
                         _logger.warning("authDigestAuthRequest: HOTFIX: accepting '/' login for '%s'." % realmname)
                     else:
@@ -359,20 +588,47 @@ class HTTPAuthenticator(object):
 
         if isinvalidreq:
             _logger.warning("Authentication failed for user '%s', realm '%s'" % (req_username, realmname))
-            return self.sendDigestAuthResponse(environ, start_response)
+            return self.sendDigestAuthResponse(environ, start_response, realmname=realmname)
+
+        # The digest is right: only now the nonce state is touched. If the
+        # nonce has expired, was replayed or is unknown (e.g. issued before
+        # a restart), the client may retry with a new one.
+        if self._nonceManager.check(req_nonce, req_nc) != NonceManager.NONCE_OK:
+            _logger.info("Stale nonce for user '%s', realm '%s'" % (req_username, realmname))
+            return self.sendDigestAuthResponse(environ, start_response, stale=True,
+                                               realmname=realmname)
+
+        return self._authenticated(environ, start_response, realmname, req_username)
 
+
+    def _authenticated(self, environ, start_response, realmname, username):
+        """Call the application for a user whose credentials were verified."""
         environ[b"http_authenticator.realm"] = realmname
-        environ[b"http_authenticator.username"] = req_username
-        return self._application(environ, start_response)                
+        environ[b"http_authenticator.username"] = username
+        if self._connectionAuth:
+            state = environ.get(b"wsgiserver.connection_state")
+            if state is not None:
+                state[b"http_authenticator"] = (realmname, username,
+                                                environ[b"HTTP_AUTHORIZATION"])
+        if self._sessionCookies and environ[b"REQUEST_METHOD"] in (b"GET", b"HEAD"):
+            # Sent with directory listings (see WsgiDavDirBrowser)
+            environ[b"http_authenticator.set_cookie"] = self._sessionCookies.makeCookie(
+                environ, realmname, username)
+        return self._application(environ, start_response)
 
 
     def computeDigestResponse(self, username, realm, password, method, uri, nonce, cnonce, qop, nc):
         A1 = username + b":" + realm + b":" + password
+        return self.computeDigestResponseHA1(self.md5h(A1), method, uri, nonce, cnonce, qop, nc)
+
+
+    def computeDigestResponseHA1(self, ha1, method, uri, nonce, cnonce, qop, nc):
+        """Return the digest response, using a precomputed md5h(A1)."""
         A2 = method + b":" + uri
         if qop:
-            digestresp = self.md5kd( self.md5h(A1), nonce + b":" + nc + b":" + cnonce + b":" + qop + b":" + self.md5h(A2))
+            digestresp = self.md5kd(ha1, nonce + b":" + nc + b":" + cnonce + b":" + qop + b":" + self.md5h(A2))
         else:
-            digestresp = self.md5kd( self.md5h(A1), nonce + b":" + self.md5h(A2))
+            digestresp = self.md5kd(ha1, nonce + b":" + self.md5h(A2))
         # print A1, A2
         # print digestresp
         return digestresp
@@ -11,6 +11,7 @@ class IDomainController(object):
       
         wsgidav.domain_controller.WsgiDAVDomainController
         wsgidav.addons.nt_domain_controller.NTDomainController
+        wsgidav.addons.hashed_domain_controller.HashedDomainController
       
     All methods must be implemented.
    
@@ -34,4 +35,11 @@ class IDomainController(object):
     allow access to the resource.
    
     A domain controller provides this information to the HTTPAuthenticator. 
+
+    For digest authentication, a domain controller may also implement
+    ``getRealmUserHA1(realmname, username, environ)``, returning
+    md5('username:realm:password') (or None for unknown users). Then the
+    HTTPAuthenticator uses this instead of hashing getRealmUserPassword() on
+    every request. This is meant for controllers that store HA1 values
+    instead of passwords.
     """
@@ -3,10 +3,11 @@
 Implements the `LockManager` object that provides the locking functionality.
 
 The LockManager requires a LockStorage object to implement persistence.  
-Two alternative lock storage classes are defined in the lock_storage module:
+Three alternative lock storage classes are defined in the lock_storage module:
 
 - wsgidav.lock_storage.LockStorageDict
 - wsgidav.lock_storage.LockStorageShelve
+- wsgidav.lock_storage.LockStorageSqlite (may be shared by several processes)
 
 
 The lock data model is a dictionary with these fields:
@@ -44,6 +45,7 @@ from pprint import pprint
 
 from . import util
 from .rw_lock import ReadWriteLock
+from .timing import counted
 from .dav_error import DAVError, HTTP_LOCKED, PRECONDITION_CODE_LockConflict
 from ..wsgidav.dav_error import DAVErrorCondition
 
@@ -126,7 +128,7 @@ class LockManager(object):
             LockManagerStorage object
         """
         assert hasattr(storage, b"getLockList")
-        self._lock = ReadWriteLock()
+        self._lock = ReadWriteLock(b"lock_manager")
         self.storage = storage
         self.storage.open()
 
@@ -207,6 +209,7 @@ class LockManager(object):
         self.storage.create(path, lockDict)
         return lockDict
 
+    @counted(b"lock_manager")
     def acquire(self, url, locktype, lockscope, lockdepth, lockowner, timeout, 
                 principal, tokenList):
         """Check for permissions and acquire a lock.
@@ -215,20 +218,28 @@ class LockManager(object):
         On error raise a DAVError with an embedded DAVErrorCondition.
         """
         url = normalizeLockRoot(url)
+        # Storages shared by several processes must make check & create atomic
+        exclusive = getattr(self.storage, b"exclusive", None)
         self._lock.acquireWrite()
         try:
+            if exclusive is not None:
+                with exclusive():
+                    self._checkLockPermission(url, locktype, lockscope, lockdepth, tokenList, principal)
+                    return self._generateLock(principal, locktype, lockscope, lockdepth, lockowner, url, timeout)
             # Raises DAVError on conflict:
             self._checkLockPermission(url, locktype, lockscope, lockdepth, tokenList, principal)
             return self._generateLock(principal, locktype, lockscope, lockdepth, lockowner, url, timeout)
         finally:
             self._lock.release()
 
+    @counted(b"lock_manager")
     def refresh(self, token, timeout=None):
         """Set new timeout for lock, if existing and valid."""
         if timeout is None:
             timeout = LockManager.LOCK_TIME_OUT_DEFAULT
         return self.storage.refresh(token, timeout)
 
+    @counted(b"lock_manager")
     def getLock(self, token, key=None):
         """Return lockDict, or None, if not found or invalid. 
         
@@ -244,15 +255,18 @@ class LockManager(object):
             return lock
         return lock[key]
 
+    @counted(b"lock_manager")
     def release(self, token):
         """Delete lock."""
         self.storage.delete(token)
 
+    @counted(b"lock_manager")
     def isTokenLockedByUser(self, token, principal):
         """Return True, if <token> exists, is valid, and bound to <principal>."""   
         return self.getLock(token, b"principal") == principal
 
 #    def getUrlLockList(self, url, principal=None):
+    @counted(b"lock_manager")
     def getUrlLockList(self, url):
         """Return list of lockDict, if <url> is protected by at least one direct, valid lock.
         
@@ -264,6 +278,40 @@ class LockManager(object):
                                             tokenOnly=False)
         return lockList
 
+    @counted(b"lock_manager")
+    def getLocksForUrls(self, urls):
+        """Return a dictionary {url: [lockDict, ...]} for a list of URLs.
+
+        This is the bulk variant of getUrlLockList(), e.g. for resolving 
+        {DAV:}lockdiscovery for all resources of a PROPFIND response at once.
+        Only URLs that are directly locked are contained in the result, so an 
+        empty dictionary means 'none of these URLs is locked'.
+        
+        Side effect: expired locks for these urls are purged.
+        """
+        pathMap = {}  # normalized path -> [url, ...]
+        for url in urls:
+            pathMap.setdefault(normalizeLockRoot(url), []).append(url)
+
+        if hasattr(self.storage, b"getLocksForPaths"):
+            pathLockMap = self.storage.getLocksForPaths(pathMap.keys())
+        else:
+            # Custom storage that has no bulk query
+            pathLockMap = {}
+            for path in pathMap:
+                lockList = self.storage.getLockList(path, includeRoot=True, 
+                                                    includeChildren=False, 
+                                                    tokenOnly=False)
+                if lockList:
+                    pathLockMap[path] = lockList
+
+        lockMap = {}
+        for path, lockList in pathLockMap.items():
+            for url in pathMap[path]:
+                lockMap[url] = lockList
+        return lockMap
+
+    @counted(b"lock_manager")
     def getIndirectUrlLockList(self, url, principal=None):
         """Return a list of valid lockDicts, that protect <path> directly or indirectly.
         
@@ -288,16 +336,19 @@ class LockManager(object):
             u = util.getUriParent(u)
         return lockList
 
+    @counted(b"lock_manager")
     def isUrlLocked(self, url):
         """Return True, if url is directly locked."""
         lockList = self.getUrlLockList(url)
         return len(lockList) > 0
 
+    @counted(b"lock_manager")
     def isUrlLockedByToken(self, url, locktoken):
         """Check, if url (or any of it's parents) is locked by locktoken."""
         lockUrl = self.getLock(locktoken, b"root")
         return lockUrl and util.isEqualOrChildUri(lockUrl, url) 
 
+    @counted(b"lock_manager")
     def removeAllLocksFromUrl(self, url):
         self._lock.acquireWrite()
         try:
@@ -390,6 +441,7 @@ class LockManager(object):
             raise DAVError(HTTP_LOCKED, errcondition=errcond)
         return
 
+    @counted(b"lock_manager")
     def checkWritePermission(self, url, depth, tokenList, principal):
         """Check, if <principal> can modify <url>, otherwise raise HTTP_LOCKED.
         
@@ -424,41 +476,40 @@ class LockManager(object):
         # Error precondition to collect conflicting URLs
         errcond = DAVErrorCondition(PRECONDITION_CODE_LockConflict)
 
-        self._lock.acquireRead()
-        try:
-            # Check url and all parents for conflicting locks
-            u = url 
-            while u:
-                ll = self.getUrlLockList(u)
-                _logger.debug("  checking %s" % u)
-                for l in ll:
-                    _logger.debug("     l=%s" % lockString(l))
-                    if u != url and l[b"depth"] != b"infinity":
-                        # We only consider parents with Depth: inifinity
-                        continue  
-                    elif principal == l[b"principal"] and l[b"token"] in tokenList:
-                        # User owns this lock 
-                        continue  
-                    else:
-                        # Token is owned by principal, but not passed with lock list
-                        _logger.debug(" -> DENIED due to locked parent %s" % lockString(l))
-                        errcond.add_href(l[b"root"])
-                u = util.getUriParent(u)
-    
-            if depth == b"infinity":
-                # Check child URLs for conflicting locks
-                childLocks = self.storage.getLockList(url, 
-                                                      includeRoot=False, 
-                                                      includeChildren=True, 
-                                                      tokenOnly=False)
+        # No need for self._lock: the result would be outdated anyway when the
+        # caller starts writing, and the storage guards its own data
 
-                for l in childLocks:
-                    assert util.isChildUri(url, l[b"root"])
-#                    if util.isChildUri(url, l["root"]): 
-                    _logger.debug(" -> DENIED due to locked child %s" % lockString(l))
+        # Check url and all parents for conflicting locks
+        u = url 
+        while u:
+            ll = self.getUrlLockList(u)
+            _logger.debug("  checking %s" % u)
+            for l in ll:
+                _logger.debug("     l=%s" % lockString(l))
+                if u != url and l[b"depth"] != b"infinity":
+                    # We only consider parents with Depth: inifinity
+                    continue  
+                elif principal == l[b"principal"] and l[b"token"] in tokenList:
+                    # User owns this lock 
+                    continue  
+                else:
+                    # Token is owned by principal, but not passed with lock list
+                    _logger.debug(" -> DENIED due to locked parent %s" % lockString(l))
                     errcond.add_href(l[b"root"])
-        finally:
-            self._lock.release()               
+            u = util.getUriParent(u)
+    
+        if depth == b"infinity":
+            # Check child URLs for conflicting locks
+            childLocks = self.storage.getLockList(url, 
+                                                  includeRoot=False, 
+                                                  includeChildren=True, 
+                                                  tokenOnly=False)
+
+            for l in childLocks:
+                assert util.isChildUri(url, l[b"root"])
+#                if util.isChildUri(url, l["root"]): 
+                _logger.debug(" -> DENIED due to locked child %s" % lockString(l))
+                errcond.add_href(l[b"root"])
 
         # If there were conflicts, raise HTTP_LOCKED for <url>, and pass
         # conflicting resource with 'no-conflicting-lock' precondition 
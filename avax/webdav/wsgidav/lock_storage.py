@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 """
-Implements two storage providers for `LockManager`.
+Implements three storage providers for `LockManager`.
 
-Two alternative lock storage classes are defined here: one in-memory
-(dict-based), and one persistent low performance variant using shelve.
+Three alternative lock storage classes are defined here: one in-memory
+(dict-based), one persistent low performance variant using shelve, and one
+using SQLite, that can be shared by several server processes.
 
 See wsgidav.lock_manager.LockManager
 
@@ -13,12 +14,16 @@ See `Developers info`_ for more information about the WsgiDAV architecture.
 """
 from __future__ import absolute_import, division, unicode_literals
 
+import errno
 import os
 import shelve
+import sqlite3
+import threading
 import time
+from contextlib import contextmanager
 
 from . import util
-from .rw_lock import ReadWriteLock
+from .rw_lock import LockStripes, DEFAULT_LOCK_STRIPES
 from ..wsgidav.lock_manager import normalizeLockRoot, lockString,\
     generateLockToken, validateLock
 
@@ -43,7 +48,10 @@ class LockStorageDict(object):
     """
     An in-memory lock manager storage implementation using a dictionary.
 
-    R/W access is guarded by a thread.lock object.
+    Every key (token or 'URL2TOKEN:<path>') is guarded by its stripe of
+    plain locks (see rw_lock.LockStripes), so requests on different paths
+    rarely contend. No stripe is held while another one is requested, except
+    by hold(key1, key2) and holdAll().
 
     Also, to make it work with a Shelve dictionary, modifying dictionary
     members is done by re-assignment and we call a _flush() method.
@@ -82,9 +90,9 @@ class LockStorageDict(object):
     LOCK_TIME_OUT_DEFAULT = 604800 # 1 week, in seconds
     LOCK_TIME_OUT_MAX = 4 * 604800 # 1 month, in seconds
 
-    def __init__(self):
+    def __init__(self, stripes=DEFAULT_LOCK_STRIPES):
         self._dict = None
-        self._lock = ReadWriteLock()
+        self._stripes = LockStripes(stripes, b"lock_storage")
 
     def __repr__(self):
         return self.__class__.__name__
@@ -93,9 +101,13 @@ class LockStorageDict(object):
         pass
 
     def _flush(self):
-        """Overloaded by Shelve implementation."""
+        """Overloaded by Shelve implementation (called with the stripes held)."""
         pass
 
+    def _isEmpty(self):
+        # len() of a dict is atomic
+        return not self._dict
+
     def open(self):
         """Called before first use.
 
@@ -115,7 +127,16 @@ class LockStorageDict(object):
     def clear(self):
         """Delete all entries."""
         if self._dict is not None:
-            self._dict.clear()
+            with self._stripes.holdAll():
+                self._dict.clear()
+
+    def countLocks(self):
+        """Return the number of stored locks (including expired ones)."""
+        with self._stripes.holdAll():
+            if self._dict is None:
+                return 0
+            return sum(1 for key in self._dict.keys()
+                       if not key.startswith(b"URL2TOKEN:"))
 
     def get(self, token):
         """Return a lock dictionary for a token.
@@ -129,22 +150,19 @@ class LockStorageDict(object):
 
         Side effect: if lock is expired, it will be purged and None is returned.
         """
-        self._lock.acquireRead()
-        try:
+        with self._stripes.hold(token):
             lock = self._dict.get(token)
-            if lock is None:
-                # Lock not found: purge dangling URL2TOKEN entries
-                _logger.debug("Lock purged dangling: %s" % token)
-                self.delete(token)
-                return None
-            expire = float(lock[b"expire"])
-            if expire >= 0 and expire < time.time():
-                _logger.debug("Lock timed-out(%s): %s" % (expire, lockString(lock)))
-                self.delete(token)
-                return None
-            return lock
-        finally:
-            self._lock.release()
+        if lock is None:
+            # Lock not found: purge dangling URL2TOKEN entries
+            _logger.debug("Lock purged dangling: %s" % token)
+            self.delete(token)
+            return None
+        expire = float(lock[b"expire"])
+        if expire >= 0 and expire < time.time():
+            _logger.debug("Lock timed-out(%s): %s" % (expire, lockString(lock)))
+            self.delete(token)
+            return None
+        return lock
 
     def create(self, path, lock):
         """Create a direct lock for a resource path.
@@ -162,38 +180,37 @@ class LockStorageDict(object):
         - lock['timeout'] may be normalized and shorter than requested
         - lock['token'] is added
         """
-        self._lock.acquireWrite()
-        try:
-            # We expect only a lock definition, not an existing lock
-            assert lock.get(b"token") is None
-            assert lock.get(b"expire") is None, "Use timeout instead of expire"
-            assert path and b"/" in path
-
-            # Normalize root: /foo/bar
-            org_path = path
-            path = normalizeLockRoot(path)
-            lock[b"root"] = path
-
-            # Normalize timeout from ttl to expire-date
-            timeout = float(lock.get(b"timeout"))
-            if timeout is None:
-                timeout = LockStorageDict.LOCK_TIME_OUT_DEFAULT
-            elif timeout < 0 or timeout > LockStorageDict.LOCK_TIME_OUT_MAX:
-                timeout = LockStorageDict.LOCK_TIME_OUT_MAX
+        # We expect only a lock definition, not an existing lock
+        assert lock.get(b"token") is None
+        assert lock.get(b"expire") is None, "Use timeout instead of expire"
+        assert path and b"/" in path
 
-            lock[b"timeout"] = timeout
-            lock[b"expire"] = time.time() + timeout
+        # Normalize root: /foo/bar
+        org_path = path
+        path = normalizeLockRoot(path)
+        lock[b"root"] = path
+
+        # Normalize timeout from ttl to expire-date
+        timeout = float(lock.get(b"timeout"))
+        if timeout is None:
+            timeout = LockStorageDict.LOCK_TIME_OUT_DEFAULT
+        elif timeout < 0 or timeout > LockStorageDict.LOCK_TIME_OUT_MAX:
+            timeout = LockStorageDict.LOCK_TIME_OUT_MAX
+
+        lock[b"timeout"] = timeout
+        lock[b"expire"] = time.time() + timeout
 
-            validateLock(lock)
+        validateLock(lock)
 
-            token = generateLockToken()
-            lock[b"token"] = token
+        token = generateLockToken()
+        lock[b"token"] = token
 
+        key = b"URL2TOKEN:%s" % path
+        with self._stripes.hold(token, key):
             # Store lock
             self._dict[token] = lock
 
             # Store locked path reference
-            key = b"URL2TOKEN:%s" % path
             if not key in self._dict:
                 self._dict[key] = [ token ]
             else:
@@ -202,11 +219,9 @@ class LockStorageDict(object):
                 tokList.append(token)
                 self._dict[key] = tokList
             self._flush()
-            _logger.debug("LockStorageDict.set(%r): %s" % (org_path, lockString(lock)))
-#            print("LockStorageDict.set(%r): %s" % (org_path, lockString(lock)))
-            return lock
-        finally:
-            self._lock.release()
+        _logger.debug("LockStorageDict.set(%r): %s" % (org_path, lockString(lock)))
+#        print("LockStorageDict.set(%r): %s" % (org_path, lockString(lock)))
+        return lock
 
     def refresh(self, token, timeout):
         """Modify an existing lock's timeout.
@@ -225,16 +240,13 @@ class LockStorageDict(object):
         if timeout < 0 or timeout > LockStorageDict.LOCK_TIME_OUT_MAX:
             timeout = LockStorageDict.LOCK_TIME_OUT_MAX
 
-        self._lock.acquireWrite()
-        try:
+        with self._stripes.hold(token):
             # Note: shelve dictionary returns copies, so we must reassign values:
             lock = self._dict[token]
             lock[b"timeout"] = timeout
             lock[b"expire"] = time.time() + timeout
             self._dict[token] = lock
             self._flush()
-        finally:
-            self._lock.release()
         return lock
 
     def delete(self, token):
@@ -242,14 +254,18 @@ class LockStorageDict(object):
 
         Returns True on success. False, if token does not exist, or is expired.
         """
-        self._lock.acquireWrite()
-        try:
+        with self._stripes.hold(token):
             lock = self._dict.get(token)
-            _logger.debug("delete %s" % lockString(lock))
-            if lock is None:
+        _logger.debug("delete %s" % lockString(lock))
+        if lock is None:
+            return False
+        # The root of a lock never changes, so we can lock its stripe now
+        key = b"URL2TOKEN:%s" % lock.get(b"root")
+        with self._stripes.hold(token, key):
+            if token not in self._dict:
+                # Deleted by another thread
                 return False
             # Remove url to lock mapping
-            key = b"URL2TOKEN:%s" % lock.get(b"root")
             if key in self._dict:
 #                _logger.debug("    delete token %s from url %s" % (token, lock.get("root")))
                 tokList = self._dict[key]
@@ -263,8 +279,6 @@ class LockStorageDict(object):
             del self._dict[token]
 
             self._flush()
-        finally:
-            self._lock.release()
         return True
 
     def getLockList(self, path, includeRoot, includeChildren, tokenOnly):
@@ -300,48 +314,82 @@ class LockStorageDict(object):
                         lockList.append(lock)
 
         path = normalizeLockRoot(path)
-        self._lock.acquireRead()
-        try:
+        key = b"URL2TOKEN:%s" % path
+        lockList = []
+        # Copy the token lists, self.get() must be called without a stripe
+        if includeRoot:
+            with self._stripes.hold(key):
+                tokList = list(self._dict.get(key, []))
+            __appendLocks(tokList)
+
+        if includeChildren:
+            with self._stripes.holdAll():
+                childToks = [list(ltoks) for u, ltoks in self._dict.items()
+                             if util.isChildUri(key, u)]
+            for ltoks in childToks:
+                __appendLocks(ltoks)
+
+        return lockList
+
+    def getLocksForPaths(self, paths):
+        """Return a dictionary of direct locks for a list of paths.
+
+        This is the bulk variant of getLockList(path, includeRoot=True,
+        includeChildren=False, tokenOnly=False): the storage is only locked 
+        once and an empty storage is detected without looking at the paths.
+
+        paths:
+            List of normalized paths (utf8 encoded string, no trailing '/')
+        Returns:
+            Dictionary {path: [lockDict, ...]}, that only contains entries for 
+            paths with at least one valid lock (may be empty).
+        """
+        lockMap = {}
+        if self._isEmpty():
+            return lockMap
+        for path in paths:
             key = b"URL2TOKEN:%s" % path
-            tokList = self._dict.get(key, [])
+            with self._stripes.hold(key):
+                tokList = self._dict.get(key)
+                if not tokList:
+                    continue
+                tokList = list(tokList)
             lockList = []
-            if includeRoot:
-                __appendLocks(tokList)
-
-            if includeChildren:
-                for u, ltoks in self._dict.items():
-                    if util.isChildUri(key, u):
-                        __appendLocks(ltoks)
-
-            return lockList
-        finally:
-            self._lock.release()
+            for token in tokList:
+                # self.get() purges expired locks
+                lock = self.get(token)
+                if lock:
+                    lockList.append(lock)
+            if lockList:
+                lockMap[path] = lockList
+        return lockMap
 
 
 class LockStorageShelve(LockStorageDict):
     """
     A low performance lock manager implementation using shelve.
+
+    A shelve is not thread-safe, so there is only one stripe (a global lock).
     """
     def __init__(self, storagePath):
-        super(LockStorageShelve, self).__init__()
+        super(LockStorageShelve, self).__init__(stripes=1)
         self._storagePath = os.path.abspath(storagePath)
 
     def __repr__(self):
         return "LockStorageShelve(%r)" % self._storagePath
 
     def _flush(self):
-        """Write persistent dictionary to disc."""
+        """Write persistent dictionary to disc (called with the stripe held)."""
         _logger.debug("_flush()")
-        self._lock.acquireWrite() # TODO: read access is enough?
-        try:
-            self._dict.sync()
-        finally:
-            self._lock.release()
+        self._dict.sync()
+
+    def _isEmpty(self):
+        with self._stripes.holdAll():
+            return not self._dict
 
     def clear(self):
         """Delete all entries."""
-        self._lock.acquireWrite() # TODO: read access is enough?
-        try:
+        with self._stripes.holdAll():
             was_closed = self._dict is None
             if was_closed:
                 self.open()
@@ -349,9 +397,8 @@ class LockStorageShelve(LockStorageDict):
                 self._dict.clear()
                 self._dict.sync()
             if was_closed:
-                self.close()
-        finally:
-            self._lock.release()
+                self._dict.close()
+                self._dict = None
     
     def open(self):
         _logger.debug("open(%r)" % self._storagePath)
@@ -364,10 +411,252 @@ class LockStorageShelve(LockStorageDict):
 
     def close(self):
         _logger.debug("close()")
-        self._lock.acquireWrite()
-        try:
+        with self._stripes.holdAll():
             if self._dict is not None:
                 self._dict.close()
                 self._dict = None
-        finally:
-            self._lock.release()
\ No newline at end of file
+
+class LockStorageSqlite(object):
+    """
+    A lock manager storage implementation using an SQLite database.
+
+    Unlike LockStorageDict, the locks are visible to all processes that open
+    the same database file, so this storage can be used when several server
+    processes serve the same shares (see run_server's 'workers' option).
+
+    Every thread (and every forked process) uses its own connection.
+    exclusive() makes a sequence of calls atomic across processes; it is used
+    by LockManager.acquire() to check for conflicts and create the new lock
+    in one transaction.
+
+    The lock fields are stored in plain columns. The database file is
+    created readable by the current user only, and an existing file is not
+    opened unless the current user owns it.
+    """
+    LOCK_TIME_OUT_DEFAULT = 604800 # 1 week, in seconds
+    LOCK_TIME_OUT_MAX = 4 * 604800 # 1 month, in seconds
+
+    # Columns of the locks table (= keys of a lock dictionary)
+    COLUMNS = (b"token", b"root", b"expire", b"type", b"scope", b"depth",
+               b"owner", b"timeout", b"principal")
+    _SELECT = "SELECT %s FROM locks " % ", ".join(COLUMNS)
+
+    # Page through long path lists (SQLite limits the number of parameters)
+    MAX_QUERY_PATHS = 500
+
+    def __init__(self, storagePath, timeout=30):
+        self._storagePath = os.path.abspath(storagePath)
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def __repr__(self):
+        return "LockStorageSqlite(%r)" % self._storagePath
+
+    def _checkFile(self):
+        """Create the database file or make sure the current user owns it."""
+        try:
+            fd = os.open(self._storagePath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            os.close(fd)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        if os.stat(self._storagePath).st_uid != os.getuid():
+            raise RuntimeError("Lock storage %s is not owned by the current user"
+                               % self._storagePath)
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, b"pid", None) != os.getpid():
+            # New thread, or a connection inherited from the parent process
+            self._checkFile()
+            conn = sqlite3.connect(self._storagePath, timeout=self._timeout,
+                                   isolation_level=None)
+            conn.text_factory = str
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def _execute(self, sql, args=()):
+        return self._connection().execute(sql, args)
+
+    def open(self):
+        """Called before first use: create the database, if necessary."""
+        _logger.debug("open(%r)" % self._storagePath)
+        columns = [row[1] for row in self._execute("PRAGMA table_info(locks)")]
+        if b"data" in columns:
+            # Pickled locks of an older version: never load them
+            _logger.warning("Discarding locks of an old format in %s" % self._storagePath)
+            self._execute("DROP TABLE locks")
+        self._execute("CREATE TABLE IF NOT EXISTS locks ("
+                      "token TEXT PRIMARY KEY, root TEXT NOT NULL, "
+                      "expire REAL NOT NULL, type TEXT NOT NULL, "
+                      "scope TEXT NOT NULL, depth TEXT NOT NULL, "
+                      "owner TEXT NOT NULL, timeout REAL NOT NULL, "
+                      "principal TEXT NOT NULL)")
+        self._execute("CREATE INDEX IF NOT EXISTS locks_root ON locks (root)")
+
+    def close(self):
+        """Called on shutdown: close the connection of the current thread."""
+        conn = getattr(self._local, b"conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local = threading.local()
+
+    def cleanup(self):
+        """Purge expired locks."""
+        self._execute("DELETE FROM locks WHERE expire >= 0 AND expire < ?",
+                      (time.time(), ))
+
+    def clear(self):
+        """Delete all entries."""
+        self._execute("DELETE FROM locks")
+
+    def countLocks(self):
+        """Return the number of stored locks (including expired ones)."""
+        return self._execute("SELECT COUNT(*) FROM locks").fetchone()[0]
+
+    @contextmanager
+    def exclusive(self):
+        """Run the enclosed storage calls as one transaction.
+
+        Other processes (and threads) are blocked from writing until the 
+        transaction is committed.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _loadLocks(self, rows):
+        """Return a list of unexpired lock dicts, purging expired ones."""
+        lockList = []
+        now = time.time()
+        for row in rows:
+            lock = dict(zip(self.COLUMNS, row))
+            expire = lock[b"expire"]
+            if expire >= 0 and expire < now:
+                _logger.debug("Lock timed-out(%s): %s" % (expire, lock[b"token"]))
+                self.delete(lock[b"token"])
+                continue
+            lockList.append(lock)
+        return lockList
+
+    def get(self, token):
+        """Return a lock dictionary for a token.
+
+        If the lock does not exist or is expired, None is returned.
+        Side effect: if lock is expired, it will be purged.
+        """
+        rows = self._execute(self._SELECT + "WHERE token = ?", (token, )).fetchall()
+        lockList = self._loadLocks(rows)
+        if not lockList:
+            return None
+        return lockList[0]
+
+    def _store(self, lock, insert):
+        if insert:
+            # Byte strings are stored as they are (paths need not be UTF-8)
+            values = [lock[name] for name in self.COLUMNS]
+            self._execute("INSERT INTO locks (%s) VALUES (%s)"
+                          % (", ".join(self.COLUMNS), ", ".join("?" * len(values))),
+                          values)
+        else:
+            self._execute("UPDATE locks SET expire = ?, timeout = ? "
+                          "WHERE token = ?",
+                          (lock[b"expire"], lock[b"timeout"], lock[b"token"]))
+
+    def create(self, path, lock):
+        """Create a direct lock for a resource path.
+
+        See LockStorageDict.create()
+        """
+        # We expect only a lock definition, not an existing lock
+        assert lock.get(b"token") is None
+        assert lock.get(b"expire") is None, "Use timeout instead of expire"
+        assert path and b"/" in path
+
+        # Normalize root: /foo/bar
+        path = normalizeLockRoot(path)
+        lock[b"root"] = path
+
+        # Normalize timeout from ttl to expire-date
+        timeout = float(lock.get(b"timeout"))
+        if timeout is None:
+            timeout = LockStorageSqlite.LOCK_TIME_OUT_DEFAULT
+        elif timeout < 0 or timeout > LockStorageSqlite.LOCK_TIME_OUT_MAX:
+            timeout = LockStorageSqlite.LOCK_TIME_OUT_MAX
+
+        lock[b"timeout"] = timeout
+        lock[b"expire"] = time.time() + timeout
+
+        validateLock(lock)
+
+        lock[b"token"] = generateLockToken()
+        self._store(lock, insert=True)
+        _logger.debug(b"LockStorageSqlite.set(%r): %s" % (path, lockString(lock)))
+        return lock
+
+    def refresh(self, token, timeout):
+        """Modify an existing lock's timeout.
+
+        See LockStorageDict.refresh()
+        """
+        assert timeout == -1 or timeout > 0
+        if timeout < 0 or timeout > LockStorageSqlite.LOCK_TIME_OUT_MAX:
+            timeout = LockStorageSqlite.LOCK_TIME_OUT_MAX
+        lock = self.get(token)
+        if lock is None:
+            raise ValueError("Lock must exist: %s" % token)
+        lock[b"timeout"] = timeout
+        lock[b"expire"] = time.time() + timeout
+        self._store(lock, insert=False)
+        return lock
+
+    def delete(self, token):
+        """Delete lock.
+
+        Returns True on success. False, if token does not exist.
+        """
+        cursor = self._execute("DELETE FROM locks WHERE token = ?", (token, ))
+        return cursor.rowcount > 0
+
+    def getLockList(self, path, includeRoot, includeChildren, tokenOnly):
+        """Return a list of direct locks for <path>.
+
+        See LockStorageDict.getLockList()
+        """
+        assert path and path.startswith(b"/")
+        assert includeRoot or includeChildren
+
+        path = normalizeLockRoot(path)
+        rows = []
+        if includeRoot:
+            rows.extend(self._execute(self._SELECT + "WHERE root = ?", (path, )))
+        if includeChildren:
+            # All roots starting with '<path>/' ('0' follows '/' in ASCII)
+            prefix = path.rstrip(b"/")
+            rows.extend(self._execute(self._SELECT + "WHERE root > ? AND root < ?",
+                                      (prefix + b"/", prefix + b"0")))
+        lockList = self._loadLocks(rows)
+        if tokenOnly:
+            return [lock[b"token"] for lock in lockList]
+        return lockList
+
+    def getLocksForPaths(self, paths):
+        """Return a dictionary of direct locks for a list of paths.
+
+        See LockStorageDict.getLocksForPaths()
+        """
+        lockMap = {}
+        for i in range(0, len(paths), self.MAX_QUERY_PATHS):
+            chunk = paths[i:i + self.MAX_QUERY_PATHS]
+            rows = self._execute(self._SELECT +
+                                 "WHERE root IN (%s)" % ", ".join("?" * len(chunk)),
+                                 chunk).fetchall()
+            for lock in self._loadLocks(rows):
+                lockMap.setdefault(lock[b"root"], []).append(lock)
+        return lockMap
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics registry with a text exposition format.
+
+WsgiDAVApp keeps a `MetricsRegistry` in ``app.metrics`` that counts requests
+and records latency histograms (by method, provider type, status and depth),
+bytes in and out, active requests and batch commit durations. Other values
+(locks, queue depths, access log, phase timings, ...) are read by callbacks
+when the metrics are rendered.
+
+If ``metrics.path`` is configured, the app answers GET requests on that path
+with the current values in the Prometheus text format::
+
+    # HELP wsgidav_requests_total Finished requests.
+    # TYPE wsgidav_requests_total counter
+    wsgidav_requests_total{method="PROPFIND",provider="ArchiveProvider",status="207",depth="1"} 42
+
+Counters are *lock-striped*: every thread is assigned one of a fixed number
+of stripes, each with its own lock and dictionary. Request threads rarely
+contend; the stripes are only summed up when the metrics are rendered.
+
+Caches count their hits and misses with `getCacheStats(name)`. These
+counters are process-wide and rendered by every registry as
+``wsgidav_cache_lookups_total{cache="name",result="hit"}``.
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://wsgidav.readthedocs.org/en/latest/develop.html
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import bisect
+import itertools
+import threading
+
+__docformat__ = "reStructuredText"
+
+DEFAULT_STRIPES = 16
+
+# Upper bounds of the latency buckets (seconds)
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+# Every thread uses one stripe, assigned round robin on first use.
+# (Thread idents are addresses of thread stacks, so 'ident % n' would put
+# most threads on the same stripe.)
+_local = threading.local()
+_nextStripe = itertools.count()
+
+
+def _stripeIndex():
+    try:
+        return _local.stripe
+    except AttributeError:
+        _local.stripe = next(_nextStripe)
+        return _local.stripe
+
+
+def _escape(value):
+    return (b"%s" % (value, )).replace(b"\\", b"\\\\").replace(
+        b'"', b'\\"').replace(b"\n", b"\\n")
+
+
+def _formatLabels(labelNames, labels, extra=None):
+    pairs = [b'%s="%s"' % (name, _escape(value))
+             for name, value in zip(labelNames, labels)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return b""
+    return b"{%s}" % b",".join(pairs)
+
+
+def _formatValue(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return b"+Inf"
+        return b"%r" % value
+    return b"%s" % value
+
+
+#===============================================================================
+# StripedCounter
+#===============================================================================
+class StripedCounter(object):
+    """Counters {labels: value} that are updated with little contention."""
+
+    def __init__(self, stripes=DEFAULT_STRIPES):
+        self._stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+
+    def add(self, labels=(), amount=1):
+        lock, values = self._stripes[_stripeIndex() % len(self._stripes)]
+        with lock:
+            values[labels] = values.get(labels, 0) + amount
+
+    def snapshot(self):
+        """Return {labels: value}, summed over all stripes."""
+        result = {}
+        for lock, values in self._stripes:
+            with lock:
+                items = values.items()
+            for labels, value in items:
+                result[labels] = result.get(labels, 0) + value
+        return result
+
+    def total(self):
+        return sum(self.snapshot().values())
+
+
+#===============================================================================
+# Histogram
+#===============================================================================
+class Histogram(object):
+    """Distribution of observed values {labels: bucket counts, sum}."""
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS, stripes=DEFAULT_STRIPES):
+        self.buckets = tuple(sorted(buckets))
+        self._stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        lock, values = self._stripes[_stripeIndex() % len(self._stripes)]
+        with lock:
+            entry = values.get(labels)
+            if entry is None:
+                # [count per bucket (the last one is +Inf), sum]
+                entry = values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def snapshot(self):
+        """Return {labels: (cumulative bucket counts, sum)}."""
+        merged = {}
+        for lock, values in self._stripes:
+            with lock:
+                items = [(labels, (list(e[0]), e[1])) for labels, e in values.items()]
+            for labels, (counts, total) in items:
+                m = merged.get(labels)
+                if m is None:
+                    merged[labels] = [counts, total]
+                else:
+                    m[0] = [a + b for a, b in zip(m[0], counts)]
+                    m[1] += total
+        result = {}
+        for labels, (counts, total) in merged.items():
+            result[labels] = (list(_accumulate(counts)), total)
+        return result
+
+
+def _accumulate(values):
+    total = 0
+    for value in values:
+        total += value
+        yield total
+
+
+#===============================================================================
+# Cache statistics
+#===============================================================================
+class CacheStats(object):
+    """Hits and misses of a cache."""
+
+    def __init__(self, name):
+        self.name = name
+        self._counter = StripedCounter()
+
+    def __repr__(self):
+        counts = self._counter.snapshot()
+        return "%s(%r, hits=%s, misses=%s)" % (
+            self.__class__.__name__, self.name, counts.get(b"hit", 0),
+            counts.get(b"miss", 0))
+
+    def hit(self):
+        self._counter.add(b"hit")
+
+    def miss(self):
+        self._counter.add(b"miss")
+
+    def snapshot(self):
+        """Return {'hit': n, 'miss': n}."""
+        counts = {b"hit": 0, b"miss": 0}
+        counts.update(self._counter.snapshot())
+        return counts
+
+
+_cacheStats = {}
+_cacheStatsLock = threading.Lock()
+
+
+def getCacheStats(name):
+    """Return the (process-wide) CacheStats for a cache name."""
+    stats = _cacheStats.get(name)
+    if stats is None:
+        with _cacheStatsLock:
+            stats = _cacheStats.setdefault(name, CacheStats(name))
+    return stats
+
+
+#===============================================================================
+# MetricsRegistry
+#===============================================================================
+class MetricsRegistry(object):
+    """Named counters, histograms and callbacks, rendered as text.
+
+    Usage::
+
+        requests = registry.counter("app_requests_total", "Requests.", ("method", ))
+        requests.add(("GET", ))
+        registry.callback("app_queue_depth", "Queued requests.",
+                          lambda: queue.qsize())
+        text = registry.render()
+    """
+
+    def __init__(self, stripes=DEFAULT_STRIPES):
+        self.stripes = stripes
+        # [(name, help, type, labelNames, source)] in order of registration
+        self._metrics = []
+        self._names = set()
+
+    def __repr__(self):
+        return "%s(%s metrics)" % (self.__class__.__name__, len(self._metrics))
+
+    def _register(self, name, helpText, kind, labelNames, source):
+        if name in self._names:
+            raise ValueError("Metric already registered: %r" % name)
+        self._names.add(name)
+        self._metrics.append((name, helpText, kind, tuple(labelNames), source))
+        return source
+
+    def counter(self, name, helpText, labelNames=()):
+        """Register and return a StripedCounter."""
+        return self._register(name, helpText, b"counter", labelNames,
+                              StripedCounter(self.stripes))
+
+    def gauge(self, name, helpText, labelNames=()):
+        """Register and return a StripedCounter for a value that goes up and down."""
+        return self._register(name, helpText, b"gauge", labelNames,
+                              StripedCounter(self.stripes))
+
+    def histogram(self, name, helpText, labelNames=(),
+                  buckets=DEFAULT_LATENCY_BUCKETS):
+        """Register and return a Histogram."""
+        return self._register(name, helpText, b"histogram", labelNames,
+                              Histogram(buckets, self.stripes))
+
+    def add(self, name, helpText, source, labelNames=(), kind=None):
+        """Register an existing StripedCounter or Histogram and return it.
+
+        `kind` defaults to 'histogram' or 'counter'.
+        """
+        if kind is None:
+            kind = b"histogram" if isinstance(source, Histogram) else b"counter"
+        return self._register(name, helpText, kind, labelNames, source)
+
+    def callback(self, name, helpText, func, labelNames=(), kind=b"gauge"):
+        """Register a function that returns the current value.
+
+        `func` returns a number, or {labels: number} if there are labelNames.
+        It returns None, if there is no value (the metric is skipped).
+        """
+        self._register(name, helpText, kind, labelNames, func)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, helpText, kind, labelNames, source in self._metrics:
+            lines.append(b"# HELP %s %s" % (name, helpText))
+            lines.append(b"# TYPE %s %s" % (name, kind))
+            if isinstance(source, Histogram):
+                bounds = [_formatValue(float(b)) for b in source.buckets] + [b"+Inf"]
+                for labels, (counts, total) in sorted(source.snapshot().items()):
+                    for bound, count in zip(bounds, counts):
+                        lines.append(b"%s_bucket%s %s" % (
+                            name, _formatLabels(labelNames, labels, b'le="%s"' % bound),
+                            count))
+                    labelText = _formatLabels(labelNames, labels)
+                    lines.append(b"%s_sum%s %s" % (name, labelText, _formatValue(total)))
+                    lines.append(b"%s_count%s %s" % (name, labelText, counts[-1]))
+                continue
+            if isinstance(source, StripedCounter):
+                values = source.snapshot()
+            else:
+                values = source()
+                if values is None:
+                    continue
+            if not labelNames:
+                if isinstance(values, dict):
+                    values = values.get((), 0)
+                lines.append(b"%s %s" % (name, _formatValue(values)))
+                continue
+            for labels, value in sorted(values.items()):
+                lines.append(b"%s%s %s" % (name, _formatLabels(labelNames, labels),
+                                           _formatValue(value)))
+
+        if _cacheStats:
+            name = b"wsgidav_cache_lookups_total"
+            lines.append(b"# HELP %s Cache lookups by result." % name)
+            lines.append(b"# TYPE %s counter" % name)
+            for cacheName, stats in sorted(_cacheStats.items()):
+                for result, count in sorted(stats.snapshot().items()):
+                    lines.append(b'%s{cache="%s",result="%s"} %s'
+                                 % (name, _escape(cacheName), result, count))
+        lines.append(b"")
+        text = b"\n".join(lines)
+        if isinstance(text, unicode):
+            text = text.encode("utf8")
+        return text
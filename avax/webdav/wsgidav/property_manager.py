@@ -25,7 +25,8 @@ import shelve
 import logging
 
 from ..wsgidav import util
-from .rw_lock import ReadWriteLock
+from .rw_lock import LockStripes, DEFAULT_LOCK_STRIPES
+from .timing import counted
 
 # TODO: comment's from Ian Bicking (2005)
 #@@: Use of shelve means this is only really useful in a threaded environment.
@@ -51,11 +52,14 @@ class PropertyManager(object):
     
     This is obviously not persistent, but should be enough in some cases.
     For a persistent implementation, see property_manager.ShelvePropertyManager().
+
+    The properties of every URL are guarded by its stripe of plain locks
+    (see rw_lock.LockStripes), so requests on different paths rarely contend.
     """
-    def __init__(self):
+    def __init__(self, stripes=DEFAULT_LOCK_STRIPES):
         self._dict = None
         self._loaded = False      
-        self._lock = ReadWriteLock()
+        self._stripes = LockStripes(stripes, b"property_manager")
         self._verbose = 2
 
     def __repr__(self):
@@ -68,24 +72,22 @@ class PropertyManager(object):
 
     def _lazyOpen(self):
         _logger.debug("_lazyOpen()")
-        self._lock.acquireWrite()
-        try:
+        with self._stripes.holdAll():
+            # Test again within the critical section
+            if self._loaded:
+                return
             self._dict = {}
             self._loaded = True
-        finally:
-            self._lock.release()         
 
     def _sync(self):
+        """Overloaded by Shelve implementation (called with the stripes held)."""
         pass
 
     def _close(self):
         _logger.debug("_close()")
-        self._lock.acquireWrite()
-        try:
+        with self._stripes.holdAll():
             self._dict = None
             self._loaded = False
-        finally:
-            self._lock.release()         
 
     def _check(self, msg=b""):
         try:
@@ -126,26 +128,24 @@ class PropertyManager(object):
         except Exception, e:
             util.warn("PropertyManager._dump()  ERROR: %s" % e)
 
+    @counted(b"property_manager")
     def getProperties(self, normurl):
         _logger.debug("getProperties(%s)" % normurl)
-        self._lock.acquireRead()
-        try:
-            if not self._loaded:
-                self._lazyOpen()        
+        if not self._loaded:
+            self._lazyOpen()        
+        with self._stripes.hold(normurl):
             returnlist = []
             if normurl in self._dict:
                 for propdata in self._dict[normurl].keys():
                     returnlist.append(propdata)
             return returnlist
-        finally:
-            self._lock.release()
 
+    @counted(b"property_manager")
     def getProperty(self, normurl, propname):
         _logger.debug("getProperty(%s, %s)" % (normurl, propname))
-        self._lock.acquireRead()
-        try:
-            if not self._loaded:
-                self._lazyOpen()
+        if not self._loaded:
+            self._lazyOpen()
+        with self._stripes.hold(normurl):
             if normurl not in self._dict:
                 return None
             # TODO: sometimes we get exceptions here: (catch or otherwise make more robust?)
@@ -155,9 +155,8 @@ class PropertyManager(object):
                 _logger.exception("getProperty(%s, %s) failed : %s" % (normurl, propname, e))
                 raise
             return resourceprops.get(propname)
-        finally:
-            self._lock.release()
 
+    @counted(b"property_manager")
     def writeProperty(self, normurl, propname, propertyvalue, dryRun=False):
 #        self._log("writeProperty(%s, %s, dryRun=%s):\n\t%s" % (normurl, propname, dryRun, propertyvalue))
         assert normurl and normurl.startswith("/")
@@ -168,10 +167,9 @@ class PropertyManager(object):
         if dryRun:
             return  # TODO: can we check anything here?
         
-        self._lock.acquireWrite()
-        try:
-            if not self._loaded:
-                self._lazyOpen()
+        if not self._loaded:
+            self._lazyOpen()
+        with self._stripes.hold(normurl):
             if normurl in self._dict:
                 locatordict = self._dict[normurl] 
             else:
@@ -182,9 +180,8 @@ class PropertyManager(object):
             self._sync()
             if __debug__ and self._verbose >= 2:
                 self._check()         
-        finally:
-            self._lock.release()
 
+    @counted(b"property_manager")
     def removeProperty(self, normurl, propname, dryRun=False):
         """
         Specifying the removal of a property that does not exist is NOT an error.
@@ -193,10 +190,9 @@ class PropertyManager(object):
         if dryRun:
             # TODO: can we check anything here?
             return  
-        self._lock.acquireWrite()
-        try:
-            if not self._loaded:
-                self._lazyOpen()
+        if not self._loaded:
+            self._lazyOpen()
+        with self._stripes.hold(normurl):
             if normurl in self._dict:      
                 locatordict = self._dict[normurl] 
                 if propname in locatordict:
@@ -206,45 +202,44 @@ class PropertyManager(object):
                     self._sync()
             if __debug__ and self._verbose >= 2:
                 self._check()         
-        finally:
-            self._lock.release()         
 
+    @counted(b"property_manager")
     def removeProperties(self, normurl):
         _logger.debug("removeProperties(%s)" % normurl)
-        self._lock.acquireWrite()
-        try:
-            if not self._loaded:
-                self._lazyOpen()
+        if not self._loaded:
+            self._lazyOpen()
+        with self._stripes.hold(normurl):
             if normurl in self._dict:      
                 del self._dict[normurl] 
                 self._sync()
-        finally:
-            self._lock.release()         
 
+    @counted(b"property_manager")
     def copyProperties(self, srcurl, desturl):
         _logger.debug("copyProperties(%s, %s)" % (srcurl, desturl))
-        self._lock.acquireWrite()
-        try:
+        if not self._loaded:
+            self._lazyOpen()
+        with self._stripes.hold(srcurl, desturl):
             if __debug__ and self._verbose >= 2:
                 self._check()         
-            if not self._loaded:
-                self._lazyOpen()
             if srcurl in self._dict:      
                 self._dict[desturl] = self._dict[srcurl].copy() 
                 self._sync()
             if __debug__ and self._verbose >= 2:
                 self._check("after copy")         
-        finally:
-            self._lock.release()         
 
+    @counted(b"property_manager")
     def moveProperties(self, srcurl, desturl, withChildren):
         _logger.debug("moveProperties(%s, %s, %s)" % (srcurl, desturl, withChildren))
-        self._lock.acquireWrite()
-        try:
+        if not self._loaded:
+            self._lazyOpen()
+        # The children may be in any stripe
+        if withChildren:
+            stripes = self._stripes.holdAll()
+        else:
+            stripes = self._stripes.hold(srcurl, desturl)
+        with stripes:
             if __debug__ and self._verbose >= 2:
                 self._check()         
-            if not self._loaded:
-                self._lazyOpen()
             if withChildren:
                 # Move srcurl\*      
                 for url in self._dict.keys():
@@ -260,8 +255,6 @@ class PropertyManager(object):
             self._sync()
             if __debug__ and self._verbose >= 2:
                 self._check("after move")         
-        finally:
-            self._lock.release()         
 
 
 #===============================================================================
@@ -271,18 +264,19 @@ class PropertyManager(object):
 class ShelvePropertyManager(PropertyManager):
     """
     A low performance property manager implementation using shelve
+
+    A shelve is not thread-safe, so there is only one stripe (a global lock).
     """
     def __init__(self, storagePath):
         self._storagePath = os.path.abspath(storagePath)
-        super(ShelvePropertyManager, self).__init__()
+        super(ShelvePropertyManager, self).__init__(stripes=1)
 
     def __repr__(self):
         return "ShelvePropertyManager(%s)" % self._storagePath
 
     def _lazyOpen(self):
         _logger.debug("_lazyOpen(%s)" % self._storagePath)
-        self._lock.acquireWrite()
-        try:
+        with self._stripes.holdAll():
             # Test again within the critical section
             if self._loaded:
                 return True
@@ -294,34 +288,24 @@ class ShelvePropertyManager(PropertyManager):
             if __debug__ and self._verbose >= 2:
                 self._check("After shelve.open()")
                 self._dump("After shelve.open()")
-        finally:
-            self._lock.release()         
 
     def _sync(self):
-        """Write persistent dictionary to disc."""
+        """Write persistent dictionary to disc (called with the stripe held)."""
         _logger.debug("_sync()")
-        self._lock.acquireWrite() # TODO: read access is enough?
-        try:
-            if self._loaded:
-                self._dict.sync()
-        finally:
-            self._lock.release()         
+        if self._loaded:
+            self._dict.sync()
 
     def _close(self):
         _logger.debug("_close()")
-        self._lock.acquireWrite()
-        try:
+        with self._stripes.holdAll():
             if self._loaded:
                 self._dict.close()
                 self._dict = None
                 self._loaded = False
-        finally:
-            self._lock.release()         
 
     def clear(self):
         """Delete all entries."""
-        self._lock.acquireWrite() 
-        try:
+        with self._stripes.holdAll():
             was_closed = self._dict is None
             if was_closed:
                 self.open()
@@ -330,5 +314,3 @@ class ShelvePropertyManager(PropertyManager):
                 self._dict.sync()
             if was_closed:
                 self.close()
-        finally:
-            self._lock.release()
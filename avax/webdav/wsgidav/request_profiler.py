@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+On-demand profiling of live requests.
+
+`RequestProfiler` runs cProfile around selected requests and adds the
+results to one aggregated profile. A request is profiled if
+
+- it carries the configured token in the ``X-WsgiDAV-Profile`` header or in
+  the ``wsgidav-profile`` query argument, or
+- it was picked by sampling (one of every `sampleRate` requests).
+
+At most `maxActive` requests are profiled at the same time; others are
+served normally.
+
+cProfile profiles only the thread that enabled it, so a profile must be
+stopped by the thread that started it. WsgiDAVApp stops it when the
+application has returned its response iterable; producing the response
+body while it is sent is not profiled.
+
+The aggregated profile is available as text report (top functions by
+cumulative time) from the report path, which also requires the token::
+
+    curl -H "X-WsgiDAV-Profile: <token>" "http://host/.wsgidav/profile?sort=cumulative&limit=40"
+
+Arguments: ``sort`` (any pstats sort key), ``limit`` (number of functions),
+``reset=1`` (start a new profile after the report) and ``format=pstats``
+(the raw profile, for ``python -m pstats``).
+If a `filePath` is configured, the profile is also written there (at most
+every `saveInterval` seconds) in the pstats format.
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://wsgidav.readthedocs.org/en/latest/develop.html
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import cProfile
+import hmac
+import itertools
+import marshal
+import os
+import pstats
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+from urlparse import parse_qs
+
+from . import util
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+PROFILE_HEADER = b"HTTP_X_WSGIDAV_PROFILE"
+PROFILE_QUERY_ARG = b"wsgidav-profile"
+
+
+#===============================================================================
+# RequestProfiler
+#===============================================================================
+class RequestProfiler(object):
+    """Profile selected requests and aggregate the results.
+
+    Usage::
+
+        profile = profiler.start(environ)  # None, if not selected
+        ... handle the request ...
+        if profile is not None:
+            profiler.stop(profile)
+    """
+
+    def __init__(self, token=None, sampleRate=0, maxActive=4, filePath=None,
+                 saveInterval=60):
+        if isinstance(token, unicode):
+            token = token.encode("utf8")
+        self.token = token
+        self.sampleRate = sampleRate
+        self.maxActive = maxActive
+        self.filePath = filePath
+        self.saveInterval = saveInterval
+        self.profiled = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._active = 0
+        self._counter = itertools.count(1)
+        self._stats = None
+        self._lastSave = 0
+
+    def __repr__(self):
+        return "%s(profiled=%s, sampleRate=%s, filePath=%r)" % (
+            self.__class__.__name__, self.profiled, self.sampleRate, self.filePath)
+
+    def isAuthorized(self, environ):
+        """Return True if the request carries the profiling token."""
+        if not self.token:
+            return False
+        value = environ.get(PROFILE_HEADER)
+        if value is None:
+            query = environ.get(b"QUERY_STRING")
+            if not query or PROFILE_QUERY_ARG not in query:
+                return False
+            value = parse_qs(query).get(PROFILE_QUERY_ARG, [b""])[0]
+        return hmac.compare_digest(value, self.token)
+
+    def isSelected(self, environ):
+        """Return True if the request should be profiled."""
+        if self.sampleRate and next(self._counter) % self.sampleRate == 0:
+            return True
+        return self.isAuthorized(environ)
+
+    def start(self, environ):
+        """Start profiling the current thread, if the request is selected.
+
+        Return the profile, or None.
+        """
+        if not self.isSelected(environ):
+            return None
+        with self._lock:
+            if self._active >= self.maxActive:
+                return None
+            self._active += 1
+        profile = cProfile.Profile()
+        profile.thread = threading.current_thread()
+        profile.enable()
+        return profile
+
+    def stop(self, profile):
+        """Stop a profile returned by start() and add it to the aggregate.
+
+        Must be called by the thread that called start().
+        """
+        if profile.thread is not threading.current_thread():
+            raise RuntimeError("Profile of %s stopped by %s"
+                               % (profile.thread.name, threading.current_thread().name))
+        profile.disable()
+        with self._lock:
+            self._active -= 1
+            try:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self.profiled += 1
+            except Exception:
+                _logger.exception("Could not add request profile")
+                return
+            if self.filePath and time.time() - self._lastSave >= self.saveInterval:
+                self._lastSave = time.time()
+                self._save()
+
+    def _save(self):
+        """Write the aggregated profile to self.filePath (atomically)."""
+        try:
+            folder = os.path.dirname(os.path.abspath(self.filePath))
+            fd, tmpPath = tempfile.mkstemp(dir=folder, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._dumps())
+            os.rename(tmpPath, self.filePath)
+        except (IOError, OSError):
+            _logger.exception("Could not write profile to %s" % self.filePath)
+
+    def _dumps(self):
+        # Same format as pstats.Stats.dump_stats()
+        return marshal.dumps(self._stats.stats)
+
+    def reset(self):
+        """Discard the aggregated profile."""
+        with self._lock:
+            self._stats = None
+            self.profiled = 0
+            self.started = time.time()
+
+    def getReport(self, sort=b"cumulative", limit=40):
+        """Return the top `limit` functions of the aggregated profile as text."""
+        stream = StringIO()
+        with self._lock:
+            stream.write(b"%s profiled requests since %s\n\n"
+                         % (self.profiled, util.getRfc1123Time(self.started)))
+            if self._stats is None:
+                return stream.getvalue()
+            self._stats.stream = stream
+            try:
+                self._stats.sort_stats(sort).print_stats(limit)
+            finally:
+                self._stats.stream = None
+        return stream.getvalue()
+
+    def handleReportRequest(self, environ, start_response):
+        """WSGI application that serves the aggregated profile."""
+        if not self.isAuthorized(environ):
+            start_response(b"403 Forbidden", [(b"Content-Type", b"text/plain"),
+                                              (b"Content-Length", b"0")])
+            return [b""]
+        args = parse_qs(environ.get(b"QUERY_STRING", b""))
+        sort = args.get(b"sort", [b"cumulative"])[0]
+        try:
+            limit = int(args.get(b"limit", [40])[0])
+        except ValueError:
+            limit = 40
+        if args.get(b"format", [None])[0] == b"pstats":
+            with self._lock:
+                body = self._dumps() if self._stats is not None else marshal.dumps({})
+            contentType = b"application/octet-stream"
+        else:
+            try:
+                body = self.getReport(sort, limit)
+            except KeyError:
+                body = b"Invalid sort key: %r\n" % sort
+            contentType = b"text/plain; charset=utf-8"
+        if args.get(b"reset", [None])[0] == b"1":
+            self.reset()
+        start_response(b"200 OK", [(b"Content-Type", contentType),
+                                   (b"Content-Length", str(len(body))),
+                                   (b"Cache-Control", b"no-cache"),
+                                   ])
+        return [body]
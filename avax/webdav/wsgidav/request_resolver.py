@@ -147,8 +147,30 @@ __docformat__ = "reStructuredText"
 
 class RequestResolver(object):
 
+    # Max. number of cached RequestServer instances (see callFlat)
+    MAX_CACHED_SERVERS = 1024
+
     def __init__(self):
-        pass
+        self._servers = {}
+
+    def callFlat(self, environ, start_response):
+        """Same as __call__, but return the RequestServer's response iterable.
+
+        Used by the compiled pipeline: chunks are passed through, and the
+        (stateless) RequestServer instances are reused for every provider.
+        """
+        provider = environ[b"wsgidav.provider"]
+        if (provider is None
+            or (environ[b"REQUEST_METHOD"] == b"OPTIONS"
+                and environ[b"PATH_INFO"] in (b"/", b"*"))):
+            return self(environ, start_response)
+
+        server = self._servers.get(provider)
+        if server is None:
+            if len(self._servers) >= self.MAX_CACHED_SERVERS:
+                self._servers.clear()
+            server = self._servers[provider] = RequestServer(provider)
+        return server.callFlat(environ, start_response)
 
     def __call__(self, environ, start_response):
         path = environ[b"PATH_INFO"]
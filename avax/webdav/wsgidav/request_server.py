@@ -16,6 +16,8 @@ from ..wsgidav.dav_error import HTTP_OK, HTTP_LENGTH_REQUIRED
 from ..wsgidav import xml_tools
 
 from . import util
+from .timing import getTimer, timed
+from .metrics import getCacheStats
 
 try:
     from cStringIO import StringIO
@@ -44,6 +46,18 @@ _logger = util.getModuleLogger(__name__)
 # BLOCK_SIZE = 8192
 BLOCK_SIZE = 65536
 
+# Pre-digested PROPFIND request for an empty body (same as <allprop/>)
+_PROPFIND_ALLPROP = (b"allprop", ())
+
+# Cache of pre-digested PROPFIND requests: {body: (propFindMode, propNameList)}
+PROPFIND_CACHE_MAX_BODY = 4096
+PROPFIND_CACHE_MAX_ENTRIES = 256
+_propfindRequestCache = {}
+_propfindCacheStats = getCacheStats(b"propfind_request")
+
+# Methods that may walk a whole tree and are subject to admission control
+_TREE_METHODS = (b"PROPFIND", b"DELETE", b"COPY", b"MOVE")
+
 
 class RequestServer(object):
 
@@ -67,7 +81,8 @@ class RequestServer(object):
     def __del__(self):
         util.debug("RequestServer: __del__", module="sc")
 
-    def __call__(self, environ, start_response):
+    def _getHandler(self, environ):
+        """Normalize request headers and return the 'doMETHOD()' handler."""
         assert b"wsgidav.verbose" in environ
         # TODO: allow anonymous somehow: this should run, even if http_authenticator middleware is not installed
 #        assert "http_authenticator.username" in environ
@@ -83,15 +98,30 @@ class RequestServer(object):
         if environ.get(b"HTTP_OVERWRITE") is not None:
             environ[b"HTTP_OVERWRITE"] = environ[b"HTTP_OVERWRITE"].upper()
 
-        if b"HTTP_EXPECT" in environ:
-            pass
-        
         # Dispatch HTTP request methods to 'doMETHOD()' handlers
         method = None
         if requestmethod in self._possible_methods:
             method = getattr(self, b"do%s" % requestmethod, None)
         if not method:
             self._fail(HTTP_METHOD_NOT_ALLOWED)
+        return method
+
+    def callFlat(self, environ, start_response):
+        """Same as __call__, but return the handler's response iterable.
+
+        Used by the compiled pipeline (see WsgiDAVApp): chunks are not
+        re-yielded, and errors are raised when called, not when iterated.
+        """
+        if environ.get(b"wsgidav.debug_profile"):
+            return self(environ, start_response)
+        method = self._getHandler(environ)
+        if environ[b"REQUEST_METHOD"] in _TREE_METHODS:
+            return self._runAdmitted(method, environ, start_response)
+        return method(environ, start_response)
+
+    def __call__(self, environ, start_response):
+        method = self._getHandler(environ)
+        requestmethod = environ[b"REQUEST_METHOD"]
 
         if environ.get(b"wsgidav.debug_break"):
             pass  # Set a break point here
@@ -108,7 +138,10 @@ class RequestServer(object):
                 res.close()
             return
   
-        app_iter = method(environ, start_response)
+        if requestmethod in _TREE_METHODS:
+            app_iter = self._runAdmitted(method, environ, start_response)
+        else:
+            app_iter = method(environ, start_response)
         for v in app_iter:
             yield v
         if hasattr(app_iter, b"close"):
@@ -124,6 +157,32 @@ class RequestServer(object):
         util.log("Raising DAVError %s" % e.getUserInfo())
         raise e
 
+    def _runAdmitted(self, method, environ, start_response):
+        """Call a tree method handler, if admission control lets us.
+        
+        Heavy operations (see AdmissionController) may have to wait for a 
+        free slot, or are rejected with HTTP_SERVICE_UNAVAILABLE.
+        The handlers return a list, so the work is done when they return.
+        """
+        admission = environ.get(b"wsgidav.admission_control")
+        if (admission is None 
+            or environ.get(b"HTTP_DEPTH", b"infinity") != b"infinity"):
+            return method(environ, start_response)
+        res = self._davProvider.getResourceInst(environ[b"PATH_INFO"], environ)
+        if res is None:
+            return method(environ, start_response)
+        ticket = admission.admit(environ, res, b"infinity")
+        try:
+            return method(environ, start_response)
+        finally:
+            admission.release(ticket)
+
+    def _recordTreeSize(self, environ, res, count):
+        """Tell admission control how many resources a tree walk touched."""
+        admission = environ.get(b"wsgidav.admission_control")
+        if admission is not None and environ[b"HTTP_DEPTH"] == b"infinity":
+            admission.recordCost(res, count)
+
     def _sendResponse(self, environ, start_response, rootRes, successCode, errorList):
         """Send WSGI response (single or multistatus).
         
@@ -154,6 +213,7 @@ class RequestServer(object):
 
         return util.sendMultiStatusResponse(environ, start_response, multistatusEL)
 
+    @timed(b"locks", 3)
     def _checkWritePermission(self, res, depth, environ):
         """Raise DAVError(HTTP_LOCKED), if res is locked.
         
@@ -173,6 +233,7 @@ class RequestServer(object):
                                      environ[b"wsgidav.ifLockTokenList"],
                                      environ[b"wsgidav.username"])
 
+    @timed(b"locks", 2)
     def _evaluateIfHeaders(self, res, environ):
         """Apply HTTP headers on <path>, raising DAVError if conditions fail.
          
@@ -233,6 +294,64 @@ class RequestServer(object):
 
         return
     
+    def _parsePropfindRequest(self, environ):
+        """Return (propFindMode, propNameList) for the PROPFIND request body.
+        
+        Clients tend to send the same few request bodies over and over again,
+        so the results are cached by body (see _propfindRequestCache). 
+        Cached name lists are tuples, because they are shared.
+        """
+        requestbody = util.readRequestBody(environ)
+        if requestbody == b"":
+            # An empty PROPFIND request body MUST be treated as a request for 
+            # the names and values of all properties.
+            return _PROPFIND_ALLPROP
+
+        useCache = (len(requestbody) <= PROPFIND_CACHE_MAX_BODY 
+                    and not environ.get(b"wsgidav.dump_request_body"))
+        if useCache:
+            request = _propfindRequestCache.get(requestbody)
+            if request is not None:
+                _propfindCacheStats.hit()
+                return request
+            _propfindCacheStats.miss()
+
+        requestEL = util.parseXmlString(environ, requestbody)
+        if requestEL.tag != b"{DAV:}propfind":
+            self._fail(HTTP_BAD_REQUEST)   
+        
+        propNameList = []
+        propFindMode = None
+        for pfnode in requestEL:
+            if pfnode.tag == b"{DAV:}allprop":
+                if propFindMode: 
+                    # RFC: allprop and propname are mutually exclusive
+                    self._fail(HTTP_BAD_REQUEST)
+                propFindMode = b"allprop"
+            # TODO: implement <include> option
+#            elif pfnode.tag == "{DAV:}include":
+#                if not propFindMode in (None, "allprop"):
+#                    self._fail(HTTP_BAD_REQUEST, "<include> element is only valid with 'allprop'.")
+#                for pfpnode in pfnode:
+#                    propNameList.append(pfpnode.tag)       
+            elif pfnode.tag == b"{DAV:}propname":
+                if propFindMode: # RFC: allprop and propname are mutually exclusive
+                    self._fail(HTTP_BAD_REQUEST)
+                propFindMode = b"propname"
+            elif pfnode.tag == b"{DAV:}prop":
+                if propFindMode not in (None, b"named"): # RFC: allprop and propname are mutually exclusive
+                    self._fail(HTTP_BAD_REQUEST)
+                propFindMode = b"named"
+                for pfpnode in pfnode:
+                    propNameList.append(pfpnode.tag)       
+
+        request = (propFindMode, tuple(propNameList))
+        if useCache:
+            if len(_propfindRequestCache) >= PROPFIND_CACHE_MAX_ENTRIES:
+                _propfindRequestCache.clear()
+            _propfindRequestCache[requestbody] = request
+        return request
+
     def doPROPFIND(self, environ, start_response):
         """
         TODO: does not yet support If and If HTTP Conditions
@@ -267,68 +386,48 @@ class RequestServer(object):
         self._evaluateIfHeaders(res, environ)
 
         # Parse PROPFIND request
-        requestEL = util.parseXmlBody(environ, allowEmpty=True)
-        if requestEL is None:   
-            # An empty PROPFIND request body MUST be treated as a request for 
-            # the names and values of all properties.
-            requestEL = etree.XML(b"<D:propfind xmlns:D='DAV:'><D:allprop/></D:propfind>")
-
-        if requestEL.tag != b"{DAV:}propfind":
-            self._fail(HTTP_BAD_REQUEST)   
-        
-        propNameList = []
-        propFindMode = None
-        for pfnode in requestEL:
-            if pfnode.tag == b"{DAV:}allprop":
-                if propFindMode: 
-                    # RFC: allprop and propname are mutually exclusive
-                    self._fail(HTTP_BAD_REQUEST)
-                propFindMode = b"allprop"
-            # TODO: implement <include> option
-#            elif pfnode.tag == "{DAV:}include":
-#                if not propFindMode in (None, "allprop"):
-#                    self._fail(HTTP_BAD_REQUEST, "<include> element is only valid with 'allprop'.")
-#                for pfpnode in pfnode:
-#                    propNameList.append(pfpnode.tag)       
-            elif pfnode.tag == b"{DAV:}propname":
-                if propFindMode: # RFC: allprop and propname are mutually exclusive
-                    self._fail(HTTP_BAD_REQUEST)
-                propFindMode = b"propname"
-            elif pfnode.tag == b"{DAV:}prop":
-                if propFindMode not in (None, b"named"): # RFC: allprop and propname are mutually exclusive
-                    self._fail(HTTP_BAD_REQUEST)
-                propFindMode = b"named"
-                for pfpnode in pfnode:
-                    propNameList.append(pfpnode.tag)       
+        propFindMode, propNameList = self._parsePropfindRequest(environ)
+        propNameList = list(propNameList)
 
         # --- Build list of resource URIs 
         
         reslist = res.getDescendants(depth=environ[b"HTTP_DEPTH"],
                                      addSelf=True)
+        self._recordTreeSize(environ, res, len(reslist))
         if environ["wsgidav.verbose"] >= 3:
             pprint(reslist, indent=4)
         
-        multistatusEL = xml_tools.makeMultistatusEL()
-        responsedescription = []
+        # Resolve {DAV:}lockdiscovery for the whole response in one query 
+        lm = self._davProvider.lockManager
+        if lm and (propFindMode == b"allprop" 
+                   or b"{DAV:}lockdiscovery" in propNameList):
+            lockMap = lm.getLocksForUrls([child.getRefUrl() for child in reslist])
+            for child in reslist:
+                child.setLockList(lockMap.get(child.getRefUrl(), []))
+
+        # Standard live properties are serialized from byte templates, 
+        # everything else is built as element tree
+        writer = util.MultiStatusWriter()
+        timer = getTimer(environ)
         
         for child in reslist:
 
+            startTime = timer.start()
             if propFindMode == b"allprop":
                 propList = child.getProperties(b"allprop")
             elif propFindMode == b"propname":
                 propList = child.getProperties(b"propname")
             else:
                 propList = child.getProperties(b"named", nameList=propNameList)
+            timer.stop(b"props", startTime)
 
+            startTime = timer.start()
             href = child.getHref()
-            util.addPropertyResponse(multistatusEL, href, propList)
+            writer.addPropertyResponse(href, propList)
+            timer.stop(b"serialize", startTime)
 
-        if responsedescription:
-            el = etree.SubElement(multistatusEL, b"{DAV:}responsedescription")
-            el.text = b"\n".join(responsedescription)
-            
-        return util.sendMultiStatusResponse(environ,
-                                            start_response, multistatusEL)
+        return util.sendMultiStatusWriterResponse(environ, start_response, 
+                                                  writer)
 
     def doPROPPATCH(self, environ, start_response):
         """Handle PROPPATCH request to set or remove a property.
@@ -545,6 +644,7 @@ class RequestServer(object):
         reverseChildList = res.getDescendants(depthFirst=True, 
                                               depth=environ[b"HTTP_DEPTH"],
                                               addSelf=True)
+        self._recordTreeSize(environ, res, len(reverseChildList))
 
         if res.isCollection and res.supportRecursiveDelete():
             hasConflicts = False
@@ -872,6 +972,7 @@ class RequestServer(object):
         # --- Cleanup destination before copy/move ----------------------------- 
 
         srcList = srcRes.getDescendants(addSelf=True)
+        self._recordTreeSize(environ, srcRes, len(srcList))
 
         srcRootLen = len(srcPath)
         destRootLen = len(destPath)
@@ -10,15 +10,77 @@ See the class documentation for more info.
 
 Copyright (C) 2007, Heiko Wundram.
 Released under the BSD-license.
+
+LockStripes (WsgiDAV): a set of plain locks, selected by the hash of a key,
+for data that is guarded per key (e.g. per path). Threads working on
+different keys rarely contend, and a plain lock costs much less than the
+reentrant ReadWriteLock.
+
+Instrumentation (WsgiDAV): locks that were given a name report how long
+threads waited for them and held them, while a `LockInstrumentation` is
+enabled (see enableInstrumentation()). Locks with the same name are
+aggregated.
 """
 from __future__ import absolute_import, division, unicode_literals
 
 # Imports
 # -------
 
+import weakref
 from threading import Condition, Lock, currentThread
 from time import time
 
+from .metrics import Histogram, StripedCounter
+
+
+# Instrumentation
+# ---------------
+
+# Upper bounds of the wait and hold time buckets (seconds)
+LOCK_TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                     1.0, 5.0)
+
+# Default number of locks of LockStripes
+DEFAULT_LOCK_STRIPES = 16
+
+# All named locks (see getLockHolders)
+_namedLocks = weakref.WeakSet()
+# Receives the wait and hold times of named locks (None: disabled)
+_instrumentation = None
+
+
+class LockInstrumentation(object):
+    """Wait and hold times of named locks by (lock name, 'read' | 'write').
+
+    Every acquire call is a wait (nested ones return at once). A hold lasts
+    from the first acquire of a thread to its last release; it has the mode
+    of the first acquire (a read lock upgraded to write is a 'read' hold).
+    """
+
+    def __init__(self, buckets=LOCK_TIME_BUCKETS):
+        self.waits = Histogram(buckets)
+        self.holds = Histogram(buckets)
+        # Threads that are waiting (gauge) and timed out acquisitions
+        self.waiting = StripedCounter()
+        self.timeouts = StripedCounter()
+
+
+def enableInstrumentation(instrumentation):
+    """Send the times of all named locks to `instrumentation` (None: disable)."""
+    global _instrumentation
+    _instrumentation = instrumentation
+
+
+def getLockHolders():
+    """Return {(lock name, mode): threads holding a named lock}."""
+    holders = {}
+    for lock in list(_namedLocks):
+        readers, writers = lock.getHolders()
+        for mode, count in ((b"read", readers), (b"write", writers)):
+            key = (lock.name, mode)
+            holders[key] = holders.get(key, 0) + count
+    return holders
+
 
 # Read write lock
 # ---------------
@@ -49,8 +111,17 @@ class ReadWriteLock(object):
     acquireWrite() has been match by a corresponding release().
     """
 
-    def __init__(self):
-        """Initialize this read-write lock."""
+    def __init__(self, name=None):
+        """Initialize this read-write lock.
+
+        Named locks are instrumented (see enableInstrumentation())."""
+
+        self.name = name
+        # Threads holding the lock {thread: (time of first acquire, mode)},
+        # only while instrumentation is enabled
+        self._holdStart = {}
+        if name is not None:
+            _namedLocks.add(self)
 
         # Condition variable, used to signal waiters of a change in object
         # state.
@@ -64,6 +135,13 @@ class ReadWriteLock(object):
         # Initialize with no readers.
         self.__readers = {}
 
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.name)
+
+    def getHolders(self):
+        """Return the number of (reader, writer) threads (not synchronized)."""
+        return len(self.__readers), 0 if self.__writer is None else 1
+
     def acquireRead(self,timeout=None):
         """Acquire a read lock for the current thread, waiting at most
         timeout seconds or doing a non-blocking check in case timeout is <= 0.
@@ -71,6 +149,71 @@ class ReadWriteLock(object):
         In case timeout is None, the call to acquireRead blocks until the
         lock request can be serviced.
 
+        In case the timeout expires before the lock could be serviced, a
+        RuntimeError is thrown."""
+        instrumentation = _instrumentation
+        if instrumentation is None or self.name is None:
+            return self._acquireRead(timeout)
+        self._acquireInstrumented(self._acquireRead, b"read", timeout,
+                                  instrumentation)
+
+    def acquireWrite(self,timeout=None):
+        """Acquire a write lock for the current thread, waiting at most
+        timeout seconds or doing a non-blocking check in case timeout is <= 0.
+
+        In case the write lock cannot be serviced due to the deadlock
+        condition mentioned above, a ValueError is raised.
+
+        In case timeout is None, the call to acquireWrite blocks until the
+        lock request can be serviced.
+
+        In case the timeout expires before the lock could be serviced, a
+        RuntimeError is thrown."""
+        instrumentation = _instrumentation
+        if instrumentation is None or self.name is None:
+            return self._acquireWrite(timeout)
+        self._acquireInstrumented(self._acquireWrite, b"write", timeout,
+                                  instrumentation)
+
+    def release(self):
+        """Release the currently held lock.
+
+        In case the current thread holds no lock, a ValueError is thrown."""
+        self._release()
+        if self._holdStart:
+            me = currentThread()
+            if self.__writer is not me and me not in self.__readers:
+                entry = self._holdStart.pop(me, None)
+                instrumentation = _instrumentation
+                if entry is not None and instrumentation is not None:
+                    instrumentation.holds.observe((self.name, entry[1]),
+                                                  time() - entry[0])
+
+    def _acquireInstrumented(self, acquire, mode, timeout, instrumentation):
+        """Call acquire(timeout) and record the wait time."""
+        key = (self.name, mode)
+        instrumentation.waiting.add(key)
+        startTime = time()
+        try:
+            acquire(timeout)
+        except RuntimeError:
+            instrumentation.timeouts.add(key)
+            raise
+        finally:
+            instrumentation.waiting.add(key, -1)
+        now = time()
+        instrumentation.waits.observe(key, now - startTime)
+        me = currentThread()
+        if me not in self._holdStart:
+            self._holdStart[me] = (now, mode)
+
+    def _acquireRead(self,timeout=None):
+        """Acquire a read lock for the current thread, waiting at most
+        timeout seconds or doing a non-blocking check in case timeout is <= 0.
+
+        In case timeout is None, the call to acquireRead blocks until the
+        lock request can be serviced.
+
         In case the timeout expires before the lock could be serviced, a
         RuntimeError is thrown."""
 
@@ -111,7 +254,7 @@ class ReadWriteLock(object):
         finally:
             self.__condition.release()
 
-    def acquireWrite(self,timeout=None):
+    def _acquireWrite(self,timeout=None):
         """Acquire a write lock for the current thread, waiting at most
         timeout seconds or doing a non-blocking check in case timeout is <= 0.
 
@@ -198,7 +341,7 @@ class ReadWriteLock(object):
         finally:
             self.__condition.release()
 
-    def release(self):
+    def _release(self):
         """Release the currently held lock.
 
         In case the current thread holds no lock, a ValueError is thrown."""
@@ -228,3 +371,117 @@ class ReadWriteLock(object):
                 raise ValueError("Trying to release unheld lock")
         finally:
             self.__condition.release()
+
+
+# LockStripes
+# -----------
+
+class LockStripes(object):
+    """Fixed set of plain locks, selected by the hash of a key.
+
+    The locks are not reentrant: a thread that holds the stripe of a key
+    must not ask for the stripe of another key (which may be the same lock).
+    Use hold(key1, key2) instead, which acquires the stripes in a fixed
+    order, or holdAll().
+
+    Usage::
+
+        with stripes.hold(path):
+            ...
+        with stripes.hold(srcPath, destPath):
+            ...
+
+    Named stripes are instrumented like ReadWriteLocks (mode 'write').
+    """
+
+    def __init__(self, count=DEFAULT_LOCK_STRIPES, name=None):
+        self.name = name
+        self._locks = [Lock() for _ in range(max(1, count))]
+        if name is not None:
+            _namedLocks.add(self)
+
+    def __repr__(self):
+        return "%s(%s, %r)" % (self.__class__.__name__, len(self._locks), self.name)
+
+    def __len__(self):
+        return len(self._locks)
+
+    def getHolders(self):
+        """Return the number of (reader, writer) threads (not synchronized)."""
+        return 0, sum(1 for lock in self._locks if lock.locked())
+
+    def hold(self, key, *keys):
+        """Return a context manager that holds the stripes of the keys."""
+        locks = self._locks
+        if keys:
+            indexes = sorted(set(hash(k) % len(locks) for k in (key, ) + keys))
+            if len(indexes) > 1:
+                return _LockGroup([self._wrap(locks[i]) for i in indexes])
+            lock = locks[indexes[0]]
+        else:
+            lock = locks[hash(key) % len(locks)]
+        return self._wrap(lock)
+
+    def holdAll(self):
+        """Return a context manager that holds all stripes."""
+        if len(self._locks) == 1:
+            return self._wrap(self._locks[0])
+        return _LockGroup([self._wrap(lock) for lock in self._locks])
+
+    def _wrap(self, lock):
+        instrumentation = _instrumentation
+        if instrumentation is None or self.name is None:
+            return lock
+        return _InstrumentedLock(lock, self.name, instrumentation)
+
+
+class _LockGroup(object):
+    """Context manager that holds several locks (acquired in list order)."""
+
+    __slots__ = ("_locks", )
+
+    def __init__(self, locks):
+        self._locks = locks
+
+    def __enter__(self):
+        acquired = []
+        try:
+            for lock in self._locks:
+                lock.__enter__()
+                acquired.append(lock)
+        except BaseException:
+            for lock in reversed(acquired):
+                lock.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        for lock in reversed(self._locks):
+            lock.__exit__(None, None, None)
+        return False
+
+
+class _InstrumentedLock(object):
+    """Context manager that holds a plain lock and records the times."""
+
+    __slots__ = ("_lock", "_key", "_instrumentation", "_start")
+
+    def __init__(self, lock, name, instrumentation):
+        self._lock = lock
+        self._key = (name, b"write")
+        self._instrumentation = instrumentation
+
+    def __enter__(self):
+        instrumentation = self._instrumentation
+        instrumentation.waiting.add(self._key)
+        startTime = time()
+        self._lock.acquire()
+        self._start = time()
+        instrumentation.waiting.add(self._key, -1)
+        instrumentation.waits.observe(self._key, self._start - startTime)
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self._lock.release()
+        self._instrumentation.holds.observe(self._key, time() - self._start)
+        return False
@@ -66,13 +66,25 @@ number of requests and their responses, so we run a nested loop::
                             response.close()
                 if req.close_connection:
                     return
+                if nothing else is buffered:
+                    return True     # idle keep-alive connection
+        if idle keep-alive connection:
+            server.connections.put(conn)
+        else:
+            conn.close()
+
+Idle keep-alive connections are parked in a ConnectionManager, which polls
+their sockets from a single thread and puts each one back on the Queue once
+the client sends its next request. That way a handful of worker threads can
+serve many mostly idle persistent clients (e.g. mounted WebDAV drives).
 """
 
 __all__ = ['HTTPRequest', 'HTTPConnection', 'HTTPServer',
            'SizeCheckWrapper', 'KnownLengthRFile', 'ChunkedRFile',
            'CP_fileobject',
            'MaxSizeExceeded', 'NoSSLError', 'FatalSSLAlert',
-           'WorkerThread', 'ThreadPool', 'SSLAdapter',
+           'WorkerThread', 'ThreadPool', 'ThreadPoolAutoscaler',
+           'ConnectionManager', 'SSLAdapter',
            'CherryPyWSGIServer',
            'Gateway', 'WSGIGateway', 'WSGIGateway_10', 'WSGIGateway_u0',
            'WSGIPathInfoDispatcher', 'get_ssl_adapter_class']
@@ -84,6 +96,7 @@ except:
     import Queue as queue
 import re
 import rfc822
+import select
 import socket
 import sys
 if 'win' in sys.platform and not hasattr(socket, 'IPPROTO_IPV6'):
@@ -552,6 +565,14 @@ class HTTPRequest(object):
 
     This value is set automatically inside send_headers."""
 
+    lane = None
+    """The name of the worker lane (see HTTPServer.lanes) this request was
+    handed off to, or None for the default lane."""
+
+    resume = None
+    """A callable which continues the response in another lane, set by
+    hand_off() and cleared once the other lane has picked it up."""
+
     def __init__(self, server, conn):
         self.server= server
         self.conn = conn
@@ -568,6 +589,10 @@ class HTTPRequest(object):
         self.status = ""
         self.outheaders = []
         self.sent_headers = False
+        # Headers are sent together with the first write() or in finish_response()
+        self.header_buffer = None
+        # The CRLF ending the last chunk is sent with the next one
+        self.chunk_open = False
         self.close_connection = self.__class__.close_connection
         self.chunked_read = False
         self.chunked_write = self.__class__.chunked_write
@@ -829,12 +854,39 @@ class HTTPRequest(object):
             self.rfile = KnownLengthRFile(self.conn.rfile, cl)
 
         self.server.gateway(self).respond()
+        if self.resume is None:
+            self.finish_response()
 
+    def hand_off(self, lane, resume):
+        """Ask the calling Connection to continue this request in another lane.
+
+        The gateway must return right after calling this. A worker of the
+        given lane will then call resume() and finish the response.
+        """
+        self.lane = lane
+        self.resume = resume
+
+    def resume_response(self):
+        """Continue a response that was handed off to this worker's lane."""
+        resume, self.resume = self.resume, None
+        resume()
+        if self.resume is None:
+            self.finish_response()
+
+    def finish_response(self):
+        """Send the headers (if nothing was written) and the last chunk."""
         if (self.ready and not self.sent_headers):
             self.sent_headers = True
             self.send_headers()
+        parts = []
+        if self.header_buffer is not None:
+            parts.append(self.header_buffer)
+            self.header_buffer = None
         if self.chunked_write:
-            self.conn.wfile.sendall("0\r\n\r\n")
+            parts.append(self.chunk_open and "\r\n0\r\n\r\n" or "0\r\n\r\n")
+            self.chunk_open = False
+        if parts:
+            self.conn.wfile.sendall_parts(parts)
 
     def simple_response(self, status, msg=""):
         """Write a simple response back to the client."""
@@ -871,12 +923,19 @@ class HTTPRequest(object):
                 raise
 
     def write(self, chunk):
-        """Write unbuffered data to the client."""
+        """Write unbuffered data (and headers not sent yet) to the client."""
         if self.chunked_write and chunk:
-            buf = [hex(len(chunk))[2:], CRLF, chunk, CRLF]
-            self.conn.wfile.sendall(EMPTY.join(buf))
+            size = hex(len(chunk))[2:] + CRLF
+            if self.chunk_open:
+                size = CRLF + size
+            parts = [size, chunk]
+            self.chunk_open = True
         else:
-            self.conn.wfile.sendall(chunk)
+            parts = [chunk]
+        if self.header_buffer is not None:
+            parts.insert(0, self.header_buffer)
+            self.header_buffer = None
+        self.conn.wfile.sendall_parts(parts)
 
     def send_headers(self):
         """Assert, process, and send the HTTP response message-headers.
@@ -942,7 +1001,9 @@ class HTTPRequest(object):
         for k, v in self.outheaders:
             buf.append(k + COLON + SPACE + v + CRLF)
         buf.append(CRLF)
-        self.conn.wfile.sendall(EMPTY.join(buf))
+        # Not sent yet: write() and finish_response() send the headers
+        # together with the first body data, saving a syscall and a packet.
+        self.header_buffer = EMPTY.join(buf)
 
 
 class NoSSLError(Exception):
@@ -958,11 +1019,59 @@ class FatalSSLAlert(Exception):
 class CP_fileobject(socket._fileobject):
     """Faux file object attached to a socket object."""
 
+    coalesce_size = 64 * 1024
+    """sendall_parts() joins parts up to this total size into one send."""
+
+    use_cork = hasattr(socket, "TCP_CORK")
+    """Use TCP_CORK (Linux) to send larger parts as full segments."""
+
     def __init__(self, *args, **kwargs):
         self.bytes_read = 0
         self.bytes_written = 0
         socket._fileobject.__init__(self, *args, **kwargs)
 
+    def sendall_parts(self, parts):
+        """Send a list of strings with as few syscalls and packets as possible.
+
+        Small responses are joined and sent at once. For larger ones, small
+        parts are joined and large parts are sent as they are while the
+        socket is corked, so the kernel does not push a partial segment
+        between the headers and the body (Python 2 has no writev). Without
+        TCP_CORK, the parts are joined.
+        """
+        if len(parts) == 1:
+            self.sendall(parts[0])
+            return
+        if (not self.use_cork
+            or sum([len(p) for p in parts]) <= self.coalesce_size):
+            self.sendall(EMPTY.join(parts))
+            return
+        try:
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        except Exception:
+            # e.g. a pyOpenSSL connection
+            self.use_cork = False
+            self.sendall(EMPTY.join(parts))
+            return
+        try:
+            small = []
+            for p in parts:
+                if len(p) < self.coalesce_size:
+                    small.append(p)
+                    continue
+                if small:
+                    self.sendall(EMPTY.join(small))
+                    small = []
+                self.sendall(p)
+            if small:
+                self.sendall(EMPTY.join(small))
+        finally:
+            # Uncorking pushes out the last partial segment immediately
+            try:
+                self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+            except socket.error:
+                pass
+
     def sendall(self, data):
         """Sendall for non-blocking sockets."""
         while data:
@@ -978,6 +1087,13 @@ class CP_fileobject(socket._fileobject):
         self.bytes_written += bytes_sent
         return bytes_sent
 
+    def has_buffered_input(self):
+        """Return True if data was received but not yet consumed."""
+        if _fileobject_uses_str_type:
+            return bool(self._rbuf)
+        self._rbuf.seek(0, 2)
+        return self._rbuf.tell() > 0
+
     def flush(self):
         if self._wbuf:
             buffer = "".join(self._wbuf)
@@ -1269,6 +1385,7 @@ class HTTPConnection(object):
     rbufsize = DEFAULT_BUFFER_SIZE
     wbufsize = DEFAULT_BUFFER_SIZE
     RequestHandlerClass = HTTPRequest
+    handoff_request = None
 
     def __init__(self, server, sock, makefile=CP_fileobject):
         self.server = server
@@ -1276,9 +1393,30 @@ class HTTPConnection(object):
         self.rfile = makefile(sock, "rb", self.rbufsize)
         self.wfile = makefile(sock, "wb", self.wbufsize)
         self.requests_seen = 0
+        # Application data that lives as long as the connection (passed as
+        # environ['wsgiserver.connection_state'], e.g. a verified principal)
+        self.state = {}
+
+    def has_buffered_input(self):
+        """Return True if a pipelined request may already be buffered."""
+        has_buffered_input = getattr(self.rfile, 'has_buffered_input', None)
+        if has_buffered_input is None:
+            # Unknown file object: assume the worst, so we never park a
+            # connection whose next request is sitting in a buffer.
+            return True
+        return has_buffered_input()
 
     def communicate(self):
-        """Read each request and respond appropriately."""
+        """Read each request and respond appropriately.
+
+        Return True if the connection is still open and idle between
+        requests, so the caller can park it in the server's
+        ConnectionManager instead of blocking on the next request line.
+
+        Also return True if the current request was handed off to another
+        lane; in that case self.handoff_request is set, and the worker which
+        calls communicate() next resumes it.
+        """
         request_seen = False
         try:
             while True:
@@ -1286,22 +1424,36 @@ class HTTPConnection(object):
                 # the RequestHandlerClass constructor, the error doesn't
                 # get written to the previous request.
                 req = None
-                req = self.RequestHandlerClass(self.server, self)
+                if self.handoff_request is not None:
+                    req, self.handoff_request = self.handoff_request, None
+                    request_seen = True
+                    req.resume_response()
+                else:
+                    req = self.RequestHandlerClass(self.server, self)
 
-                # This order of operations should guarantee correct pipelining.
-                req.parse_request()
-                if self.server.stats['Enabled']:
-                    self.requests_seen += 1
-                if not req.ready:
-                    # Something went wrong in the parsing (and the server has
-                    # probably already made a simple_response). Return and
-                    # let the conn close.
-                    return
+                    # This order of operations should guarantee correct pipelining.
+                    req.parse_request()
+                    if self.server.stats['Enabled']:
+                        self.requests_seen += 1
+                    if not req.ready:
+                        # Something went wrong in the parsing (and the server has
+                        # probably already made a simple_response). Return and
+                        # let the conn close.
+                        return
 
-                request_seen = True
-                req.respond()
+                    request_seen = True
+                    req.respond()
+                if req.resume is not None:
+                    # Let a worker of another lane take over.
+                    self.handoff_request = req
+                    return True
                 if req.close_connection:
                     return
+                if (self.server.connections is not None
+                    and not self.has_buffered_input()):
+                    # Nothing pipelined behind this request; let the
+                    # connection manager wait for the next one.
+                    return True
         except socket.error:
             e = sys.exc_info()[1]
             errnum = e.args[0]
@@ -1409,10 +1561,19 @@ class WorkerThread(threading.Thread):
     """A simple flag for the calling server to know when this thread
     has begun polling the Queue."""
 
+    pool = None
+    """The ThreadPool this thread takes connections from (None means
+    server.requests)."""
+
+    lane = None
+    """The name of the pool's lane, or None for the default lane."""
 
-    def __init__(self, server):
+
+    def __init__(self, server, pool=None):
         self.ready = False
         self.server = server
+        self.pool = pool
+        self.lane = getattr(pool, 'lane', None)
 
         self.requests_seen = 0
         self.bytes_read = 0
@@ -1431,27 +1592,47 @@ class WorkerThread(threading.Thread):
 
     def run(self):
         self.server.stats['Worker Threads'][self.getName()] = self.stats
+        pool = self.pool
+        if pool is None:
+            pool = self.server.requests
         try:
             self.ready = True
             while True:
-                conn = self.server.requests.get()
+                conn = pool.get()
                 if conn is _SHUTDOWNREQUEST:
                     return
 
                 self.conn = conn
                 if self.server.stats['Enabled']:
                     self.start_time = time.time()
+                keep_alive = False
                 try:
-                    conn.communicate()
+                    keep_alive = conn.communicate()
                 finally:
-                    conn.close()
+                    if not keep_alive:
+                        conn.close()
                     if self.server.stats['Enabled']:
                         self.requests_seen += self.conn.requests_seen
                         self.bytes_read += self.conn.rfile.bytes_read
                         self.bytes_written += self.conn.wfile.bytes_written
                         self.work_time += time.time() - self.start_time
                         self.start_time = None
+                        if keep_alive:
+                            # The connection will come back to some worker;
+                            # don't count what we've seen so far twice.
+                            conn.requests_seen = 0
+                            conn.rfile.bytes_read = 0
+                            conn.wfile.bytes_written = 0
                     self.conn = None
+                if keep_alive and conn.handoff_request is not None:
+                    self.server.get_lane(conn.handoff_request.lane).put(conn)
+                elif keep_alive:
+                    connections = self.server.connections
+                    if connections is not None:
+                        connections.put(conn)
+                    else:
+                        # The server is shutting down.
+                        conn.close()
         except (KeyboardInterrupt, SystemExit):
             exc = sys.exc_info()[1]
             self.server.interrupt = exc
@@ -1462,20 +1643,38 @@ class ThreadPool(object):
 
     ThreadPool objects must provide min, get(), put(obj), start()
     and stop(timeout) attributes.
+
+    'lane' names the pool if it serves one of HTTPServer.lanes.
     """
 
-    def __init__(self, server, min=10, max=-1):
+    def __init__(self, server, min=10, max=-1, lane=None):
         self.server = server
         self.min = min
         self.max = max
+        self.lane = lane
         self._threads = []
         self._queue = queue.Queue()
-        self.get = self._queue.get
+        self._max_wait = 0
+
+    def get(self):
+        """Return the next queued connection, noting how long it waited."""
+        obj = self._queue.get()
+        queued_at = getattr(obj, 'queued_at', None)
+        if queued_at is not None:
+            wait = time.time() - queued_at
+            if wait > self._max_wait:
+                self._max_wait = wait
+        return obj
+
+    def pop_max_wait(self):
+        """Return the longest queue wait time (in seconds) since the last call."""
+        wait, self._max_wait = self._max_wait, 0
+        return wait
 
     def start(self):
         """Start the pool of threads."""
         for i in range(self.min):
-            self._threads.append(WorkerThread(self.server))
+            self._threads.append(WorkerThread(self.server, self))
         for worker in self._threads:
             worker.setName("CP Server " + worker.getName())
             worker.start()
@@ -1485,18 +1684,19 @@ class ThreadPool(object):
 
     def _get_idle(self):
         """Number of worker threads which are idle. Read-only."""
-        return len([t for t in self._threads if t.conn is None])
+        return len([t for t in self._threads if t.conn is None and t.isAlive()])
     idle = property(_get_idle, doc=_get_idle.__doc__)
 
     def put(self, obj):
+        if obj is not _SHUTDOWNREQUEST:
+            obj.queued_at = time.time()
         self._queue.put(obj)
-        if obj is _SHUTDOWNREQUEST:
-            return
 
     def grow(self, amount):
         """Spawn new worker threads (not above self.max)."""
         if self.max > 0:
-            budget = max(self.max - len(self._threads), 0)
+            alive = len([t for t in self._threads if t.isAlive()])
+            budget = max(self.max - alive, 0)
         else:
             # self.max <= 0 indicates no maximum
             budget = float('inf')
@@ -1509,7 +1709,7 @@ class ThreadPool(object):
         self._threads.extend(workers)
 
     def _spawn_worker(self):
-        worker = WorkerThread(self.server)
+        worker = WorkerThread(self.server, self)
         worker.setName("CP Server " + worker.getName())
         worker.start()
         return worker
@@ -1519,14 +1719,18 @@ class ThreadPool(object):
         return reduce(operator.and_, results, True)
     _all = staticmethod(_all)
 
+    def cull(self):
+        """Remove dead threads from our list; return their number."""
+        dead = [t for t in self._threads if not t.isAlive()]
+        for t in dead:
+            self._threads.remove(t)
+        return len(dead)
+
     def shrink(self, amount):
         """Kill off worker threads (not below self.min)."""
         # Grow/shrink the pool if necessary.
         # Remove any dead threads from our list
-        for t in self._threads:
-            if not t.isAlive():
-                self._threads.remove(t)
-                amount -= 1
+        amount -= self.cull()
 
         # calculate the number of threads above the minimum
         n_extra = max(len(self._threads) - self.min, 0)
@@ -1582,6 +1786,88 @@ class ThreadPool(object):
     qsize = property(_get_qsize)
 
 
+class ThreadPoolAutoscaler(object):
+    """Grow and shrink a ThreadPool with the load.
+
+    Every 'interval' seconds the pool is sampled. It is considered busy if
+    connections are queued while no worker is idle, or if a connection had
+    to wait longer than 'max_wait' seconds for a worker. It is considered
+    idle if the queue is empty and more than 'spare' workers are idle.
+
+    To avoid flapping, the pool only grows after 'grow_after' consecutive
+    busy samples and only shrinks after 'shrink_after' consecutive idle
+    samples. It never shrinks below pool.min nor grows above pool.max.
+    """
+
+    def __init__(self, pool, interval=1, max_wait=0.1, grow_after=2,
+                 shrink_after=30, spare=2):
+        self.pool = pool
+        self.interval = interval
+        self.max_wait = max_wait
+        self.grow_after = grow_after
+        self.shrink_after = shrink_after
+        self.spare = spare
+        self.busy_samples = 0
+        self.idle_samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling the pool."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="CP Server ThreadPoolAutoscaler")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Stop sampling the pool."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.isSet():
+            self._stopped.wait(self.interval)
+            if self._stopped.isSet():
+                return
+            try:
+                self.tick()
+            except Exception:
+                self.pool.server.error_log("Error in ThreadPoolAutoscaler.tick",
+                                           level=logging.ERROR, traceback=True)
+
+    def tick(self):
+        """Sample the pool once and resize it if necessary."""
+        pool = self.pool
+        # Dead threads (shut down by an earlier shrink) are neither idle
+        # nor part of the pool size
+        pool.cull()
+        qsize = pool.qsize
+        idle = pool.idle
+        wait = pool.pop_max_wait()
+
+        if (qsize and not idle) or wait > self.max_wait:
+            self.busy_samples += 1
+            self.idle_samples = 0
+        elif not qsize and idle > self.spare:
+            self.idle_samples += 1
+            self.busy_samples = 0
+        else:
+            self.busy_samples = self.idle_samples = 0
+
+        if self.busy_samples >= self.grow_after:
+            self.busy_samples = 0
+            # Absorb the current backlog in one step (or add a single
+            # thread if only the wait time tripped the switch).
+            pool.grow(max(qsize, 1))
+        elif self.idle_samples >= self.shrink_after:
+            self.idle_samples = 0
+            # Release half of the surplus at a time.
+            pool.shrink(max((idle - self.spare) // 2, 1))
+
+
 
 try:
     import fcntl
@@ -1605,6 +1891,219 @@ else:
         fcntl.fcntl(fd, fcntl.F_SETFD, old_flags | fcntl.FD_CLOEXEC)
 
 
+if hasattr(select, 'epoll'):
+    class _Poller(object):
+        """Report readable file descriptors, using epoll (Linux)."""
+
+        def __init__(self):
+            self._epoll = select.epoll()
+
+        def register(self, fd):
+            self._epoll.register(fd, select.EPOLLIN | select.EPOLLPRI)
+
+        def unregister(self, fd):
+            self._epoll.unregister(fd)
+
+        def poll(self, timeout):
+            return [fd for fd, event in self._epoll.poll(timeout)]
+
+        def close(self):
+            self._epoll.close()
+elif hasattr(select, 'poll'):
+    class _Poller(object):
+        """Report readable file descriptors, using poll (POSIX)."""
+
+        def __init__(self):
+            self._poll = select.poll()
+
+        def register(self, fd):
+            self._poll.register(fd, select.POLLIN | select.POLLPRI)
+
+        def unregister(self, fd):
+            self._poll.unregister(fd)
+
+        def poll(self, timeout):
+            return [fd for fd, event in self._poll.poll(timeout * 1000)]
+
+        def close(self):
+            pass
+else:
+    class _Poller(object):
+        """Report readable file descriptors, using select."""
+
+        def __init__(self):
+            self._fds = set()
+
+        def register(self, fd):
+            self._fds.add(fd)
+
+        def unregister(self, fd):
+            self._fds.discard(fd)
+
+        def poll(self, timeout):
+            rlist, wlist, xlist = select.select(list(self._fds), [], [], timeout)
+            return rlist
+
+        def close(self):
+            pass
+
+
+class ConnectionManager(object):
+    """Park idle keep-alive connections until their client speaks again.
+
+    Instead of blocking a WorkerThread in readline() until the next request
+    line arrives, HTTPConnection.communicate() returns between requests and
+    the connection is handed to put(). A single thread polls all parked
+    sockets and puts each connection back on the server's request Queue
+    as soon as it becomes readable (which includes the client hanging up).
+    Connections that stay idle for longer than 'timeout' seconds are closed.
+    """
+
+    sweep_interval = 1
+    """How often (in seconds) to look for expired connections."""
+
+    def __init__(self, server, timeout):
+        self.server = server
+        self.timeout = timeout
+        self.ready = False
+        self._lock = threading.Lock()
+        self._pending = []
+        self._parked = {}
+        self._poller = None
+        self._thread = None
+        self._wake_r = self._wake_w = None
+
+    def start(self):
+        """Start the polling thread."""
+        self._poller = _Poller()
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self._poller.register(self._wake_r)
+        self.ready = True
+        self._thread = threading.Thread(target=self._run,
+                                        name="CP Server ConnectionManager")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def put(self, conn):
+        """Park an idle connection (or close it if we are shutting down)."""
+        self._lock.acquire()
+        try:
+            parked = self.ready
+            if parked:
+                self._pending.append(conn)
+                self._wake()
+        finally:
+            self._lock.release()
+        if not parked:
+            conn.close()
+
+    def _get_parked(self):
+        """Number of connections currently parked. Read-only."""
+        return len(self._parked) + len(self._pending)
+    parked = property(_get_parked, doc=_get_parked.__doc__)
+
+    def _wake(self):
+        # Callers hold self._lock, so stop() cannot close the pipe under us.
+        try:
+            os.write(self._wake_w, "x")
+        except OSError:
+            # The pipe is full (EAGAIN), so the poller is awake anyway.
+            pass
+
+    def _run(self):
+        next_sweep = time.time() + self.sweep_interval
+        while self.ready:
+            try:
+                fds = self._poller.poll(self.sweep_interval)
+            except (select.error, IOError, OSError):
+                if sys.exc_info()[1].args[0] in socket_error_eintr:
+                    continue
+                self.server.error_log("Error in ConnectionManager.poll",
+                                      level=logging.ERROR, traceback=True)
+                break
+            for fd in fds:
+                if fd == self._wake_r:
+                    try:
+                        while os.read(self._wake_r, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                conn = self._parked.pop(fd, (None, None))[0]
+                if conn is not None:
+                    self._poller.unregister(fd)
+                    self.server.requests.put(conn)
+
+            now = time.time()
+            self._register_pending(now)
+            if now >= next_sweep:
+                self._expire(now)
+                next_sweep = now + self.sweep_interval
+        self._close_all()
+
+    def _register_pending(self, now):
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, []
+        finally:
+            self._lock.release()
+        deadline = now + self.timeout
+        for conn in pending:
+            try:
+                fd = conn.socket.fileno()
+                self._poller.register(fd)
+            except (socket.error, IOError, OSError, ValueError):
+                conn.close()
+                continue
+            self._parked[fd] = (conn, deadline)
+
+    def _expire(self, now):
+        expired = [fd for fd, (conn, deadline) in self._parked.items()
+                   if deadline <= now]
+        for fd in expired:
+            conn = self._parked.pop(fd)[0]
+            self._poller.unregister(fd)
+            conn.close()
+
+    def _close_all(self):
+        self._lock.acquire()
+        try:
+            self.ready = False
+            pending, self._pending = self._pending, []
+        finally:
+            self._lock.release()
+        for conn in pending + [c for c, deadline in self._parked.values()]:
+            conn.close()
+        self._parked.clear()
+        self._poller.close()
+
+    def stop(self, timeout=5):
+        """Stop polling and close all parked connections."""
+        self._lock.acquire()
+        try:
+            self.ready = False
+            if self._thread is not None:
+                self._wake()
+        finally:
+            self._lock.release()
+        if self._thread is None:
+            return
+        self._thread.join(timeout)
+        if not self._thread.isAlive():
+            self._lock.acquire()
+            try:
+                os.close(self._wake_r)
+                os.close(self._wake_w)
+            finally:
+                self._lock.release()
+        self._thread = None
+
+
 class SSLAdapter(object):
     """Base class for SSL driver library adapters.
 
@@ -1677,7 +2176,44 @@ class HTTPServer(object):
     """The maximum size, in bytes, for request bodies, or 0 for no limit."""
 
     nodelay = True
-    """If True (the default since 3.1), sets the TCP_NODELAY socket option."""
+    """If True (the default since 3.1), sets the TCP_NODELAY socket option.
+
+    Responses are written with as few sends as possible (headers together
+    with the body, see CP_fileobject.sendall_parts), so Nagle's algorithm
+    would only delay the last segment."""
+
+    reuse_port = False
+    """If True, sets the SO_REUSEPORT socket option, so several processes
+    can listen on the same port and the kernel balances connections among
+    them (Linux 3.9+, BSD)."""
+
+    park_connections = True
+    """If True (the default), idle keep-alive connections wait for their next
+    request in a ConnectionManager instead of occupying a worker thread.
+    Only used for plain (non-SSL) sockets on POSIX platforms."""
+
+    keep_alive_timeout = None
+    """The time in seconds a parked connection may stay idle before it is
+    closed (default None = use 'timeout')."""
+
+    connections = None
+    """The ConnectionManager holding idle keep-alive connections, or None."""
+
+    lanes = None
+    """An optional dict of additional ThreadPools, keyed by lane name.
+
+    Each request first runs in the default pool (self.requests). If
+    lane_classifier() picks another lane, the connection is handed to that
+    lane's pool before the application is called, so e.g. long transfers
+    cannot occupy every worker that quick requests depend on."""
+
+    lane_classifier = None
+    """A callable taking the WSGI environ and returning the name of the lane
+    which should serve the request (None for the default lane)."""
+
+    autoscaler = None
+    """An optional ThreadPoolAutoscaler (or any object with start() and
+    stop(timeout) methods), started together with the worker threads."""
 
     ConnectionClass = HTTPConnection
     """The class to use for handling HTTP connections."""
@@ -1711,6 +2247,7 @@ class HTTPServer(object):
             'Queue': lambda s: getattr(self.requests, "qsize", None),
             'Threads': lambda s: len(getattr(self.requests, "_threads", [])),
             'Threads Idle': lambda s: getattr(self.requests, "idle", None),
+            'Connections Parked': lambda s: getattr(self.connections, "parked", None),
             'Socket Errors': 0,
             'Requests': lambda s: (not s['Enabled']) and -1 or sum([w['Requests'](w) for w
                                        in s['Worker Threads'].values()], 0),
@@ -1849,6 +2386,21 @@ class HTTPServer(object):
 
         # Create worker threads
         self.requests.start()
+        for pool in (self.lanes or {}).values():
+            pool.start()
+
+        # Park idle keep-alive connections instead of pinning workers.
+        # SSL sockets may hold decrypted data the poller cannot see.
+        if (self.park_connections and self.ssl_adapter is None
+            and os.name == 'posix'):
+            keep_alive_timeout = self.keep_alive_timeout
+            if keep_alive_timeout is None:
+                keep_alive_timeout = self.timeout
+            self.connections = ConnectionManager(self, keep_alive_timeout)
+            self.connections.start()
+
+        if self.autoscaler is not None:
+            self.autoscaler.start()
 
         self.ready = True
         self._start_time = time.time()
@@ -1882,6 +2434,12 @@ class HTTPServer(object):
         self.socket = socket.socket(family, type, proto)
         prevent_socket_inheritance(self.socket)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Python 2 doesn't define the constant; 15 is its value on Linux
+            reuseport = getattr(socket, 'SO_REUSEPORT', None)
+            if reuseport is None and sys.platform.startswith('linux'):
+                reuseport = 15
+            self.socket.setsockopt(socket.SOL_SOCKET, reuseport, 1)
         if self.nodelay and not isinstance(self.bind_addr, str):
             self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
@@ -2039,7 +2597,20 @@ class HTTPServer(object):
                 sock.close()
             self.socket = None
 
+        if self.autoscaler is not None:
+            self.autoscaler.stop(self.shutdown_timeout)
+        if self.connections is not None:
+            self.connections.stop(self.shutdown_timeout)
+            self.connections = None
         self.requests.stop(self.shutdown_timeout)
+        for pool in (self.lanes or {}).values():
+            pool.stop(self.shutdown_timeout)
+
+    def get_lane(self, lane):
+        """Return the ThreadPool serving the given lane."""
+        if lane is None or not self.lanes:
+            return self.requests
+        return self.lanes.get(lane, self.requests)
 
 
 class Gateway(object):
@@ -2131,7 +2702,19 @@ class WSGIGateway(Gateway):
         raise NotImplemented
 
     def respond(self):
-        """Process the current request."""
+        """Process the current request (possibly in another lane)."""
+        server = self.req.server
+        if server.lanes and server.lane_classifier is not None:
+            lane = server.lane_classifier(self.env)
+            if lane not in server.lanes:
+                lane = None
+            if lane != getattr(threading.currentThread(), 'lane', None):
+                self.req.hand_off(lane, self.call_app)
+                return
+        self.call_app()
+
+    def call_app(self):
+        """Call the WSGI application and write its iterable output."""
         response = self.req.server.wsgi_app(self.env, self.start_response)
         try:
             for chunk in response:
@@ -2243,6 +2826,7 @@ class WSGIGateway_10(WSGIGateway):
             'wsgi.run_once': False,
             'wsgi.url_scheme': req.scheme,
             'wsgi.version': (1, 0),
+            'wsgiserver.connection_state': req.conn.state,
             }
 
         if isinstance(req.server.bind_addr, basestring):
@@ -0,0 +1,1051 @@
+# (c) 2009-2014 Martin Wendt and contributors; see WsgiDAV https://github.com/mar10/wsgidav
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+event_server.py is a WSGI server that handles its connections on one event
+loop (epoll, poll or select).
+
+The loop accepts connections, parses HTTP requests, reads request bodies
+and writes response bytes. Only the application call itself runs on a
+bounded pool of worker threads:
+
+    - Idle keep-alive connections and slow clients sending a request cost a
+      socket and a small buffer, but no thread.
+    - A request is dispatched to a worker only when it has been received
+      completely (large bodies are spooled to a temporary file).
+    - Workers produce at most ``highWater`` bytes of a response at a time
+      and hand them to the loop. The next part is only produced after the
+      loop has sent most of it to the client, so a slow reader does not
+      hold a worker while its response drains.
+    - A request stays on one thread from start to finish: the next parts
+      of a response and closing it (which commits the archive batch,
+      writes the access log, ...) are run by the worker that called the
+      application, never by the loop or another worker.
+    - If all workers are busy and the queue is full, complete requests wait
+      on the loop until a worker is free.
+
+This makes it possible to keep many thousands of clients (e.g. mounted
+WebDAV drives) connected to one node.
+
+Usage::
+
+    server = EventServer(app, ("0.0.0.0", 8080), threads=10)
+    server.serve_forever()
+
+SSL is not supported; use the bundled CherryPy server for HTTPS.
+"""
+__docformat__ = "reStructuredText"
+
+from avax.webdav.wsgidav.version import __version__
+from avax.webdav.wsgidav import util
+from collections import deque
+from tempfile import SpooledTemporaryFile
+import errno
+import os
+import select
+import socket
+import sys
+import threading
+import time
+import urllib
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+_logger = util.getModuleLogger(__name__)
+
+SERVER_ERROR = """\
+<html>
+  <head>
+     <title>Server Error</title>
+  </head>
+  <body>
+     <h1>Server Error</h1>
+     A server error has occurred.  Please contact the system administrator for
+     more information.
+  </body>
+</html>
+"""
+
+# Connection states
+READING = 0      # Waiting for (the rest of) a request
+PROCESSING = 1   # Request is queued or running in a worker thread
+WRITING = 2      # Response is being produced and sent
+
+RECV_SIZE = 64 * 1024
+SEND_SIZE = 64 * 1024
+
+class HTTPRequestError(Exception):
+    """Invalid request; answered by the loop and the connection is closed."""
+
+    def __init__(self, status, message):
+        Exception.__init__(self, status, message)
+        self.status = status
+        self.message = message
+
+
+#===============================================================================
+# Poller
+#===============================================================================
+class Poller(object):
+    """Minimal level-triggered readiness notification (epoll, poll or select)."""
+    READ = 1
+    WRITE = 2
+    ERROR = 4  # Reported with READ|WRITE; not used for register()
+
+    def __init__(self):
+        self._fds = {}
+        if hasattr(select, "epoll"):
+            self._impl = select.epoll()
+            self._masks = ((self.READ, select.EPOLLIN), (self.WRITE, select.EPOLLOUT))
+            self._errors = select.EPOLLERR | select.EPOLLHUP
+        elif hasattr(select, "poll"):
+            self._impl = select.poll()
+            self._masks = ((self.READ, select.POLLIN), (self.WRITE, select.POLLOUT))
+            self._errors = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        else:
+            self._impl = None
+
+    def _native(self, events):
+        mask = 0
+        for flag, native in self._masks:
+            if events & flag:
+                mask |= native
+        return mask
+
+    def register(self, fd, events):
+        if fd in self._fds:
+            if self._fds[fd] == events:
+                return
+            self._fds[fd] = events
+            if self._impl is not None:
+                self._impl.modify(fd, self._native(events))
+        else:
+            self._fds[fd] = events
+            if self._impl is not None:
+                self._impl.register(fd, self._native(events))
+
+    def unregister(self, fd):
+        if self._fds.pop(fd, None) is not None and self._impl is not None:
+            try:
+                self._impl.unregister(fd)
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+
+    def poll(self, timeout):
+        """Return a list of (fd, events); errors are reported as ERROR|READ|WRITE."""
+        if self._impl is None:
+            r = [fd for fd, ev in self._fds.iteritems() if ev & self.READ]
+            w = [fd for fd, ev in self._fds.iteritems() if ev & self.WRITE]
+            try:
+                r, w, _ = select.select(r, w, [], timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+            res = dict((fd, self.READ) for fd in r)
+            for fd in w:
+                res[fd] = res.get(fd, 0) | self.WRITE
+            return res.items()
+
+        if isinstance(self._impl, select.epoll):
+            timeout = timeout if timeout is not None else -1
+        elif timeout is not None:
+            timeout = int(timeout * 1000)
+        try:
+            events = self._impl.poll(timeout)
+        except (IOError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        res = []
+        for fd, native in events:
+            ev = 0
+            for flag, mask in self._masks:
+                if native & mask:
+                    ev |= flag
+            if native & self._errors:
+                ev |= self.ERROR | self.READ | self.WRITE
+            res.append((fd, ev))
+        return res
+
+    def close(self):
+        if self._impl is not None and hasattr(self._impl, "close"):
+            self._impl.close()
+        self._fds.clear()
+
+
+#===============================================================================
+# BoundedExecutor
+#===============================================================================
+class BoundedExecutor(object):
+    """Run callables on a fixed number of threads with a bounded queue.
+
+    submit() queues a callable for any free worker. submitTo() queues it for
+    one worker (see currentWorker()); these callables are never refused and
+    run before the worker takes new ones from the shared queue.
+    """
+
+    def __init__(self, threads=10, maxQueued=100):
+        self.maxQueued = maxQueued
+        self._lock = threading.Lock()
+        self._shared = deque()
+        self._pinned = [deque() for _ in range(threads)]
+        self._wakeups = [threading.Condition(self._lock) for _ in range(threads)]
+        self._idle = []  # Indexes of waiting workers
+        self._stopping = False
+        self._local = threading.local()
+        self._threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self._run, args=(i, ),
+                                 name="EventServer worker %s" % i)
+            t.daemon = True
+            self._threads.append(t)
+            t.start()
+
+    def _run(self, index):
+        self._local.index = index
+        pinned = self._pinned[index]
+        wakeup = self._wakeups[index]
+        while True:
+            with self._lock:
+                while not (pinned or self._shared or self._stopping):
+                    self._idle.append(index)
+                    wakeup.wait()
+                    if index in self._idle:
+                        self._idle.remove(index)
+                if pinned:
+                    fn, args = pinned.popleft()
+                elif self._shared:
+                    fn, args = self._shared.popleft()
+                else:
+                    return
+            try:
+                fn(*args)
+            except Exception:
+                _logger.exception("Unhandled exception in %s" % fn)
+
+    def _wake(self, index=None):
+        """Wake worker `index`, or any idle worker (lock held)."""
+        if index is None:
+            if self._idle:
+                self._wakeups[self._idle.pop()].notify()
+        elif index in self._idle:
+            self._idle.remove(index)
+            self._wakeups[index].notify()
+
+    @property
+    def qsize(self):
+        """Number of queued callables."""
+        return len(self._shared) + sum(len(p) for p in self._pinned)
+
+    def currentWorker(self):
+        """Return the index of the calling worker thread (None for others)."""
+        return getattr(self._local, "index", None)
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) for any worker; return False if the queue is full."""
+        with self._lock:
+            if len(self._shared) >= self.maxQueued:
+                return False
+            self._shared.append((fn, args))
+            self._wake()
+        return True
+
+    def submitTo(self, index, fn, *args):
+        """Queue fn(*args) for worker `index`."""
+        with self._lock:
+            self._pinned[index].append((fn, args))
+            self._wake(index)
+
+    def shutdown(self, timeout=5):
+        """Stop the workers after they have run all queued callables."""
+        with self._lock:
+            self._stopping = True
+            for wakeup in self._wakeups:
+                wakeup.notify()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+
+#===============================================================================
+# Request, Response, Connection
+#===============================================================================
+class Request(object):
+    """A parsed HTTP request header."""
+
+    def __init__(self, method, uri, version, headers):
+        self.method = method
+        self.uri = uri
+        self.version = version
+        self.headers = headers  # {HTTP_NAME: value}
+        self.body = None
+        self.bodySize = 0
+        self.keepAlive = False
+
+
+class Response(object):
+    """WSGI response state; only used by the worker that called the app."""
+
+    def __init__(self, request, server):
+        self.request = request
+        self.server = server
+        self.status = None
+        self.headers = None
+        self.headersSent = False
+        self.chunked = False
+        self.closeAfter = not request.keepAlive
+        self.omitBody = request.method == "HEAD"
+        self.remaining = None
+        self.written = []  # Data passed to the write() callable
+        self.result = None
+        self.iterator = None
+        self.worker = None  # Index of the worker that called the app
+
+    def startResponse(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.headersSent:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+        elif self.status is not None:
+            raise AssertionError("start_response() called twice")
+        self.status = status
+        self.headers = list(headers)
+        return self.written.append
+
+    def _headerBytes(self, finished):
+        names = dict((k.lower(), v) for k, v in self.headers)
+        code = int(self.status[:3])
+        if code < 200 or code in (204, 304):
+            self.omitBody = True
+        if names.get("connection", "").lower() == "close":
+            self.closeAfter = True
+
+        if "content-length" in names:
+            self.remaining = int(names["content-length"])
+        elif self.omitBody:
+            pass
+        elif finished:
+            # Nothing was produced: the body is empty
+            self.headers.append(("Content-Length", "0"))
+            self.remaining = 0
+        elif self.request.version == "HTTP/1.1":
+            self.headers.append(("Transfer-Encoding", "chunked"))
+            self.chunked = True
+        else:
+            # HTTP/1.0 without Content-Length: end of body is end of connection
+            self.closeAfter = True
+
+        if "connection" not in names:
+            if self.closeAfter:
+                self.headers.append(("Connection", "close"))
+            elif self.request.version != "HTTP/1.1":
+                self.headers.append(("Connection", "Keep-Alive"))
+        if "date" not in names:
+            self.headers.append(("Date", util.getRfc1123Time()))
+        if "server" not in names:
+            self.headers.append(("Server", self.server.version))
+
+        lines = ["HTTP/1.1 %s" % self.status]
+        for name, value in self.headers:
+            lines.append("%s: %s" % (name, value))
+        lines.append("\r\n")
+        self.headersSent = True
+        return str("\r\n".join(lines))
+
+    def frame(self, data, out):
+        """Append data (with headers and chunk framing) to the out list."""
+        if not self.headersSent:
+            out.append(self._headerBytes(False))
+        if not data or self.omitBody:
+            return
+        assert type(data) is str
+        if self.remaining is not None:
+            data = data[:self.remaining]
+            self.remaining -= len(data)
+        if self.chunked:
+            out.append("%x\r\n" % len(data))
+            out.append(data)
+            out.append("\r\n")
+        else:
+            out.append(data)
+
+    def finish(self, out):
+        """Append the end of the response to the out list."""
+        if not self.headersSent:
+            out.append(self._headerBytes(True))
+        if self.chunked:
+            out.append("0\r\n\r\n")
+        elif self.remaining:
+            # Application sent less than announced
+            self.closeAfter = True
+
+    def close(self):
+        result, self.result = self.result, None
+        if hasattr(result, "close"):
+            try:
+                result.close()
+            except Exception:
+                _logger.exception("Error closing the response iterator")
+
+
+class Connection(object):
+    """State of one client connection; only touched by the event loop."""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.addr = addr
+        self.state = READING
+        self.inbuf = ""
+        self.outbuf = deque()
+        self.outsize = 0
+        self.request = None
+        self.response = None
+        self.pumping = False    # A worker is producing response data
+        self.finished = False   # All response data was produced
+        self.closed = False
+        self.requests = 0
+        self.lastActivity = time.time()
+        # Body reader state
+        self.bodyRemaining = 0  # Content-Length bytes, or bytes of the current chunk
+        self.chunkState = None  # None (not chunked), "size", "data", "crlf", "trailer"
+
+    def __repr__(self):
+        return "Connection(%s:%s, state=%s)" % (self.addr[0], self.addr[1], self.state)
+
+
+#===============================================================================
+# EventServer
+#===============================================================================
+class EventServer(object):
+    """WSGI server that handles all connections on one event loop thread."""
+
+    version = "WsgiDAV/%s EventServer Python/%s" % (__version__, sys.version.split()[0])
+
+    def __init__(self, app, bindAddress, threads=10, maxQueued=100,
+                 maxConnections=10000, keepAliveTimeout=60, timeout=30,
+                 maxHeaderSize=64 * 1024, spoolSize=1024 * 1024,
+                 highWater=256 * 1024, requestQueueSize=128):
+        self.app = app
+        self.bindAddress = bindAddress
+        self.threads = threads
+        self.maxQueued = maxQueued
+        self.maxConnections = maxConnections
+        self.keepAliveTimeout = keepAliveTimeout
+        self.timeout = timeout
+        self.maxHeaderSize = maxHeaderSize
+        self.spoolSize = spoolSize
+        self.highWater = highWater
+        self.lowWater = highWater // 4
+        self.requestQueueSize = requestQueueSize
+        self.socket = None
+        self.executor = None
+        self.ready = False
+        self._connections = {}
+        self._waiting = deque()      # Complete requests waiting for a worker
+        self._completions = deque()  # (conn, data, finished) posted by workers
+        self._wakePending = False
+        self._wakeLock = threading.Lock()
+        self._stopRequest = False
+
+    def bind(self):
+        host, port = self.bindAddress
+        info = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM,
+                                  0, socket.AI_PASSIVE)[0]
+        family, socktype, proto, _canonname, sa = info
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(sa)
+        sock.listen(self.requestQueueSize)
+        sock.setblocking(0)
+        self.socket = sock
+        if port == 0:
+            self.bindAddress = (host, sock.getsockname()[1])
+
+    # --- Worker side ---------------------------------------------------------
+
+    def _post(self, conn, data, finished):
+        """Hand produced response data to the loop (called by workers)."""
+        self._completions.append((conn, data, finished))
+        self._wakeLock.acquire()
+        try:
+            if self._wakePending:
+                return
+            self._wakePending = True
+            try:
+                os.write(self._wakeWrite, b"x")
+            except OSError:
+                pass
+        finally:
+            self._wakeLock.release()
+
+    def _makeEnviron(self, conn):
+        req = conn.request
+        uri = req.uri
+        if "://" in uri:
+            # Absolute URI: http://host/path
+            uri = "/" + uri.split("://", 1)[1].partition("/")[2]
+        path, _, query = uri.partition("?")
+        environ = {"wsgi.version": (1, 0),
+                   "wsgi.url_scheme": "http",
+                   "wsgi.input": req.body or StringIO(""),
+                   "wsgi.errors": sys.stderr,
+                   "wsgi.multithread": True,
+                   "wsgi.multiprocess": False,
+                   "wsgi.run_once": False,
+                   "REQUEST_METHOD": req.method,
+                   "REQUEST_URI": req.uri,
+                   "SCRIPT_NAME": "",
+                   "PATH_INFO": urllib.unquote(path),
+                   "QUERY_STRING": query,
+                   "SERVER_NAME": self.bindAddress[0],
+                   "SERVER_PORT": str(self.bindAddress[1]),
+                   "SERVER_PROTOCOL": req.version,
+                   "SERVER_SOFTWARE": self.version,
+                   "REMOTE_ADDR": conn.addr[0],
+                   "REMOTE_PORT": str(conn.addr[1]),
+                   }
+        for name, value in req.headers.iteritems():
+            if name in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+                environ[name[5:]] = value
+            else:
+                environ[name] = value
+        if req.body is not None:
+            # Chunked bodies were decoded by the loop
+            environ["CONTENT_LENGTH"] = str(req.bodySize)
+            environ.pop("HTTP_TRANSFER_ENCODING", None)
+        return environ
+
+    def _callApp(self, conn):
+        """Worker: call the application and produce the first part of the response."""
+        resp = conn.response
+        # Later parts of this request are run by the same worker
+        resp.worker = self.executor.currentWorker()
+        try:
+            resp.result = self.app(self._makeEnviron(conn), resp.startResponse)
+            resp.iterator = iter(resp.result)
+        except Exception:
+            _logger.exception("Application error for %s %s" % (conn.request.method, conn.request.uri))
+            self._postError(conn)
+            return
+        self._pump(conn)
+
+    def _pump(self, conn):
+        """Worker: produce up to highWater bytes of the response."""
+        resp = conn.response
+        out = []
+        size = 0
+        finished = False
+        try:
+            while size < self.highWater:
+                if resp.written:
+                    data, resp.written = "".join(resp.written), []
+                else:
+                    try:
+                        data = resp.iterator.next()
+                    except StopIteration:
+                        finished = True
+                        break
+                    if resp.written:
+                        data = "".join(resp.written) + data
+                        resp.written = []
+                if data:
+                    n = len(out)
+                    resp.frame(data, out)
+                    size += sum(len(s) for s in out[n:])
+            if finished:
+                resp.finish(out)
+        except Exception:
+            _logger.exception("Application error for %s %s" % (conn.request.method, conn.request.uri))
+            resp.close()
+            if not resp.headersSent:
+                self._postError(conn)
+            else:
+                # Too late for an error response: drop the connection
+                resp.closeAfter = True
+                self._post(conn, out, True)
+            return
+        if finished:
+            resp.close()
+        self._post(conn, out, finished)
+
+    def _postError(self, conn):
+        resp = conn.response
+        resp.close()
+        resp.status = None
+        resp.written = []
+        resp.closeAfter = True
+        resp.startResponse("500 Internal Server Error", [("Content-Type", "text/html"),
+                                                         ("Content-Length", str(len(SERVER_ERROR)))])
+        out = []
+        resp.frame(SERVER_ERROR, out)
+        resp.finish(out)
+        self._post(conn, out, True)
+
+    # --- Event loop -----------------------------------------------------------
+
+    def serve_forever(self):
+        """Run the event loop until stop() is called."""
+        if self.socket is None:
+            self.bind()
+        self._wakeRead, self._wakeWrite = os.pipe()
+        for fd in (self._wakeRead, self._wakeWrite):
+            _setNonBlocking(fd)
+        self.executor = BoundedExecutor(self.threads, self.maxQueued)
+        self._poller = Poller()
+        self._poller.register(self.socket.fileno(), Poller.READ)
+        self._poller.register(self._wakeRead, Poller.READ)
+        self._accepting = True
+        self.ready = True
+        lastSweep = time.time()
+        try:
+            while not self._stopRequest:
+                for fd, events in self._poller.poll(1.0):
+                    if fd == self._wakeRead:
+                        self._drainWake()
+                    elif fd == self.socket.fileno():
+                        self._accept()
+                    else:
+                        conn = self._connections.get(fd)
+                        if conn is None:
+                            continue
+                        if events & Poller.ERROR and conn.state != READING:
+                            # Reset or hang-up while the request is running:
+                            # the error would be reported again at once
+                            self._close(conn)
+                            continue
+                        if events & Poller.READ:
+                            self._onReadable(conn)
+                        if events & Poller.WRITE and not conn.closed:
+                            self._onWritable(conn)
+                self._handleCompletions()
+                self._dispatchWaiting()
+                now = time.time()
+                if now - lastSweep >= 1.0:
+                    lastSweep = now
+                    self._expire(now)
+        finally:
+            self.ready = False
+            conns = self._connections.values()
+            for conn in conns:
+                self._close(conn)
+            self._dispatchWaiting()
+            # Let the workers finish (and close) the responses they produce
+            deadline = time.time() + 5
+            while any(conn.pumping for conn in conns) and time.time() < deadline:
+                time.sleep(0.01)
+                self._handleCompletions()
+            self.executor.shutdown()
+            self._poller.close()
+            self.socket.close()
+            self.socket = None
+            os.close(self._wakeRead)
+            os.close(self._wakeWrite)
+
+    def stop(self):
+        """Stop serve_forever() (may be called from any thread)."""
+        self._stopRequest = True
+        if self.ready:
+            self._post(None, None, None)
+
+    def _drainWake(self):
+        self._wakeLock.acquire()
+        try:
+            self._wakePending = False
+            try:
+                while os.read(self._wakeRead, 4096):
+                    pass
+            except OSError:
+                pass
+        finally:
+            self._wakeLock.release()
+
+    def _accept(self):
+        while len(self._connections) < self.maxConnections:
+            try:
+                sock, addr = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    _logger.warning("accept() failed: %s" % e)
+                    return
+                if e.args[0] == errno.ECONNABORTED:
+                    continue
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if not isinstance(addr, tuple) or len(addr) < 2:
+                addr = ("", 0)
+            conn = Connection(sock, addr)
+            self._connections[conn.fd] = conn
+            self._poller.register(conn.fd, Poller.READ)
+        # Stop accepting until a connection was closed
+        self._poller.unregister(self.socket.fileno())
+        self._accepting = False
+
+    def _close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        self._poller.unregister(conn.fd)
+        self._connections.pop(conn.fd, None)
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+        if not conn.pumping:
+            self._release(conn)
+        # else: released when the worker has posted its data
+        if not self._accepting and not self._stopRequest:
+            self._poller.register(self.socket.fileno(), Poller.READ)
+            self._accepting = True
+
+    def _release(self, conn):
+        """Free request body and response iterator once no worker uses them.
+
+        The response iterator is closed by the worker that called the app.
+        """
+        request, response = conn.request, conn.response
+        conn.request = conn.response = None
+        if response is not None and response.result is not None:
+            self.executor.submitTo(response.worker, _closeRequest, request, response)
+        elif request is not None and request.body is not None:
+            request.body.close()
+
+    def _send(self, conn, data):
+        """Queue raw bytes written by the loop itself (errors, 100-continue)."""
+        conn.outbuf.append(data)
+        conn.outsize += len(data)
+        self._poller.register(conn.fd, self._interest(conn))
+
+    def _interest(self, conn):
+        events = 0
+        if conn.state == READING:
+            events |= Poller.READ
+        if conn.outbuf:
+            events |= Poller.WRITE
+        return events
+
+    def _updateInterest(self, conn):
+        if not conn.closed:
+            self._poller.register(conn.fd, self._interest(conn))
+
+    def _onReadable(self, conn):
+        if conn.state != READING:
+            # Error event while processing or writing
+            self._onWritable(conn)
+            return
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._close(conn)
+            return
+        if not data:
+            self._close(conn)
+            return
+        conn.lastActivity = time.time()
+        conn.inbuf += data
+        self._parse(conn)
+
+    def _onWritable(self, conn):
+        while conn.outbuf:
+            if len(conn.outbuf) > 1 and len(conn.outbuf[0]) < SEND_SIZE:
+                # Coalesce small pieces (headers, chunk framing) into one send
+                parts = []
+                size = 0
+                while conn.outbuf and size < SEND_SIZE:
+                    s = conn.outbuf.popleft()
+                    parts.append(s)
+                    size += len(s)
+                conn.outbuf.appendleft("".join(parts))
+            data = conn.outbuf[0]
+            try:
+                n = conn.sock.send(data)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                self._close(conn)
+                return
+            conn.lastActivity = time.time()
+            conn.outsize -= n
+            if n < len(data):
+                conn.outbuf[0] = data[n:]
+                break
+            conn.outbuf.popleft()
+
+        if conn.state == WRITING:
+            if conn.finished and not conn.outbuf:
+                self._endRequest(conn)
+                return
+            if (not conn.finished and not conn.pumping
+                and conn.outsize < self.lowWater):
+                self._schedule(conn, self._pump)
+        self._updateInterest(conn)
+
+    def _schedule(self, conn, fn):
+        conn.pumping = True
+        worker = conn.response.worker
+        if worker is not None:
+            self.executor.submitTo(worker, fn, conn)
+        elif not self.executor.submit(fn, conn):
+            self._waiting.append((conn, fn))
+
+    def _dispatchWaiting(self):
+        while self._waiting:
+            conn, fn = self._waiting[0]
+            if conn.closed:
+                self._waiting.popleft()
+                conn.pumping = False
+                self._release(conn)
+                continue
+            if not self.executor.submit(fn, conn):
+                return
+            self._waiting.popleft()
+
+    def _handleCompletions(self):
+        while self._completions:
+            conn, data, finished = self._completions.popleft()
+            if conn is None:
+                continue
+            conn.pumping = False
+            if conn.closed:
+                self._release(conn)
+                continue
+            conn.state = WRITING
+            for s in data:
+                conn.outbuf.append(s)
+                conn.outsize += len(s)
+            if finished:
+                conn.finished = True
+            self._onWritable(conn)
+
+    def _endRequest(self, conn):
+        """Response is sent: close or get ready for the next request."""
+        closeAfter = conn.response is None or conn.response.closeAfter
+        self._release(conn)
+        conn.finished = False
+        if closeAfter:
+            self._close(conn)
+            return
+        conn.state = READING
+        self._updateInterest(conn)
+        if conn.inbuf:
+            # Pipelined request
+            self._parse(conn)
+
+    def _expire(self, now):
+        for conn in self._connections.values():
+            if conn.state == PROCESSING or conn.pumping:
+                continue
+            if conn.state == READING and not conn.inbuf and conn.request is None:
+                limit = self.keepAliveTimeout if conn.requests else self.timeout
+            else:
+                limit = self.timeout
+            if now - conn.lastActivity > limit:
+                _logger.debug("Closing inactive %s" % conn)
+                self._close(conn)
+
+    # --- Request parsing --------------------------------------------------------
+
+    def _parse(self, conn):
+        try:
+            if conn.request is None and not self._parseHead(conn):
+                return
+            if not self._readBody(conn):
+                return
+        except HTTPRequestError, e:
+            _logger.debug("Bad request from %s: %s %s" % (conn.addr, e.status, e.message))
+            conn.state = WRITING
+            conn.finished = True
+            conn.inbuf = ""
+            conn.response = None
+            body = "%s\n" % e.message
+            self._send(conn, "HTTP/1.1 %s\r\nContent-Type: text/plain\r\n"
+                             "Content-Length: %s\r\nConnection: close\r\n\r\n%s"
+                       % (e.status, len(body), body))
+            return
+        # Request is complete
+        if conn.request.body is not None:
+            conn.request.body.seek(0)
+        conn.requests += 1
+        conn.state = PROCESSING
+        conn.response = Response(conn.request, self)
+        self._updateInterest(conn)
+        self._schedule(conn, self._callApp)
+
+    def _parseHead(self, conn):
+        # Ignore empty lines before the request line (RFC 2616, 4.1)
+        conn.inbuf = conn.inbuf.lstrip("\r\n")
+        end = conn.inbuf.find("\r\n\r\n")
+        if end < 0:
+            if len(conn.inbuf) > self.maxHeaderSize:
+                raise HTTPRequestError("431 Request Header Fields Too Large", "Request header too large.")
+            return False
+        head, conn.inbuf = conn.inbuf[:end], conn.inbuf[end + 4:]
+        lines = head.split("\r\n")
+        try:
+            method, uri, version = lines[0].split(" ", 2)
+        except ValueError:
+            raise HTTPRequestError("400 Bad Request", "Malformed request line.")
+        if version not in ("HTTP/1.0", "HTTP/1.1"):
+            raise HTTPRequestError("505 HTTP Version Not Supported", "Unsupported HTTP version.")
+
+        headers = {}
+        name = None
+        for line in lines[1:]:
+            if line[:1] in (" ", "\t") and name:
+                headers[name] += " " + line.strip()
+                continue
+            k, sep, v = line.partition(":")
+            if not sep:
+                raise HTTPRequestError("400 Bad Request", "Malformed header line.")
+            name = "HTTP_" + k.strip().upper().replace("-", "_")
+            v = v.strip()
+            if name in headers:
+                headers[name] += ", " + v
+            else:
+                headers[name] = v
+
+        req = Request(method, uri, version, headers)
+        connection = headers.get("HTTP_CONNECTION", "").lower()
+        if version == "HTTP/1.1":
+            req.keepAlive = "close" not in connection
+        else:
+            req.keepAlive = "keep-alive" in connection
+        conn.request = req
+
+        if headers.get("HTTP_TRANSFER_ENCODING", "").lower() == "chunked":
+            conn.chunkState = "size"
+        elif "HTTP_CONTENT_LENGTH" in headers:
+            try:
+                conn.bodyRemaining = int(headers["HTTP_CONTENT_LENGTH"])
+            except ValueError:
+                raise HTTPRequestError("400 Bad Request", "Invalid Content-Length.")
+            if conn.bodyRemaining < 0:
+                raise HTTPRequestError("400 Bad Request", "Invalid Content-Length.")
+            conn.chunkState = None
+        else:
+            conn.bodyRemaining = 0
+            conn.chunkState = None
+            return True
+
+        if conn.chunkState or conn.bodyRemaining:
+            req.body = SpooledTemporaryFile(self.spoolSize)
+            if (version == "HTTP/1.1"
+                and headers.get("HTTP_EXPECT", "").lower() == "100-continue"):
+                self._send(conn, "HTTP/1.1 100 Continue\r\n\r\n")
+        return True
+
+    def _readBody(self, conn):
+        """Consume body bytes from inbuf; return True when the body is complete."""
+        req = conn.request
+        if conn.chunkState is None:
+            if conn.bodyRemaining:
+                data = conn.inbuf[:conn.bodyRemaining]
+                conn.inbuf = conn.inbuf[len(data):]
+                req.body.write(data)
+                req.bodySize += len(data)
+                conn.bodyRemaining -= len(data)
+            return conn.bodyRemaining == 0
+
+        # Decode 'Transfer-Encoding: chunked'
+        while True:
+            if conn.chunkState == "size":
+                end = conn.inbuf.find("\r\n")
+                if end < 0:
+                    if len(conn.inbuf) > 1024:
+                        raise HTTPRequestError("400 Bad Request", "Invalid chunk size.")
+                    return False
+                line, conn.inbuf = conn.inbuf[:end], conn.inbuf[end + 2:]
+                try:
+                    conn.bodyRemaining = int(line.split(";", 1)[0].strip(), 16)
+                except ValueError:
+                    raise HTTPRequestError("400 Bad Request", "Invalid chunk size.")
+                conn.chunkState = "data" if conn.bodyRemaining else "trailer"
+            elif conn.chunkState == "data":
+                if not conn.inbuf:
+                    return False
+                data = conn.inbuf[:conn.bodyRemaining]
+                conn.inbuf = conn.inbuf[len(data):]
+                req.body.write(data)
+                req.bodySize += len(data)
+                conn.bodyRemaining -= len(data)
+                if conn.bodyRemaining == 0:
+                    conn.chunkState = "crlf"
+            elif conn.chunkState == "crlf":
+                if len(conn.inbuf) < 2:
+                    return False
+                if conn.inbuf[:2] != "\r\n":
+                    raise HTTPRequestError("400 Bad Request", "Invalid chunk data.")
+                conn.inbuf = conn.inbuf[2:]
+                conn.chunkState = "size"
+            else:
+                # Skip trailer lines up to the empty line
+                end = conn.inbuf.find("\r\n")
+                if end < 0:
+                    if len(conn.inbuf) > self.maxHeaderSize:
+                        raise HTTPRequestError("400 Bad Request", "Invalid chunk trailer.")
+                    return False
+                line, conn.inbuf = conn.inbuf[:end], conn.inbuf[end + 2:]
+                if not line:
+                    conn.chunkState = None
+                    return True
+
+
+def _closeRequest(request, response):
+    """Worker: close the response iterator and the request body."""
+    try:
+        response.close()
+    finally:
+        if request is not None and request.body is not None:
+            request.body.close()
+
+
+def _setNonBlocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def serve(conf, app):
+    host = conf.get("host", "localhost")
+    port = int(conf.get("port", 8080))
+    options = conf.get("event_server", {})
+    server = EventServer(app, (host, port),
+                         threads=options.get("threads", 10),
+                         maxQueued=options.get("max_queued", 100),
+                         maxConnections=options.get("max_connections", 10000),
+                         keepAliveTimeout=options.get("keep_alive_timeout", 60),
+                         timeout=options.get("timeout", 30))
+    metrics = getattr(app, "metrics", None)
+    if metrics is not None:
+        def _queueDepth():
+            if server.executor is None:
+                return None
+            # Requests in the executor queue and those waiting on the loop
+            return {("event", ): server.executor.qsize + len(server._waiting)}
+        metrics.callback("wsgidav_threadpool_queue_depth",
+                         "Requests waiting for a worker thread.",
+                         _queueDepth, ("pool", ))
+        metrics.callback("wsgidav_open_connections", "Open client connections.",
+                         lambda: len(server._connections))
+    if conf.get("verbose") >= 1:
+        print "WsgiDAV %s serving at %s, port %s (event loop, %s worker threads)..." % (
+            __version__, host, port, server.threads)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        if conf.get("verbose") >= 1:
+            print "Caught Ctrl-C, shutting down..."
+
+
+if __name__ == "__main__":
+    raise RuntimeError("Use run_server.py")
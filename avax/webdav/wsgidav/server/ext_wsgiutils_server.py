@@ -46,6 +46,12 @@ where ``publish_app`` is the WSGI application to be run, it will be called with
 ``publish_app(environ, start_response)`` for each incoming request, as described in 
 WSGI <http://www.python.org/peps/pep-0333.html>
 
+Connections are served by a fixed pool of worker threads (``numThreads``).
+Connections are kept alive (HTTP/1.1) until they were idle for
+``keepAliveTimeout`` seconds; responses without Content-Length are sent with
+'Transfer-Encoding: chunked'. Response data is buffered and flushed once per
+response, so headers and small bodies go out in one segment.
+
 Note: if you are using the paster development server (from Paste <http://pythonpaste.org>), you can 
 copy ``ext_wsgi_server.py`` to ``<Paste-installation>/paste/servers`` and use this server to run the 
 application by specifying ``server='ext_wsgiutils'`` in the ``server.conf`` or appropriate paste 
@@ -58,6 +64,7 @@ import time
 import httplib
 import socket
 import threading
+import Queue
 
 
 import SocketServer, BaseHTTPServer, urlparse
@@ -96,6 +103,15 @@ class ExtHandler (BaseHTTPServer.BaseHTTPRequestHandler):
     server_version = "WsgiDAV/%s %s" % (__version__,
                                         BaseHTTPServer.BaseHTTPRequestHandler.server_version)
 
+    # Buffer response data; the buffer is flushed after each request
+    wbufsize = 64 * 1024
+
+    def setup(self):
+        # Idle keep-alive connections are closed after this many seconds
+        self.timeout = self.server.keepAliveTimeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
     def log_message (self, *args):
         pass
 #        BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
@@ -149,9 +165,20 @@ class ExtHandler (BaseHTTPServer.BaseHTTPRequestHandler):
         if self.command == "PUT":
             pass # breakpoint
         
+        chunked = self.headers.get("Transfer-Encoding", "").lower() == "chunked"
+        if chunked:
+            # The application decodes chunked bodies from the raw stream
+            wsgiInput = self.rfile
+        else:
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                length = 0
+            wsgiInput = _InputWrapper(self.rfile, length)
+
         env = {"wsgi.version": (1, 0),
                "wsgi.url_scheme": "http",
-               "wsgi.input": self.rfile,
+               "wsgi.input": wsgiInput,
                "wsgi.errors": sys.stderr,
                "wsgi.multithread": 1,
                "wsgi.multiprocess": 0,
@@ -174,6 +201,8 @@ class ExtHandler (BaseHTTPServer.BaseHTTPRequestHandler):
         # Setup the state
         self.wsgiSentHeaders = 0
         self.wsgiHeaders = []
+        self.wsgiChunked = False
+        self.wsgiOmitBody = False
 
         try:
             # We have there environment, now invoke the application
@@ -194,43 +223,88 @@ class ExtHandler (BaseHTTPServer.BaseHTTPRequestHandler):
             errorMsg = StringIO()
             traceback.print_exc(file=errorMsg)
             logging.error (errorMsg.getvalue())
-            if not self.wsgiSentHeaders:
-                self.wsgiStartResponse("500 Server Error", [("Content-type", "text/html")])
+            if self.wsgiSentHeaders:
+                # Response is incomplete: the client must not reuse the connection
+                self.close_connection = 1
+                return
+            self.wsgiHeaders = ("500 Server Error", [("Content-type", "text/html"),
+                                                     ("Content-Length", str(len(SERVER_ERROR)))])
+            self.close_connection = 1
             self.wsgiWriteData(SERVER_ERROR)
         
         if not self.wsgiSentHeaders:
             # issue 29 sending one byte, when content-length is '0' seems wrong
-            # We must write out something!
-#            self.wsgiWriteData (" ")
-            self.wsgiWriteData("")
+            self.wsgiSendHeaders(True)
+        elif self.wsgiChunked:
+            self.wsgiWrite("0\r\n\r\n")
+
+        if chunked or wsgiInput.remaining:
+            # Unread request data would be parsed as the next request
+            self.close_connection = 1
         return
 
     def wsgiStartResponse (self, response_status, response_headers, exc_info=None):
         _logger.debug("wsgiStartResponse(%s, %s, %s)" % (response_status, response_headers, exc_info))
         if (self.wsgiSentHeaders):
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
             raise Exception ("Headers already sent and start_response called again!")
-        # Should really take a copy to avoid changes in the application....
-        self.wsgiHeaders = (response_status, response_headers)
+        # Take a copy, because we may add headers
+        self.wsgiHeaders = (response_status, list(response_headers))
         return self.wsgiWriteData
 
+    def wsgiSendHeaders(self, finished):
+        """Send status and headers, choosing how the end of the body is marked."""
+        status, headers = self.wsgiHeaders
+        statusCode = int(status [:status.find (" ")])
+        statusMsg = status [status.find (" ") + 1:]
+        names = [header.lower() for header, _value in headers]
+        self.wsgiOmitBody = (self.command == "HEAD" or statusCode < 200
+                             or statusCode in (204, 304))
+        if "content-length" in names or self.wsgiOmitBody:
+            pass
+        elif finished:
+            headers.append(("Content-Length", "0"))
+        elif self.request_version == "HTTP/1.1":
+            headers.append(("Transfer-Encoding", "chunked"))
+            self.wsgiChunked = True
+        else:
+            # The end of the body is marked by closing the connection
+            self.close_connection = 1
+        if "connection" not in names:
+            if self.close_connection:
+                headers.append(("Connection", "close"))
+            elif self.request_version != "HTTP/1.1":
+                headers.append(("Connection", "Keep-Alive"))
+
+        _logger.debug("wsgiSendHeaders: send headers '%r', %r" % (status, headers))
+        self.send_response (statusCode, statusMsg)
+        for header, value in headers:
+            self.send_header (header, value)
+        self.end_headers()
+        self.wsgiSentHeaders = 1
+
     def wsgiWriteData (self, data):
         if not self.wsgiSentHeaders:
-            status, headers = self.wsgiHeaders
             # Need to send header prior to data
-            statusCode = status [:status.find (" ")]
-            statusMsg = status [status.find (" ") + 1:]
-            _logger.debug("wsgiWriteData: send headers '%r', %r" % (status, headers))
-            self.send_response (int (statusCode), statusMsg)
-            for header, value in headers:
-                self.send_header (header, value)
-            self.end_headers()
-            self.wsgiSentHeaders = 1
+            self.wsgiSendHeaders(False)
         # Send the data
         assert type(data) is str # If not, Content-Length is propably wrong!
+        if not data or self.wsgiOmitBody:
+            return
+        _logger.debug("wsgiWriteData: write %s bytes: '%r'..." % (len(data), data[:50]))
+        if self.wsgiChunked:
+            self.wsgiWrite("%x\r\n" % len(data))
+            self.wsgiWrite(data)
+            self.wsgiWrite("\r\n")
+        else:
+            self.wsgiWrite(data)
+
+    def wsgiWrite(self, data):
         try:
-            _logger.debug("wsgiWriteData: write %s bytes: '%r'..." % (len(data), data[:50]))
             self.wfile.write(data)
         except socket.error, e:
+            self.close_connection = 1
             # Suppress stack trace when client aborts connection disgracefully:
             # 10053: Software caused connection abort
             # 10054: Connection reset by peer
@@ -240,7 +314,86 @@ class ExtHandler (BaseHTTPServer.BaseHTTPRequestHandler):
                 raise
 
 
-class ExtServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+class _InputWrapper(object):
+    """File-like wsgi.input that does not read beyond the request body.
+
+    On persistent connections the following request is already waiting on
+    the socket, so reading past Content-Length would block or consume it.
+    """
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ""
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ""
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(iter(self.readline, ""))
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+
+class ThreadPoolMixIn(SocketServer.ThreadingMixIn):
+    """Mix-in class to handle connections on a fixed pool of worker threads.
+
+    Accepted connections are queued; if all threads are busy and the queue
+    is full, the server stops accepting until a thread becomes free.
+    """
+    daemon_threads = True
+    numThreads = 10
+    _pool = None
+
+    def startThreadPool(self):
+        self._connections = Queue.Queue(self.numThreads * 2)
+        self._pool = []
+        for i in range(self.numThreads):
+            t = threading.Thread(target=self._processConnections,
+                                 name="ExtServer worker %s" % i)
+            t.daemon = self.daemon_threads
+            self._pool.append(t)
+            t.start()
+
+    def stopThreadPool(self, timeout=5):
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        for _ in pool:
+            self._connections.put(None)
+        for t in pool:
+            t.join(timeout)
+
+    def _processConnections(self):
+        while True:
+            item = self._connections.get()
+            if item is None:
+                return
+            self.process_request_thread(*item)
+
+    def process_request(self, request, client_address):
+        """Queue the connection for the next free worker thread."""
+        if self._pool is None:
+            self.startThreadPool()
+        self._connections.put((request, client_address))
+
+
+class ExtServer (ThreadPoolMixIn, BaseHTTPServer.HTTPServer):
 
     def handle_error(self, request, client_address):
         """Handle an error gracefully.  May be overridden.
@@ -287,6 +440,8 @@ class ExtServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
             """
 #            print "Handling do_SHUTDOWN request" 
             self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.send_header("Connection", "close")
             self.end_headers()
             self.server.stop_request = True
         if not hasattr(ExtHandler, "do_SHUTDOWN"): 
@@ -318,7 +473,8 @@ class ExtServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         self.stopped = True
 
 
-    def __init__ (self, serverAddress, wsgiApplications, serveFiles=1):
+    def __init__ (self, serverAddress, wsgiApplications, serveFiles=1,
+                  numThreads=10, keepAliveTimeout=15):
         BaseHTTPServer.HTTPServer.__init__ (self, serverAddress, ExtHandler)
         appList = []
         for urlPath, wsgiApp in wsgiApplications.items():
@@ -326,12 +482,22 @@ class ExtServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         self.wsgiApplications = appList
         self.serveFiles = serveFiles
         self.serverShuttingDown = 0
+        self.numThreads = numThreads
+        self.keepAliveTimeout = keepAliveTimeout
+
+
+    def server_close(self):
+        self.stopThreadPool()
+        BaseHTTPServer.HTTPServer.server_close(self)
 
 
 def serve(conf, app):
     host = conf.get("host", "localhost")
     port = int(conf.get("port", 8080)) 
-    server = ExtServer((host, port), {"": app})
+    options = conf.get("ext_server", {})
+    server = ExtServer((host, port), {"": app},
+                       numThreads=options.get("threads", 10),
+                       keepAliveTimeout=options.get("keep_alive_timeout", 15))
     if conf.get("verbose") >= 1:
         if host in ("", "0.0.0.0"):
             (hostname, _aliaslist, ipaddrlist) = socket.gethostbyname_ex(socket.gethostname())
@@ -30,13 +30,23 @@ Configuration is defined like this:
          
        ``--port`` option overrides ``port`` setting.  
        
+       ``--workers`` option overrides ``workers`` setting.  
+       
        ``--root=FOLDER`` option creates a FilesystemProvider that publishes 
        FOLDER on the '/' share.
 """
 from optparse import OptionParser
 from pprint import pprint
 from inspect import isfunction
+from tempfile import mkdtemp
 import traceback
+import threading
+import signal
+import select
+import socket
+import shutil
+import errno
+import time
 import sys
 import os
 
@@ -115,6 +125,10 @@ If no config file is found, a default FilesystemProvider is used."""
                       dest="host",
                       # default="localhost",
                       help="host to serve from (default: %default). 'localhost' is only accessible from the local computer. Use 0.0.0.0 to make your application public"),
+    parser.add_option("-w", "--workers",
+                      dest="workers",
+                      type="int",
+                      help="number of server processes sharing the port (default: 1)")
     parser.add_option("-r", "--root",
                       dest="root_path", 
                       help="Path to a file system folder to publish as share '/'.")
@@ -233,6 +247,8 @@ def _initConfig():
         config["port"] = cmdLineOpts.get("port")
     if cmdLineOpts.get("host"):
         config["host"] = cmdLineOpts.get("host")
+    if cmdLineOpts.get("workers"):
+        config["workers"] = cmdLineOpts.get("workers")
     if cmdLineOpts.get("verbose") is not None:
         config["verbose"] = cmdLineOpts.get("verbose")
     if cmdLineOpts.get("profile") is not None:
@@ -333,8 +349,12 @@ def _runPaste(app, config, mode):
 
 
 
-def _runCherryPy(app, config, mode):
-    """Run WsgiDAV using cherrypy.wsgiserver, if CherryPy is installed."""
+def _runCherryPy(app, config, mode, onReady=None):
+    """Run WsgiDAV using cherrypy.wsgiserver, if CherryPy is installed.
+
+    onReady() is called (in another thread) once the server accepts
+    connections.
+    """
     assert mode in ("cherrypy", "cherrypy-bundled")
 
     try:
@@ -369,17 +389,81 @@ def _runCherryPy(app, config, mode):
         if config["verbose"] >= 1:
             print "Running %s" % version
             print("Listening on %s://%s:%s ..." % (protocol, config["host"], config["port"]))
+        poolConfig = DEFAULT_CONFIG["thread_pool"].copy()
+        poolConfig.update(config.get("thread_pool", {}))
         server = wsgiserver.CherryPyWSGIServer(
             (config["host"], config["port"]), 
             app,
+            numthreads=poolConfig["min"],
+            max=poolConfig["max"],
             server_name=version,
             )
+        if config.get("workers", 1) > 1:
+            # Pre-forked workers all listen on the same port
+            server.reuse_port = True
+
+        # cherrypy.wsgiserver from an external CherryPy has no autoscaler
+        autoscalerClass = getattr(wsgiserver, "ThreadPoolAutoscaler", None)
+        if poolConfig["autoscale"] and autoscalerClass is not None:
+            server.autoscaler = autoscalerClass(server.requests,
+                                                interval=poolConfig["interval"],
+                                                max_wait=poolConfig["max_wait"],
+                                                grow_after=poolConfig["grow_after"],
+                                                shrink_after=poolConfig["shrink_after"],
+                                                spare=poolConfig["spare"])
+            if config["verbose"] >= 2:
+                print("Autoscaling worker threads (%s..%s)." % (poolConfig["min"], poolConfig["max"]))
+
+        # Serve bulk transfers from a separate pool of worker threads
+        laneConfig = DEFAULT_CONFIG["request_lanes"].copy()
+        laneConfig.update(config.get("request_lanes", {}))
+        getRequestLane = getattr(app, "getRequestLane", None)
+        if (laneConfig["enable"] and getRequestLane is not None
+            and hasattr(server, "get_lane")):
+            bulkThreads = laneConfig["bulk_threads"]
+            server.lanes = {"bulk": wsgiserver.ThreadPool(server, min=bulkThreads,
+                                                          max=bulkThreads, lane="bulk")}
+            server.lane_classifier = getRequestLane
+            if config["verbose"] >= 2:
+                print("Serving bulk transfers with %s worker threads." % bulkThreads)
+
+        metrics = getattr(app, "metrics", None)
+        if metrics is not None:
+            def _pools():
+                pools = {("default", ): server.requests}
+                for lane, pool in (getattr(server, "lanes", None) or {}).items():
+                    pools[(lane, )] = pool
+                return pools
+
+            metrics.callback("wsgidav_threadpool_queue_depth",
+                             "Connections waiting for a worker thread.",
+                             lambda: dict((k, p.qsize) for k, p in _pools().items()),
+                             ("pool", ))
+            metrics.callback("wsgidav_threadpool_threads",
+                             "Worker threads.",
+                             lambda: dict((k, len(p._threads)) for k, p in _pools().items()),
+                             ("pool", ))
+            metrics.callback("wsgidav_threadpool_idle_threads",
+                             "Worker threads waiting for a connection.",
+                             lambda: dict((k, p.idle) for k, p in _pools().items()),
+                             ("pool", ))
+
+        if onReady is not None:
+            def _notify():
+                while not server.ready:
+                    time.sleep(0.05)
+                onReady()
+            t = threading.Thread(target=_notify, name="WsgiDAV ready notification")
+            t.setDaemon(True)
+            t.start()
 
         try:
             server.start()
         except KeyboardInterrupt:
             if config["verbose"] >= 1:
                 print "Caught Ctrl-C, shutting down..."
+            if server.reuse_port and server.socket is not None:
+                _drainAcceptQueue(server)
             server.stop()
     except ImportError, e:
         if config["verbose"] >= 1:
@@ -390,6 +474,24 @@ def _runCherryPy(app, config, mode):
 
 
 
+def _drainAcceptQueue(server):
+    """Queue the connections that are waiting on the listening socket.
+
+    With SO_REUSEPORT every worker has its own accept queue: connections
+    left in it would be reset when the socket is closed. server.stop() lets
+    the worker threads serve the queued connections before they exit.
+    """
+    server.socket.settimeout(0)
+    while True:
+        try:
+            pending = select.select([server.socket], [], [], 0)[0]
+        except (select.error, socket.error):
+            return
+        if not pending:
+            return
+        server.tick()
+
+
 def _runFlup(app, config, mode):
     """Run WsgiDAV using flup.server.fcgi, if Flup is installed."""
     try:
@@ -442,6 +544,26 @@ def _runSimpleServer(app, config, mode):
 
 
 
+def _runEventLoop(app, config, mode):
+    """Run WsgiDAV using event_server from the wsgidav package."""
+    try:
+        import event_server
+        if config["verbose"] >= 2:
+            print "Running WsgiDAV %s on wsgidav.event_server..." % __version__
+        options = DEFAULT_CONFIG["event_server"].copy()
+        options.update(config.get("event_server", {}))
+        config = config.copy()
+        config["event_server"] = options
+        event_server.serve(config, app)
+    except ImportError, e:
+        if config["verbose"] >= 1:
+            print "Could not import wsgidav.event_server (part of WsgiDAV)."
+        return False
+    return True
+
+
+
+
 def _runBuiltIn(app, config, mode):
     """Run WsgiDAV using ext_wsgiutils_server from the wsgidav package."""
     try:
@@ -463,6 +585,7 @@ SUPPORTED_SERVERS = {"paste": _runPaste,
                      "flup-fcgi": _runFlup,
                      "flup-fcgi_fork": _runFlup,
                      "wsgidav": _runBuiltIn,
+                     "wsgidav-eventloop": _runEventLoop,
                      }
 
 
@@ -503,8 +626,223 @@ SUPPORTED_SERVERS = {"paste": _runPaste,
 #    return _real_run(config) 
 
 
+def _runWorker(config, readyFd):
+    """Run one pre-forked worker process (never returns).
+
+    Writes b"1" to readyFd when the server accepts connections.
+    """
+    # Let SIGTERM stop the server gracefully (like Ctrl-C does)
+    def _terminate(signum, frame):
+        # Only once: do not interrupt the shutdown
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        raise KeyboardInterrupt
+    def _ready():
+        try:
+            os.write(readyFd, b"1")
+            os.close(readyFd)
+        except OSError:
+            pass
+    signal.signal(signal.SIGTERM, _terminate)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    exitcode = 1
+    try:
+        app = WsgiDAVApp(config)
+        if _runCherryPy(app, config, "cherrypy-bundled", onReady=_ready):
+            exitcode = 0
+    except KeyboardInterrupt:
+        exitcode = 0
+    except:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    os._exit(exitcode)
+
+
+def _runPrefork(config):
+    """Run WsgiDAV in several worker processes that share the port.
+    
+    Every worker runs its own WsgiDAVApp and bundled CherryPy server, so 
+    request processing is not limited to one CPU core by the GIL.
+    The master process only supervises: 
+
+    - workers that die are restarted (delayed, if they die right away),
+    - SIGHUP restarts all workers one at a time: a new worker is started,
+      and only when it accepts connections is an old one stopped (it serves
+      the connections queued on its socket first),
+    - SIGTERM or SIGINT stops all workers and exits.
+    """
+    numWorkers = config["workers"]
+    verbose = config["verbose"]
+
+    # Locks must be visible to all workers
+    lockFolder = None
+    if config.get("locksmanager") is True:
+        from avax.webdav.wsgidav.lock_storage import LockStorageSqlite
+        path = config.get("lock_storage_path")
+        if not path:
+            # Private folder (mode 0700, unpredictable name), removed on exit
+            lockFolder = mkdtemp(prefix="wsgidav-locks-")
+            path = os.path.join(lockFolder, "locks.sqlite")
+        config["locksmanager"] = LockStorageSqlite(path)
+        if verbose >= 1:
+            print "Using shared lock storage %s" % path
+
+    # Digest nonces and session cookies issued by one worker must be 
+    # accepted by the others
+    digestConfig = config.setdefault("digest_auth", {})
+    if not digestConfig.get("nonce_secret"):
+        digestConfig["nonce_secret"] = os.urandom(20)
+    cookieConfig = config.setdefault("session_cookie", {})
+    if not cookieConfig.get("secret"):
+        cookieConfig["secret"] = os.urandom(20)
+
+    workers = {}  # pid -> start time
+    state = {"stop": False, "restart": False}
+
+    def _spawn():
+        """Start a worker; return the pipe that reports it is ready."""
+        readFd, writeFd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(readFd)
+            _runWorker(config, writeFd)
+        os.close(writeFd)
+        workers[pid] = time.time()
+        if verbose >= 2:
+            print "Started worker %s." % pid
+        return readFd
+
+    def _waitReady(readFd, timeout=60):
+        """Return True when the worker reports it is ready (False if it died)."""
+        deadline = time.time() + timeout
+        try:
+            while not state["stop"]:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                try:
+                    if select.select([readFd], [], [], remaining)[0]:
+                        return os.read(readFd, 1) == b"1"
+                except (select.error, OSError), e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+            return False
+        finally:
+            os.close(readFd)
+
+    def _retire(pid, timeout=30):
+        """Stop an old worker and wait until it has served its connections."""
+        retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                done, _status = os.waitpid(pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                done = pid  # Already reaped
+            if done:
+                workers.pop(pid, None)
+                retiring.discard(pid)
+                return
+            time.sleep(0.1)
+        # Still running: reaped by the main loop
+
+    def _stop(signum, frame):
+        state["stop"] = True
+    def _restart(signum, frame):
+        state["restart"] = True
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGHUP, _restart)
+
+    if verbose >= 1:
+        print "Starting %s worker processes..." % numWorkers
+    for _ in range(numWorkers):
+        os.close(_spawn())
+
+    retiring = set()
+    while not state["stop"]:
+        if state["restart"]:
+            state["restart"] = False
+            if verbose >= 1:
+                print "Restarting %s worker processes..." % len(workers)
+            for pid in [p for p in workers if p not in retiring]:
+                if state["stop"]:
+                    break
+                if not _waitReady(_spawn()):
+                    print >>sys.stderr, "New worker did not start: keeping the old ones."
+                    break
+                _retire(pid)
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid == 0:
+            time.sleep(0.5)
+            continue
+        started = workers.pop(pid, None)
+        if started is None:
+            continue
+        if pid in retiring:
+            retiring.discard(pid)
+            continue
+        if verbose >= 1:
+            print >>sys.stderr, "Worker %s died (status %s): restarting." % (pid, status)
+        if time.time() - started < 1:
+            # Avoid a fork loop, if workers die during start-up
+            time.sleep(1)
+        if not state["stop"]:
+            os.close(_spawn())
+
+    if verbose >= 1:
+        print "Stopping %s worker processes..." % len(workers)
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.time() + 10
+    while workers and time.time() < deadline:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            break
+        if pid == 0:
+            time.sleep(0.1)
+        else:
+            workers.pop(pid, None)
+    for pid in workers:
+        # Did not stop in time
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    if lockFolder is not None:
+        shutil.rmtree(lockFolder, ignore_errors=True)
+    return True
+
+
 def run():
     config = _initConfig()
+
+    if config.get("workers", 1) > 1:
+        if not hasattr(os, "fork") or "cherrypy-bundled" not in config["ext_servers"]:
+            print >>sys.stderr, "Multiple workers require the 'cherrypy-bundled' server on POSIX: using one process."
+        else:
+            _runPrefork(config)
+            return
     
     app = WsgiDAVApp(config)
     
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Log requests that took longer than a threshold.
+
+For every slow request one structured record is logged (as warning of this
+module's logger), no matter how `verbose` is configured::
+
+    Slow request: method=PROPFIND path=/dav/big/ depth=infinity user=tester
+    agent="Microsoft-WebDAV-MiniRedir/10.0" status=207 elapsed=12.480
+    bytes_in=0 bytes_out=84523112 phases="auth=0.1 route=0.0 resource=380.2
+    props=9100.5 serialize=2230.0 body=760.3"
+    calls="descendants=52310 lock_manager=2 property_manager=52311 props=52311 resource=1 ..."
+
+'phases' holds the durations in milliseconds. 'calls' holds the number of
+measurements per phase (e.g. 'resource' is the number of getResourceInst()
+calls, 'props' the number of resources whose properties were read) and
+counted events: 'descendants' is the number of resources visited by
+getDescendants(), 'lock_manager' and 'property_manager' the calls to these
+managers.
+
+This requires the phase timer (``timing.enable``, see `timing`).
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://wsgidav.readthedocs.org/en/latest/develop.html
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+from . import util
+from .access_log import _quote
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+
+#===============================================================================
+# SlowRequestLog
+#===============================================================================
+class SlowRequestLog(object):
+    """Log a record for every request that exceeds `threshold` seconds."""
+
+    def __init__(self, threshold=5.0, logger=None):
+        self.threshold = threshold
+        self.logger = logger or _logger
+        self.logged = 0
+
+    def __repr__(self):
+        return "%s(threshold=%s, logged=%s)" % (self.__class__.__name__,
+                                                self.threshold, self.logged)
+
+    def isSlow(self, timer):
+        """Return True if a finished request took too long."""
+        return timer.total >= self.threshold
+
+    def log(self, environ, timer, bytesIn=None, bytesOut=None):
+        """Log the record of a finished request."""
+        try:
+            self.logger.warning(b"Slow request: %s"
+                                % self.formatRecord(environ, timer, bytesIn, bytesOut))
+            self.logged += 1
+        except Exception:
+            _logger.exception("Could not log slow request")
+
+    def formatRecord(self, environ, timer, bytesIn=None, bytesOut=None):
+        """Return 'name=value ...' for a finished request."""
+        status = environ.get(b"wsgidav.response_status")
+        fields = (
+            (b"method", environ.get(b"REQUEST_METHOD")),
+            (b"path", environ.get(b"SCRIPT_NAME", b"") + environ.get(b"PATH_INFO", b"")),
+            (b"depth", environ.get(b"HTTP_DEPTH")),
+            (b"user", environ.get(b"http_authenticator.username")),
+            (b"agent", environ.get(b"HTTP_USER_AGENT")),
+            (b"status", status and status.split(b" ", 1)[0]),
+            (b"elapsed", b"%.3f" % timer.total),
+            (b"bytes_in", bytesIn),
+            (b"bytes_out", bytesOut),
+            (b"phases", timer.format()),
+            (b"calls", timer.formatCounts()),
+            )
+        return b" ".join(b"%s=%s" % (name, _quote(None if value is None else b"%s" % (value, )))
+                         for name, value in fields)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Phase timing of requests.
+
+If timing is enabled, WsgiDAVApp puts a `RequestTimer` into
+``environ["wsgidav.timer"]``. Code that handles a request adds the duration
+of its phases to it::
+
+    timer = timing.getTimer(environ)
+    t = timer.start()
+    ... parse ...
+    timer.stop("xml_parse", t)
+
+or decorates a function that takes the environ::
+
+    @timing.timed("locks", 2)
+    def _evaluateIfHeaders(self, res, environ):
+
+Without a timer (timing disabled), `getTimer()` returns a timer that does
+nothing, so the cost is a dictionary lookup per measured phase.
+
+Durations of the same phase are added up. Phases may overlap: for example,
+'locks' includes the resource lookups done while evaluating If headers.
+
+The timer also counts how often each phase was measured (e.g. 'resource' is
+the number of getResourceInst() calls), and other events of the request with
+`count()`. Code that has no environ (like the lock and property managers)
+counts its calls with the `counted` decorator; it uses the timer of the
+request that the current thread is working on (see `setCurrentTimer`).
+WsgiDAVApp sets it while the application is called, so calls made while
+the response body is sent are not counted. Only the outermost call is
+counted, if decorated functions of the same name call each other.
+
+When the request is done, the durations are written to the access log and
+added to a `TimingStats` aggregator. They may also be sent as
+'Server-Timing' response header (phases that ended before the response was
+started).
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://wsgidav.readthedocs.org/en/latest/develop.html
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import functools
+import threading
+import time
+from operator import itemgetter
+
+__docformat__ = "reStructuredText"
+
+# Monotonic where available (Python 3). On Python 2, ctypes' clock_gettime
+# costs more than 20 times as much as time.time(), so we use the latter.
+_clock = getattr(time, "monotonic", time.time)
+
+# Timer of the request that the current thread is working on
+_current = threading.local()
+
+
+#===============================================================================
+# RequestTimer
+#===============================================================================
+class RequestTimer(object):
+    """Durations of the phases of one request."""
+
+    def __init__(self):
+        self.started = _clock()
+        self.total = None
+        # {phase: seconds} and the phase names in order of first use
+        self.durations = {}
+        self.order = []
+        # Number of measurements and events {name: count}
+        self.counts = {}
+        # Phases started with begin() {phase: start time}
+        self._open = {}
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.format())
+
+    def start(self):
+        """Return a start time for stop()."""
+        return _clock()
+
+    def stop(self, name, startTime):
+        """Add the time since startTime to phase `name`."""
+        elapsed = _clock() - startTime
+        if name in self.durations:
+            self.durations[name] += elapsed
+            self.counts[name] += 1
+        else:
+            self.durations[name] = elapsed
+            self.order.append(name)
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def count(self, name, amount=1):
+        """Count an event of the request (without duration)."""
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def begin(self, name):
+        """Start a phase that is ended by end() in another part of the code."""
+        self._open[name] = _clock()
+
+    def end(self, name):
+        """End a phase started by begin() (ignored, if it was not started)."""
+        startTime = self._open.pop(name, None)
+        if startTime is not None:
+            self.stop(name, startTime)
+
+    def finish(self):
+        """End all open phases and set the total request time."""
+        for name in list(self._open):
+            self.end(name)
+        self.total = _clock() - self.started
+
+    def items(self):
+        """Return a list of (phase, seconds) in order of first use."""
+        return [(name, self.durations[name]) for name in self.order]
+
+    def format(self):
+        """Return 'phase=ms ...' (for the access log)."""
+        return b" ".join(b"%s=%.1f" % (name, seconds * 1000)
+                         for name, seconds in self.items())
+
+    def formatServerTiming(self):
+        """Return the value of a 'Server-Timing' header."""
+        return b", ".join(b"%s;dur=%.1f" % (name, seconds * 1000)
+                          for name, seconds in self.items())
+
+    def formatCounts(self):
+        """Return 'name=count ...' sorted by name."""
+        return b" ".join(b"%s=%s" % item
+                         for item in sorted(self.counts.items(), key=itemgetter(0)))
+
+
+class _NullTimer(object):
+    """Timer that is used when timing is disabled."""
+
+    def start(self):
+        return 0
+
+    def stop(self, name, startTime):
+        pass
+
+    def begin(self, name):
+        pass
+
+    def end(self, name):
+        pass
+
+    def count(self, name, amount=1):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def getTimer(environ):
+    """Return the timer of the request, or a timer that does nothing."""
+    if environ is None:
+        return NULL_TIMER
+    return environ.get(b"wsgidav.timer", NULL_TIMER)
+
+
+def setCurrentTimer(timer):
+    """Make `timer` the timer of the current thread (None to unset)."""
+    _current.timer = timer
+
+
+def getCurrentTimer():
+    """Return the timer of the current thread, or None."""
+    return getattr(_current, "timer", None)
+
+
+def counted(name):
+    """Decorator that counts calls as `name` in the timer of the current thread."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timer = getattr(_current, "timer", None)
+            outer = getattr(_current, "counting", None)
+            if timer is None or outer == name:
+                # Not timed, or called by another function counted as `name`
+                return func(*args, **kwargs)
+            timer.count(name)
+            _current.counting = name
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _current.counting = outer
+        return wrapper
+    return decorator
+
+
+def timed(name, environArg):
+    """Decorator that adds the duration of calls to phase `name`.
+
+    `environArg` is the position of the environ in the arguments (counting
+    `self`); it may also be passed as keyword argument.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if len(args) > environArg:
+                environ = args[environArg]
+            else:
+                environ = kwargs.get("environ")
+            timer = None if environ is None else environ.get(b"wsgidav.timer")
+            if timer is None:
+                return func(*args, **kwargs)
+            startTime = _clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer.stop(name, startTime)
+        return wrapper
+    return decorator
+
+
+#===============================================================================
+# TimingStats
+#===============================================================================
+class TimingStats(object):
+    """Aggregate the phase durations of all requests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {phase: [count, total seconds, max seconds]}
+        self._stats = {}
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(
+            "%s=%s" % (name, s[0]) for name, s in sorted(self._stats.items())))
+
+    def add(self, timer):
+        """Add the durations of a finished request."""
+        items = timer.items()
+        items.append((b"total", timer.total))
+        with self._lock:
+            stats = self._stats
+            for name, seconds in items:
+                s = stats.get(name)
+                if s is None:
+                    stats[name] = [1, seconds, seconds]
+                else:
+                    s[0] += 1
+                    s[1] += seconds
+                    if seconds > s[2]:
+                        s[2] = seconds
+
+    def snapshot(self, reset=False):
+        """Return {phase: (count, total seconds, max seconds)}."""
+        with self._lock:
+            result = dict((name, tuple(s)) for name, s in self._stats.items())
+            if reset:
+                self._stats = {}
+        return result
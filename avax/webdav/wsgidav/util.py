@@ -9,7 +9,8 @@ See `Developers info`_ for more information about the WsgiDAV architecture.
 from __future__ import absolute_import, division, unicode_literals
 
 from pprint import pformat
-from avax.webdav.wsgidav.xml_tools import xmlToString, makeSubElement
+from avax.webdav.wsgidav.xml_tools import xmlToString, makeSubElement, \
+    makeMultistatusEL, useLxml
 import urllib
 import socket
 
@@ -42,6 +43,8 @@ except ImportError:
 #import xml_tools
 ## Trick PyDev to do intellisense and don't produce warnings:
 from ..wsgidav.xml_tools import etree #@UnusedImport
+from ..wsgidav.timing import timed
+from ..wsgidav.metrics import getCacheStats
 from ..wsgidav.dav_error import DAVError, HTTP_PRECONDITION_FAILED, HTTP_NOT_MODIFIED,\
     HTTP_NO_CONTENT, HTTP_CREATED, getHttpStatusString, HTTP_BAD_REQUEST,\
     HTTP_OK
@@ -271,32 +274,34 @@ def _write(msg, var, module, level, flush):
 #    if level >= logger.getEffectiveLevel():
     if var is not None and level >= logger.getEffectiveLevel():
         logger.log(level, pformat(var, indent=4))
-    if flush:
+    # Handlers are flushed only on request; this is called on the request
+    # path, so don't pay for a flush per message
+    if flush and logger.isEnabledFor(level):
         for hdlr in logger.handlers:
             hdlr.flush()
 
 
-def write(msg, var=None, module=None, flush=True):  
+def write(msg, var=None, module=None, flush=False):  
     """Log always."""
     _write(msg, var, module, logging.CRITICAL, flush)
 
 
-def warn(msg, var=None, module=None, flush=True):
+def warn(msg, var=None, module=None, flush=False):
     """Log to stderr."""
     _write(msg, var, module, logging.ERROR, flush)
 
 
-def status(msg, var=None, module=None, flush=True):
+def status(msg, var=None, module=None, flush=False):
     """Log if not --quiet."""
     _write(msg, var, module, logging.WARNING, flush)
 
 
-def note(msg, var=None, module=None, flush=True):
+def note(msg, var=None, module=None, flush=False):
     """Log if --verbose."""
     _write(msg, var, module, logging.INFO, flush)
 
 
-def debug(msg, var=None, module=None, flush=True):
+def debug(msg, var=None, module=None, flush=False):
     """Log if --debug."""
     _write(msg, var, module, logging.DEBUG, flush)
 
@@ -529,6 +534,33 @@ def readAndDiscardInput(environ):
             warn("--> wsgi_input.read(): %s" % sys.exc_info())
 
 
+#===============================================================================
+# ClosingIterator
+#===============================================================================
+class ClosingIterator(object):
+    """Response iterable that passes iteration straight to `iterable`.
+
+    Unlike a generator that re-yields every chunk, iter() returns the
+    iterator of the wrapped iterable, so no Python code runs per chunk.
+    close() closes the wrapped iterable and then calls the callbacks
+    (the server calls it when the response is done, see PEP 333).
+    """
+    def __init__(self, iterable, *callbacks):
+        self._iterable = iterable
+        self._callbacks = callbacks
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, "close"):
+                self._iterable.close()
+        finally:
+            for callback in self._callbacks:
+                callback()
+
+
 #===============================================================================
 # SubAppStartResponse
 #===============================================================================
@@ -678,7 +710,16 @@ def parseXmlBody(environ, allowEmpty=False):
     - empty string: 
       WSGI allows it to be empty or absent: treated like 'missing'.  
     """
-    # 
+    requestbody = readRequestBody(environ)
+    return parseXmlString(environ, requestbody, allowEmpty)
+
+
+def readRequestBody(environ):
+    """Read the request body (see parseXmlBody() for Content-Length handling).
+    
+    Return an empty string, if no request body was sent.
+    Raise HTTP_BAD_REQUEST, if CONTENT_LENGTH is invalid.
+    """
     clHeader = environ.get(b"CONTENT_LENGTH", b"").strip()
 #    contentLength = -1 # read all of stream
     if clHeader == b"":
@@ -700,7 +741,15 @@ def parseXmlBody(environ, allowEmpty=False):
         else:
             requestbody = environ[b"wsgi.input"].read(contentLength)
             environ[b"wsgidav.all_input_read"] = 1
+    return requestbody
+
 
+@timed(b"xml_parse", 0)
+def parseXmlString(environ, requestbody, allowEmpty=False):
+    """Parse a request body that was read by readRequestBody().
+
+    See parseXmlBody().
+    """
     if requestbody == b"":
         if allowEmpty:
             return None
@@ -762,6 +811,7 @@ def sendStatusResponse(environ, start_response, e):
     return [ body ]
     
     
+@timed(b"serialize", 0)
 def sendMultiStatusResponse(environ, start_response, multistatusEL):
     # If logging of the body is desired, then this is the place to do it pretty:
     if environ.get(b"wsgidav.dump_response_body"):
@@ -776,7 +826,22 @@ def sendMultiStatusResponse(environ, start_response, multistatusEL):
     xml_data = xmlToString(multistatusEL, pretty_print=False)
     # if isinstance(xml_data, unicode):
     #    xml_data = xml_data.encode('utf-8')
+    return _sendMultiStatusData(start_response, xml_data)
+
+
+@timed(b"serialize", 0)
+def sendMultiStatusWriterResponse(environ, start_response, writer):
+    """Send the body that was collected by a MultiStatusWriter."""
+    xml_data = writer.getXml()
+    if environ.get(b"wsgidav.dump_response_body"):
+        xml = b"%s XML response body:\n%s" % (environ[b"REQUEST_METHOD"],
+                                             xmlToString(etree.fromstring(xml_data), 
+                                                         pretty_print=True))
+        environ[b"wsgidav.dump_response_body"] = xml
+    return _sendMultiStatusData(start_response, xml_data)
 
+
+def _sendMultiStatusData(start_response, xml_data):
     headers = [
         (b"Content-Type", b"application/xml"),
         (b"Date", getRfc1123Time()),
@@ -858,6 +923,205 @@ def addPropertyResponse(multistatusEL, href, propList):
         etree.SubElement(propstatEL, b"{DAV:}status").text = b"HTTP/1.1 %s" % status
     
 
+#===============================================================================
+# Fast multistatus serialization
+#===============================================================================
+# Byte templates for the markup that lxml generates for a <multistatus> body,
+# when all property names are in the {DAV:} namespace (see 
+# MultiStatusWriter and the differential test in tests/test_util.py)
+_MULTISTATUS_OPEN = b"<?xml version='1.0' encoding='UTF-8'?>\n<D:multistatus xmlns:D=\"DAV:\">"
+_MULTISTATUS_CLOSE = b"</D:multistatus>"
+_MULTISTATUS_EMPTY = b"<?xml version='1.0' encoding='UTF-8'?>\n<D:multistatus xmlns:D=\"DAV:\"/>"
+_RESPONSE_TEMPLATE = b"<D:response><D:href>%s</D:href>%s</D:response>"
+_PROPSTAT_TEMPLATE = b"<D:propstat><D:prop>%s</D:prop><D:status>HTTP/1.1 %s</D:status></D:propstat>"
+
+# Characters that lxml refuses to store in text nodes (raises ValueError)
+_xmlIncompatibleRE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+# Byte strings without these characters can be copied to the output unchanged
+_xmlNeedsEscapeRE = re.compile(b"[&<>\r\x00-\x08\x0b\x0c\x0e-\x1f\x80-\xff]")
+
+# {Clark name: (start tag, end tag, empty tag)} for the {DAV:} namespace 
+_davTagCache = {}
+_DAV_TAG_CACHE_MAX = 1000
+
+# {standalone serialization: rendered bytes} for element values like 
+# {DAV:}resourcetype or {DAV:}supportedlock, that are the same for most 
+# resources
+_davElementCache = {}
+_DAV_ELEMENT_CACHE_MAX = 128
+_davElementCacheStats = getCacheStats(b"xml_element")
+
+
+def _davTags(name):
+    """Return (start tag, end tag, empty tag) for a {DAV:} Clark name."""
+    tags = _davTagCache.get(name)
+    if tags is None:
+        localname = name[6:]
+        if isinstance(localname, unicode):
+            localname = localname.encode("utf8")
+        tags = (b"<D:%s>" % localname, 
+                b"</D:%s>" % localname, 
+                b"<D:%s/>" % localname)
+        if len(_davTagCache) < _DAV_TAG_CACHE_MAX:
+            _davTagCache[name] = tags
+    return tags
+
+
+def _renderXmlText(value):
+    """Return escaped, UTF-8 encoded text content, or None if lxml would 
+    reject (or encode differently) this value."""
+    if isinstance(value, str):
+        if not _xmlNeedsEscapeRE.search(value):
+            return value
+    elif not isinstance(value, unicode):
+        return None
+    value = toUnicode(value)
+    if _xmlIncompatibleRE.search(value):
+        return None
+    return value.replace(b"&", b"&amp;").replace(b"<", b"&lt;").replace(
+        b">", b"&gt;").replace(b"\r", b"&#13;").encode("utf8")
+
+
+def _renderDAVElement(element, out):
+    """Append serialized element to out and return True.
+    
+    Return False if the element is not a plain tree of {DAV:} elements without
+    attributes (lxml maps all those to the 'D:' prefix of <multistatus>).
+    """
+    tag = element.tag
+    if (not isinstance(tag, basestring) or not tag.startswith(b"{DAV:}")
+            or element.attrib):
+        return False
+    start, end, empty = _davTags(tag)
+    if element.text is None and len(element) == 0:
+        out.append(empty)
+    else:
+        out.append(start)
+        if element.text is not None:
+            text = _renderXmlText(element.text)
+            if text is None:
+                return False
+            out.append(text)
+        for child in element:
+            if not _renderDAVElement(child, out):
+                return False
+        out.append(end)
+    if element.tail is not None:
+        tail = _renderXmlText(element.tail)
+        if tail is None:
+            return False
+        out.append(tail)
+    return True
+
+
+def renderPropertyResponse(href, propList):
+    """Return a serialized <response> element for a multistatus body.
+
+    This is a template based alternative to addPropertyResponse() + 
+    xmlToString() for the common case, where all properties are in the 
+    {DAV:} namespace (i.e. standard live properties and lock properties).
+    The output is byte-identical to the lxml serialization.
+    
+    None is returned if the propList contains anything else (e.g. dead 
+    properties or complex values). The caller must then use 
+    addPropertyResponse().
+    """
+    # Same grouping as addPropertyResponse(), so the <propstat> elements
+    # come in the same (dict) order
+    propDict = {}
+    for name, value in propList:
+        if not name.startswith(b"{DAV:}"):
+            return None
+        status = b"200 OK"
+        if isinstance(value, DAVError):
+            status = getHttpStatusString(value)
+            value = None
+        propDict.setdefault(status, []).append( (name, value) )
+
+    hrefText = _renderXmlText(href)
+    if hrefText is None:
+        return None
+    propstats = []
+    for status in propDict:
+        out = []
+        for name, value in propDict[status]:
+            if value is None:
+                out.append(_davTags(name)[2])
+            elif isinstance(value, etree._Element):
+                # lxml's own serialization is cheap and identifies equal trees
+                key = etree.tostring(value)
+                data = _davElementCache.get(key)
+                if data is None:
+                    _davElementCacheStats.miss()
+                    elementOut = []
+                    if not _renderDAVElement(value, elementOut):
+                        return None
+                    data = b"".join(elementOut)
+                    if len(_davElementCache) >= _DAV_ELEMENT_CACHE_MAX:
+                        _davElementCache.clear()
+                    _davElementCache[key] = data
+                else:
+                    _davElementCacheStats.hit()
+                out.append(data)
+            else:
+                text = _renderXmlText(value)
+                if text is None:
+                    return None
+                start, end, _ = _davTags(name)
+                out.append(start + text + end)
+        propstats.append(_PROPSTAT_TEMPLATE 
+                         % (b"".join(out), _renderXmlText(status)))
+    return _RESPONSE_TEMPLATE % (hrefText, b"".join(propstats))
+
+
+class MultiStatusWriter(object):
+    """Collect <response> elements and serialize a <multistatus> body.
+    
+    Responses are rendered with renderPropertyResponse() where possible, 
+    otherwise the element tree is built with addPropertyResponse(). 
+    The fast path is only used with lxml, since the templates reproduce its 
+    serialization.
+    
+    Usage::
+    
+        writer = MultiStatusWriter()
+        for res in reslist:
+            writer.addPropertyResponse(res.getHref(), res.getProperties("allprop"))
+        return sendMultiStatusWriterResponse(environ, start_response, writer)
+    """
+    def __init__(self, useFastPath=None):
+        if useFastPath is None:
+            useFastPath = useLxml
+        self.useFastPath = useFastPath
+        self._chunks = []
+        self._multistatusEL = None
+        if not useFastPath:
+            self._multistatusEL = makeMultistatusEL()
+        
+    def addPropertyResponse(self, href, propList):
+        if not self.useFastPath:
+            addPropertyResponse(self._multistatusEL, href, propList)
+            return
+        data = renderPropertyResponse(href, propList)
+        if data is None:
+            # Serialize this <response> via lxml and cut it out of the 
+            # (otherwise empty) <multistatus> document
+            multistatusEL = makeMultistatusEL()
+            addPropertyResponse(multistatusEL, href, propList)
+            data = xmlToString(multistatusEL)
+            assert data.startswith(_MULTISTATUS_OPEN) and data.endswith(_MULTISTATUS_CLOSE)
+            data = data[len(_MULTISTATUS_OPEN):-len(_MULTISTATUS_CLOSE)]
+        self._chunks.append(data)
+
+    def getXml(self):
+        """Return the UTF-8 encoded XML document (including declaration)."""
+        if not self.useFastPath:
+            return xmlToString(self._multistatusEL, pretty_print=False)
+        if not self._chunks:
+            return _MULTISTATUS_EMPTY
+        return b"".join([_MULTISTATUS_OPEN] + self._chunks + [_MULTISTATUS_CLOSE])
+
+
 #===============================================================================
 # ETags
 #===============================================================================
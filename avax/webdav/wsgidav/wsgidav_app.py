@@ -57,19 +57,31 @@ from ..repo_provider import RepositoryProvider
 from ..archive_provider import ArchiveProvider
 
 from . import util
+from .timing import RequestTimer, TimingStats, getTimer, setCurrentTimer
+from .metrics import MetricsRegistry, DEFAULT_LATENCY_BUCKETS, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .rw_lock import LockInstrumentation, enableInstrumentation, getLockHolders
 from .error_printer import ErrorPrinter
 from .debug_filter import WsgiDavDebugFilter
-from .http_authenticator import HTTPAuthenticator
+from .http_authenticator import HTTPAuthenticator, NonceManager, SessionCookies
 from .request_resolver import RequestResolver
 from .domain_controller import WsgiDAVDomainController
 from .property_manager import PropertyManager
 from .lock_manager import LockManager
+from .admission_control import AdmissionController
+from .access_log import AccessLogger
+from .slow_request_log import SlowRequestLog
+from .request_profiler import RequestProfiler
 from .fs_dav_provider import FilesystemProvider
 
 __docformat__ = "reStructuredText"
 
 READONLY_METHODS = ['GET', 'HEAD', 'OPTIONS', 'PROPFIND', 'PROPGET', ]
 
+# Method labels of request metrics (others are counted as 'other')
+METRIC_METHODS = frozenset([b"OPTIONS", b"GET", b"HEAD", b"PUT", b"POST", b"DELETE",
+                            b"PROPFIND", b"PROPPATCH", b"MKCOL", b"COPY", b"MOVE",
+                            b"LOCK", b"UNLOCK"])
+
 logger = logging.getLogger(__name__)
 
 
@@ -84,10 +96,124 @@ DEFAULT_CONFIG = {
         b"wsgidav",
         ],
 
+    # Number of server processes (bundled CherryPy server on POSIX only).
+    # With more than one, the processes share the port (SO_REUSEPORT) and
+    # the default lock storage is replaced by an SQLite file shared by all.
+    b"workers": 1,
+    b"lock_storage_path": None,  # None: private temporary folder (locks are lost on exit)
+
+    # Worker threads of the bundled CherryPy server
+    b"thread_pool": {
+        b"min": 10,            # Threads started (and always kept alive)
+        b"max": 50,            # Upper limit when autoscaling (-1: no limit)
+        b"autoscale": True,    # Grow/shrink the pool with the load
+        b"interval": 1.0,      # Seconds between load samples
+        b"max_wait": 0.1,      # Busy if a request waited longer (seconds)
+        b"grow_after": 2,      # Consecutive busy samples before growing
+        b"shrink_after": 30,   # Consecutive idle samples before shrinking
+        b"spare": 2,           # Idle threads to keep above the minimum
+    },
+
+    # Serve bulk transfers from their own worker threads (bundled CherryPy
+    # server only), so they cannot block PROPFIND, LOCK, OPTIONS, ...
+    b"request_lanes": {
+        b"enable": True,
+        b"bulk_threads": 10,           # Worker threads of the bulk lane
+        b"bulk_min_size": 1024 * 1024, # PUT/POST bodies and GET responses of this
+                                       # size or larger
+        b"size_cache": 10000,          # Response sizes of GET URLs to remember
+                                       # (GET of other URLs uses the normal lane)
+    },
+
+    # Built-in server ('wsgidav' in ext_servers)
+    b"ext_server": {
+        b"threads": 10,              # Worker threads (one per open connection)
+        b"keep_alive_timeout": 15,   # Seconds an idle keep-alive connection holds a thread
+    },
+
+    # Event loop server ('wsgidav-eventloop' in ext_servers): connections
+    # are handled on one thread, application calls on a bounded pool
+    b"event_server": {
+        b"threads": 10,              # Worker threads for application calls
+        b"max_queued": 100,          # Requests queued for a worker (then wait on the loop)
+        b"max_connections": 10000,   # Open connections (then stop accepting)
+        b"keep_alive_timeout": 60,   # Seconds an idle keep-alive connection is kept
+        b"timeout": 30,              # Seconds without progress while sending or receiving
+    },
+
+    # Measure request phases (routing, auth, resource lookup, locks, XML, 
+    # properties, serialization, body, commit): written to the access log 
+    # and aggregated in WsgiDAVApp.timingStats
+    b"timing": {
+        b"enable": True,
+        b"server_timing_header": False,  # Send phases as 'Server-Timing' header
+    },
+
+    # Log method, path, phases and call counts of requests that take longer
+    # than the threshold (requires timing), regardless of verbose
+    b"slow_requests": {
+        b"enable": True,
+        b"threshold": 5.0,         # Seconds
+    },
+
+    # Request counts, latency histograms, bytes, active requests, locks,
+    # cache hit ratios, queue depths, ... (see metrics.MetricsRegistry)
+    b"metrics": {
+        b"enable": True,
+        b"path": None,             # Serve the metrics as text on this path,
+                                   # e.g. b"/.wsgidav/metrics" (not authenticated!)
+        b"latency_buckets": DEFAULT_LATENCY_BUCKETS,  # Histogram bounds (seconds)
+        b"stripes": 16,            # Locks per counter (more: less contention)
+        b"lock_stats": False,      # Wait and hold times of the locks of the
+                                   # lock and property managers
+    },
+
+    # Profile live requests with cProfile (see request_profiler). Active if
+    # a token or a sample rate is set.
+    b"profiler": {
+        b"token": None,            # Profile requests with 'X-WsgiDAV-Profile: <token>'
+                                   # header or '?wsgidav-profile=<token>'
+        b"sample_rate": 0,         # Profile one of every n requests (0: off)
+        b"max_active": 4,          # Requests profiled at the same time
+        b"path": None,             # Serve the aggregated report on this path
+                                   # (requires the token), e.g. b"/.wsgidav/profile"
+        b"file": None,             # Write the aggregated profile (pstats format)
+        b"save_interval": 60,      # Seconds between writes
+    },
+
+    # Run requests through a single flat dispatch instead of the stack of
+    # middleware generators (only used with verbose < 2)
+    b"compiled_pipeline": True,
+
     b"add_header_MS_Author_Via": True,
 
     b"propsmanager": None,  # True: use property_manager.PropertyManager
     b"locksmanager": True,  # True: use lock_manager.LockManager
+
+    # Request summaries (verbose >= 1), written by a background thread
+    b"access_log": {
+        b"enable": True,
+        b"file": None,             # Append to this file (None: stdout)
+        b"fields": None,           # None: classic line, or list of names, e.g.
+                                   # [b"time", b"remote_addr", b"user", b"method", b"uri",
+                                   #  b"status", b"bytes", b"elapsed", b"agent"]
+        b"queue_size": 10000,      # Pending entries (then new entries are dropped)
+        b"flush_interval": 1.0,    # Seconds between writes of pending entries
+    },
+
+    # Limit concurrent tree operations (Depth: infinity PROPFIND, COPY, MOVE, DELETE)
+    b"admission_control": {
+        b"enable": True,
+        b"max_heavy": 4,           # Heavy operations running at once (server-wide)
+        b"max_heavy_per_user": 1,  # Heavy operations running at once per user
+                                   # (per remote address for anonymous requests)
+        b"queue_timeout": 10,      # Seconds to wait for a slot, then '503'
+        b"retry_after": 30,        # Retry-After header of '503' responses
+        b"heavy_cost": 500,        # Subtrees with this many resources are heavy
+                                   # (sizes are learned from earlier tree walks)
+        b"max_unknown": 8,         # Walks of subtrees of unknown size at once
+                                   # (one per subtree; also per-user limited)
+    },
     
     # HTTP Authentication Options
     b"user_mapping": {},       # dictionary of dictionaries
@@ -95,6 +221,21 @@ DEFAULT_CONFIG = {
     b"acceptbasic": True,      # Allow basic authentication, True or False
     b"acceptdigest": True,     # Allow digest authentication, True or False
     b"defaultdigest": True,    # True (default digest) or False (default basic)
+    b"digest_auth": {
+        b"nonce_lifetime": 900,    # Seconds a nonce is valid (then 'stale=true')
+        b"max_nonces": 10000,      # Nonces whose counts are tracked (replay protection)
+        b"nonce_secret": None,     # Key that signs nonces (None: random per process)
+    },
+    # Accept later requests on a keep-alive connection for the user that was
+    # verified on it (bundled CherryPy server only). Not for use behind
+    # proxies that mix users on one connection.
+    b"connection_auth": False,
+    # Signed cookies for browser access (set by directory listings)
+    b"session_cookie": {
+        b"enable": False,
+        b"secret": None,           # Key that signs cookies (None: random per process)
+        b"max_age": 3600,          # Seconds
+    },
     
     b"enable_loggers": [
                       ],
@@ -126,6 +267,28 @@ def _checkConfig(config):
                 "Invalid configuration: missing required field '%s'" % field)
 
 
+def _getRangeSize(rangeHeader):
+    """Return the number of bytes requested by a Range header, or None.
+
+    None if there is no header, or a range is open ('bytes=100-').
+    """
+    if not rangeHeader or not rangeHeader.startswith(b"bytes="):
+        return None
+    size = 0
+    try:
+        for subrange in rangeHeader[6:].split(b","):
+            first, last = subrange.strip().split(b"-", 1)
+            if not last:
+                return None
+            if first:
+                size += int(last) - int(first) + 1
+            else:
+                size += int(last)
+    except ValueError:
+        return None
+    return size
+
+
 class WsgiDAVApp(object):
 
     def __init__(self, config, repository=None):
@@ -151,6 +314,50 @@ class WsgiDAVApp(object):
         else:
             self.locksManager = LockManager(lockStorage)
 
+        logConfig = DEFAULT_CONFIG[b"access_log"].copy()
+        logConfig.update(config.get(b"access_log", {}))
+        if self._verbose >= 1 and logConfig[b"enable"]:
+            stream = None
+            if logConfig[b"file"]:
+                stream = open(logConfig[b"file"], "ab")
+            self.accessLogger = AccessLogger(
+                stream=stream,
+                fields=logConfig[b"fields"],
+                maxQueued=logConfig[b"queue_size"],
+                flushInterval=logConfig[b"flush_interval"],
+                verbose=self._verbose)
+        else:
+            self.accessLogger = None
+
+        timingConfig = DEFAULT_CONFIG[b"timing"].copy()
+        timingConfig.update(config.get(b"timing", {}))
+        if timingConfig[b"enable"]:
+            self.timingStats = TimingStats()
+            self._serverTimingHeader = timingConfig[b"server_timing_header"]
+        else:
+            self.timingStats = None
+            self._serverTimingHeader = False
+
+        slowConfig = DEFAULT_CONFIG[b"slow_requests"].copy()
+        slowConfig.update(config.get(b"slow_requests", {}))
+        if self.timingStats is not None and slowConfig[b"enable"]:
+            self.slowRequestLog = SlowRequestLog(threshold=slowConfig[b"threshold"])
+        else:
+            self.slowRequestLog = None
+
+        admissionConfig = DEFAULT_CONFIG[b"admission_control"].copy()
+        admissionConfig.update(config.get(b"admission_control", {}))
+        if admissionConfig[b"enable"]:
+            self.admissionControl = AdmissionController(
+                maxHeavy=admissionConfig[b"max_heavy"],
+                maxHeavyPerUser=admissionConfig[b"max_heavy_per_user"],
+                queueTimeout=admissionConfig[b"queue_timeout"],
+                retryAfter=admissionConfig[b"retry_after"],
+                heavyCost=admissionConfig[b"heavy_cost"],
+                maxUnknown=admissionConfig[b"max_unknown"])
+        else:
+            self.admissionControl = None
+
         self.propsManager = config.get(b"propsmanager")
         if not self.propsManager:
             # Normalize False, 0 to None
@@ -184,31 +391,25 @@ class WsgiDAVApp(object):
         if self.mount_path:
             self.repo_provider.setMountPath(self.mount_path)
 
+        self._domainController = domainController
+        # Realm and authentication requirement per share {share: (realm, required)}.
+        # The default domain controller only looks at the share, so this can
+        # be computed once; other controllers are asked on every request.
+        self._authTable = {} if isDefaultDC else None
+
+        self.providerMap = {}
+        self._registerProvider(b'/', self.repo_provider)
+
         fs_provider = FilesystemProvider(os.path.join(environ.pod_dir(), b'temp'))
         fs_provider.setSharePath(b'/temp')
         fs_provider.setLockManager(self.locksManager)
         fs_provider.setPropManager(self.propsManager)
         if self.mount_path:
             fs_provider.setMountPath(self.mount_path)
-
-        self.providerMap = {}
-        self.providerMap[b'/'] = self.repo_provider
-        self.providerMap[b'/temp'] = fs_provider
+        self._registerProvider(b'/temp', fs_provider)
 
         for name in self.repository.repository_names():
-            archive = self.repository.get_repository(name)
-            provider = ArchiveProvider(self.repository,
-                                       name,
-                                       archive)
-            sharePath = b'/' + name
-            provider.setSharePath(sharePath)
-
-            if self.mount_path:
-                provider.setMountPath(self.mount_path)
-
-            provider.setLockManager(self.locksManager)
-            provider.setPropManager(self.propsManager)
-            self.providerMap[sharePath] = provider
+            self._addArchiveProvider(name)
 
         if self._verbose >= 2:
             logger.debug("Using lock manager: %r", self.locksManager)
@@ -229,24 +430,308 @@ class WsgiDAVApp(object):
                     # TODO: we should only warn here, if --no-auth is not given
                     logger.warning("WARNING: share '%s' will allow anonymous access.", share)
 
+        digestConfig = DEFAULT_CONFIG[b"digest_auth"].copy()
+        digestConfig.update(config.get(b"digest_auth", {}))
+        cookieConfig = DEFAULT_CONFIG[b"session_cookie"].copy()
+        cookieConfig.update(config.get(b"session_cookie", {}))
+        sessionCookies = None
+        if cookieConfig[b"enable"]:
+            sessionCookies = SessionCookies(secret=cookieConfig[b"secret"],
+                                            maxAge=cookieConfig[b"max_age"])
+        # Keyword arguments of HTTPAuthenticator
+        self._authOptions = {
+            b"nonceManager": NonceManager(lifetime=digestConfig[b"nonce_lifetime"],
+                                          maxNonces=digestConfig[b"max_nonces"],
+                                          secret=digestConfig[b"nonce_secret"]),
+            b"connectionAuth": config.get(b"connection_auth", False),
+            b"sessionCookies": sessionCookies,
+            }
+
         # Define WSGI application stack
-        application = RequestResolver()
-        
+        # The debug filter only has an effect with verbose >= 2. Without it,
+        # the stack is compiled into a single dispatch (see _compilePipeline).
+        self._compiled = config.get(b"compiled_pipeline", True) and self._verbose < 2
+        if self._compiled:
+            self._application = self._compilePipeline(config, domainController,
+                                                      authacceptbasic,
+                                                      authacceptdigest,
+                                                      authdefaultdigest)
+        else:
+            application = RequestResolver()
+            
+            if config.get(b"dir_browser") and config[b"dir_browser"].get(b"enable", True):
+                application = config[b"dir_browser"].get(b"app_class", WsgiDavDirBrowser)(application)
+
+            application = HTTPAuthenticator(application, 
+                                            domainController, 
+                                            authacceptbasic, 
+                                            authacceptdigest, 
+                                            authdefaultdigest,
+                                            **self._authOptions)
+            application = ErrorPrinter(application, catchall=False)
+
+            application = WsgiDavDebugFilter(application, config)
+            
+            self._application = application
+
+        laneConfig = config.get(b"request_lanes", {})
+        self._bulkMinSize = laneConfig.get(b"bulk_min_size", 1024 * 1024)
+        # Response sizes of earlier GETs {SCRIPT_NAME + PATH_INFO: bytes}
+        self._getSizes = {}
+        self._maxGetSizes = laneConfig.get(b"size_cache", 10000)
+
+        self._initMetrics(config)
+
+        profilerConfig = DEFAULT_CONFIG[b"profiler"].copy()
+        profilerConfig.update(config.get(b"profiler", {}))
+        if profilerConfig[b"token"] or profilerConfig[b"sample_rate"]:
+            self.profiler = RequestProfiler(token=profilerConfig[b"token"],
+                                            sampleRate=profilerConfig[b"sample_rate"],
+                                            maxActive=profilerConfig[b"max_active"],
+                                            filePath=profilerConfig[b"file"],
+                                            saveInterval=profilerConfig[b"save_interval"])
+            self._profilerPath = profilerConfig[b"path"]
+        else:
+            self.profiler = None
+            self._profilerPath = None
+
+    def _initMetrics(self, config):
+        """Create the metrics registry (self.metrics) and its standard metrics.
+
+        Servers may register more, e.g. the depth of their request queues.
+        """
+        metricsConfig = DEFAULT_CONFIG[b"metrics"].copy()
+        metricsConfig.update(config.get(b"metrics", {}))
+        self._metricsPath = None
+        if not metricsConfig[b"enable"]:
+            self.metrics = None
+            return
+        self.metrics = metrics = MetricsRegistry(stripes=metricsConfig[b"stripes"])
+        self._metricsPath = metricsConfig[b"path"]
+
+        labelNames = (b"method", b"provider", b"status", b"depth")
+        self._requestCount = metrics.counter(
+            b"wsgidav_requests_total", b"Finished requests.", labelNames)
+        self._requestLatency = metrics.histogram(
+            b"wsgidav_request_duration_seconds",
+            b"Request latency, until the response body was sent.",
+            labelNames, buckets=metricsConfig[b"latency_buckets"])
+        self._bytesIn = metrics.counter(
+            b"wsgidav_request_bytes_total", b"Request body bytes.", (b"method", ))
+        self._bytesOut = metrics.counter(
+            b"wsgidav_response_bytes_total", b"Response body bytes.", (b"method", ))
+        self._activeRequests = metrics.gauge(
+            b"wsgidav_active_requests", b"Requests in progress.")
+        self._commitLatency = metrics.histogram(
+            b"wsgidav_batch_commit_seconds", b"Duration of archive batch commits.",
+            (b"mode", ), buckets=metricsConfig[b"latency_buckets"])
+
+        storage = self.locksManager and self.locksManager.storage
+        if hasattr(storage, "countLocks"):
+            metrics.callback(b"wsgidav_locks", b"Active locks.", storage.countLocks)
+        if self.admissionControl is not None:
+            admissionControl = self.admissionControl
+            metrics.callback(b"wsgidav_heavy_operations", b"Heavy tree operations running.",
+                             lambda: admissionControl.running)
+        if self.accessLogger is not None:
+            accessLogger = self.accessLogger
+            metrics.callback(b"wsgidav_access_log_entries_total",
+                             b"Access log entries by result.",
+                             lambda: {(b"written", ): accessLogger.written,
+                                      (b"dropped", ): accessLogger.dropped},
+                             (b"result", ), kind=b"counter")
+        if self.timingStats is not None:
+            # {phase: (count, total seconds, max seconds)}
+            snapshot = self.timingStats.snapshot
+            metrics.callback(b"wsgidav_phase_seconds_total",
+                             b"Time spent in request phases.",
+                             lambda: dict(((name, ), s[1]) for name, s in snapshot().items()),
+                             (b"phase", ), kind=b"counter")
+            metrics.callback(b"wsgidav_phase_requests_total",
+                             b"Requests that passed a phase.",
+                             lambda: dict(((name, ), s[0]) for name, s in snapshot().items()),
+                             (b"phase", ), kind=b"counter")
+        if metricsConfig[b"lock_stats"]:
+            # Process-wide: covers the named locks of all apps
+            instrumentation = LockInstrumentation()
+            enableInstrumentation(instrumentation)
+            labelNames = (b"lock", b"mode")
+            metrics.add(b"wsgidav_rwlock_wait_seconds",
+                        b"Time waited to acquire read-write locks.",
+                        instrumentation.waits, labelNames)
+            metrics.add(b"wsgidav_rwlock_hold_seconds",
+                        b"Time read-write locks were held.",
+                        instrumentation.holds, labelNames)
+            metrics.add(b"wsgidav_rwlock_waiting",
+                        b"Threads waiting for read-write locks.",
+                        instrumentation.waiting, labelNames, kind=b"gauge")
+            metrics.add(b"wsgidav_rwlock_timeouts_total",
+                        b"Read-write lock acquisitions that timed out.",
+                        instrumentation.timeouts, labelNames)
+            metrics.callback(b"wsgidav_rwlock_holders",
+                             b"Threads holding read-write locks.",
+                             getLockHolders, labelNames)
+
+    def _registerProvider(self, sharePath, provider):
+        """Add a provider to the share map and the authentication table."""
+        if self._authTable is not None:
+            # Before the provider is published: requests that find it in
+            # providerMap expect its entry here
+            environ = {b"wsgidav.provider": provider,
+                       b"wsgidav.verbose": 0,
+                       }
+            realm = self._domainController.getDomainRealm(sharePath, environ)
+            self._authTable[sharePath] = (
+                realm, self._domainController.requireAuthentication(realm, environ))
+        return self.providerMap.setdefault(sharePath, provider)
+
+    def _addArchiveProvider(self, name):
+        """Create the provider for an archive and return it."""
+        archive = self.repository.get_repository(name)
+        provider = ArchiveProvider(self.repository,
+                                   name,
+                                   archive)
+        sharePath = b'/' + name
+        provider.setSharePath(sharePath)
+
+        if self.mount_path:
+            provider.setMountPath(self.mount_path)
+
+        provider.setLockManager(self.locksManager)
+        provider.setPropManager(self.propsManager)
+        return self._registerProvider(sharePath, provider)
+
+    def _compilePipeline(self, config, domainController, acceptbasic,
+                         acceptdigest, defaultdigest):
+        """Return the middleware stack as one flat application.
+
+        Authentication is followed by a per-method dispatch table, so the
+        directory browser only runs for GET and HEAD. No layer re-yields the
+        response: the iterable of the request handler is passed straight
+        through to the server (see ErrorPrinter.callFlat).
+        """
+        resolver = RequestResolver()
+        handleGet = resolver.callFlat
         if config.get(b"dir_browser") and config[b"dir_browser"].get(b"enable", True):
-            application = config[b"dir_browser"].get(b"app_class", WsgiDavDirBrowser)(application)
+            handleGet = config[b"dir_browser"].get(b"app_class", WsgiDavDirBrowser)(handleGet)
+
+        dispatchTable = {b"GET": handleGet,
+                         b"HEAD": handleGet,
+                         }
+        defaultHandler = resolver.callFlat
+
+        def dispatch(environ, start_response):
+            handler = dispatchTable.get(environ[b"REQUEST_METHOD"], defaultHandler)
+            return handler(environ, start_response)
+
+        application = HTTPAuthenticator(dispatch,
+                                        domainController,
+                                        acceptbasic,
+                                        acceptdigest,
+                                        defaultdigest,
+                                        **self._authOptions)
+        return ErrorPrinter(application, catchall=False).callFlat
+
+    def getRequestLane(self, environ):
+        """Return 'bulk' for requests that will transfer a lot of data.
+
+        This is called by the server before the request is processed, so only
+        the method and headers are used:
+        COPY, PROPFIND with 'Depth: infinity', PUT/POST with large (or chunked)
+        bodies and GET of large files are bulk requests.
+        Return None for all others.
+
+        The size of a GET response is taken from the Range header or from
+        an earlier response for the same URL. GET of a URL whose size is
+        not known yet (first request, or the size cache was cleared) is
+        served by the normal lane, so a cold cache cannot flood the bulk
+        lane with small files and collections.
+        """
+        method = environ[b"REQUEST_METHOD"]
+        if method == b"GET":
+            path = environ[b"PATH_INFO"]
+            if path.endswith(b"/"):
+                return None
+            size = _getRangeSize(environ.get(b"HTTP_RANGE"))
+            if size is None:
+                size = self._getSizes.get(environ.get(b"SCRIPT_NAME", b"") + path)
+            if size is not None and size >= self._bulkMinSize:
+                return b"bulk"
+        elif method in (b"PUT", b"POST"):
+            if (util.getContentLength(environ) >= self._bulkMinSize
+                or environ.get(b"HTTP_TRANSFER_ENCODING", b"").lower() == b"chunked"):
+                return b"bulk"
+        elif method == b"COPY":
+            return b"bulk"
+        elif method == b"PROPFIND":
+            if environ.get(b"HTTP_DEPTH", b"infinity").lower() == b"infinity":
+                return b"bulk"
+        return None
+
+    def __call__(self, environ, start_response):
+        if self._metricsPath is not None and environ[b"PATH_INFO"] == self._metricsPath:
+            return self._sendMetrics(environ, start_response)
+        if self._profilerPath is not None and environ[b"PATH_INFO"] == self._profilerPath:
+            return self.profiler.handleReportRequest(environ, start_response)
+        if self.timingStats is not None:
+            environ[b"wsgidav.timer"] = RequestTimer()
+        if self._compiled:
+            return self._callCompiled(environ, start_response)
+        return self._callStack(environ, start_response)
+
+    def _callCompiled(self, environ, start_response):
+        """Run the compiled pipeline and pass its response iterable through."""
+        # For code that has no environ (see timing.counted)
+        setCurrentTimer(environ.get(b"wsgidav.timer"))
+        try:
+            self._beginRequest(environ)
+            app_iter = self._application(environ,
+                                         self._wrapStartResponse(environ, start_response))
+        except:
+            self._endRequest(environ)
+            raise
+        finally:
+            # The body may be sent by another thread
+            setCurrentTimer(None)
+            self._stopProfile(environ)
+        getTimer(environ).begin(b"body")
+        return util.ClosingIterator(app_iter, lambda: self._endRequest(environ))
 
-        application = HTTPAuthenticator(application, 
-                                        domainController, 
-                                        authacceptbasic, 
-                                        authacceptdigest, 
-                                        authdefaultdigest)      
-        application = ErrorPrinter(application, catchall=False)
+    def _callStack(self, environ, start_response):
+        """Run the middleware stack and re-yield its output."""
+        _start_response_wrapper = self._wrapStartResponse(environ, start_response)
 
-        application = WsgiDavDebugFilter(application, config)
-        
-        self._application = application
+        # Call next middleware
+        nbytes = 0
+        try:
+            # For code that has no environ (see timing.counted)
+            setCurrentTimer(environ.get(b"wsgidav.timer"))
+            try:
+                self._beginRequest(environ)
+                app_iter = self._application(environ, _start_response_wrapper)
+            finally:
+                setCurrentTimer(None)
+                self._stopProfile(environ)
+            getTimer(environ).begin(b"body")
+            for v in app_iter:
+                nbytes += len(v)
+                yield v
+            if hasattr(app_iter, b"close"):
+                app_iter.close()
+        except Exception as ex:
+            # this should not happen, just in case.
+            logger.error("Error in calling application: %r", ex, exc_info=True)
+        finally:
+            entry = environ.get(b"wsgidav.access_log_entry")
+            if entry is not None:
+                entry["bytes"] = nbytes
+            environ[b"wsgidav.bytes_sent"] = nbytes
+            self._endRequest(environ)
 
-    def __call__(self, environ, start_response):
+        return
+
+    def _beginRequest(self, environ):
+        """Resolve the DAV provider and begin a batch for archive requests."""
 
 #        util.log("SCRIPT_NAME='%s', PATH_INFO='%s'" % (environ.get("SCRIPT_NAME"), environ.get("PATH_INFO")))
         
@@ -255,6 +740,9 @@ class WsgiDAVApp(object):
         # path = urllib.unquote(environ[b"PATH_INFO"])
         path = environ[b"PATH_INFO"]
 
+        timer = getTimer(environ)
+        startTime = timer.start()
+
         # issue 22: Pylons sends root as u'/' 
         if isinstance(path, unicode):
             util.log("Got unicode PATH_INFO: %r" % path)
@@ -264,6 +752,7 @@ class WsgiDAVApp(object):
         environ[b"wsgidav.config"] = self.config
         environ[b"wsgidav.provider"] = None
         environ[b"wsgidav.verbose"] = self._verbose
+        environ[b"wsgidav.admission_control"] = self.admissionControl
 
         ## Find DAV provider that matches the share
 
@@ -293,23 +782,22 @@ class WsgiDAVApp(object):
             provider = self.repo_provider
         else:
             provider = self.providerMap.get(share)
+            if provider is None and self.repository.has_repository(archive_name):
+                # Archive was created after startup (e.g. MKCOL on the root)
+                provider = self._addArchiveProvider(archive_name)
 
         logger.info("Provider:'%r' is used.", provider)
 
-        # bind a new batch to this request.
-        if isinstance(provider, ArchiveProvider):
-            method = environ[b"REQUEST_METHOD"]
-            logger.debug("method: %s", method)
-            readonly = method in READONLY_METHODS
-            if readonly:
-                logger.debug("Readonly request: %s", method)
-            batch = provider.archive.begin_batch(readonly=readonly)
-            environ[b'batch'] = batch
-
         # Note: we call the next app, even if provider is None, because OPTIONS 
         #       must still be handled.
         #       All other requests will result in '404 Not Found'  
         environ[b"wsgidav.provider"] = provider
+        # (realm, authentication required) for HTTPAuthenticator
+        if self._authTable is not None:
+            if provider is None:
+                environ[b"wsgidav.auth_realm"] = (None, False)
+            else:
+                environ[b"wsgidav.auth_realm"] = self._authTable[share]
 
         # TODO: test with multi-level realms: 'aa/bb'
         # TODO: test security: url contains '..'
@@ -333,8 +821,132 @@ class WsgiDAVApp(object):
         # PATH_INFO starts with '/'
         assert environ[b"PATH_INFO"] == b"" or environ[b"PATH_INFO"].startswith(b"/")
 
+        timer.stop(b"route", startTime)
+        if self.metrics is not None:
+            environ[b"wsgidav.metrics_start"] = time.time()
+            self._activeRequests.add()
+        if self.profiler is not None:
+            # Stopped by _stopProfile() in this thread
+            profile = self.profiler.start(environ)
+            if profile is not None:
+                environ[b"wsgidav.profile"] = profile
+
+        # bind a new batch to this request.
+        # (Last, so nothing can fail before _endRequest is sure to commit it.)
+        if isinstance(provider, ArchiveProvider):
+            method = environ[b"REQUEST_METHOD"]
+            logger.debug("method: %s", method)
+            readonly = method in READONLY_METHODS
+            if readonly:
+                logger.debug("Readonly request: %s", method)
+            batch = provider.archive.begin_batch(readonly=readonly)
+            environ[b'batch'] = batch
+
+    def _endRequest(self, environ):
+        """Commit the batch of this request, if any, and log the request."""
+        timer = getTimer(environ)
+        timer.end(b"body")
+        batch = environ.pop(b'batch', None)
+        if batch:
+            startTime = timer.start()
+            commitStart = time.time()
+            batch.commit()
+            timer.stop(b"commit", startTime)
+            if self.metrics is not None:
+                mode = b"read" if environ[b"REQUEST_METHOD"] in READONLY_METHODS else b"write"
+                self._commitLatency.observe((mode, ), time.time() - commitStart)
+        metricsStart = environ.pop(b"wsgidav.metrics_start", None)
+        if metricsStart is not None:
+            self._recordRequest(environ, metricsStart)
+        if environ[b"REQUEST_METHOD"] == b"GET":
+            self._recordGetSize(environ)
+        entry = environ.pop(b"wsgidav.access_log_entry", None)
+        if self.timingStats is not None:
+            timer.finish()
+            self.timingStats.add(timer)
+            if entry is not None:
+                entry["timing"] = timer.format()
+            if self.slowRequestLog is not None and self.slowRequestLog.isSlow(timer):
+                self.slowRequestLog.log(environ, timer,
+                                        bytesIn=util.getContentLength(environ),
+                                        bytesOut=self._getBytesSent(environ))
+        # Never leave a finished request's timer on the finishing thread
+        setCurrentTimer(None)
+        if entry is not None:
+            self.accessLogger.log(entry)
+
+    def _stopProfile(self, environ):
+        """Stop profiling the request (in the thread that called the app)."""
+        profile = environ.pop(b"wsgidav.profile", None)
+        if profile is not None:
+            self.profiler.stop(profile)
+
+    def _recordGetSize(self, environ):
+        """Remember the size of a GET response for getRequestLane()."""
+        status = environ.get(b"wsgidav.response_status")
+        length = environ.get(b"wsgidav.response_length")
+        if not status or not status.startswith(b"200") or not length:
+            return
+        if len(self._getSizes) >= self._maxGetSizes:
+            self._getSizes.clear()
+        # SCRIPT_NAME + PATH_INFO is still the URL that getRequestLane() saw
+        self._getSizes[environ[b"SCRIPT_NAME"] + environ[b"PATH_INFO"]] = int(length)
+
+    def _recordRequest(self, environ, startTime):
+        """Add a finished request to the metrics."""
+        method = environ[b"REQUEST_METHOD"]
+        if method not in METRIC_METHODS:
+            method = b"other"
+        provider = environ.get(b"wsgidav.provider")
+        providerName = b"none" if provider is None else provider.__class__.__name__
+        status = environ.get(b"wsgidav.response_status")
+        status = b"none" if status is None else status.split(b" ", 1)[0]
+        depth = environ.get(b"HTTP_DEPTH", b"none").lower()
+        if depth not in (b"0", b"1", b"infinity", b"none"):
+            depth = b"other"
+        labels = (method, providerName, status, depth)
+        self._requestCount.add(labels)
+        self._requestLatency.observe(labels, time.time() - startTime)
+        self._bytesIn.add((method, ), util.getContentLength(environ))
+        sent = self._getBytesSent(environ)
+        if sent:
+            self._bytesOut.add((method, ), sent)
+        self._activeRequests.add((), -1)
+
+    def _getBytesSent(self, environ):
+        """Return the size of the response body."""
+        # Counted by _callStack, otherwise taken from Content-Length
+        sent = environ.get(b"wsgidav.bytes_sent")
+        if sent is None:
+            if environ[b"REQUEST_METHOD"] == b"HEAD":
+                return 0
+            try:
+                sent = int(environ.get(b"wsgidav.response_length") or 0)
+            except ValueError:
+                sent = 0
+        return sent
+
+    def _sendMetrics(self, environ, start_response):
+        """Answer a request on the metrics path."""
+        method = environ[b"REQUEST_METHOD"]
+        if method not in (b"GET", b"HEAD"):
+            start_response(b"405 Method Not Allowed", [(b"Allow", b"GET, HEAD"),
+                                                       (b"Content-Length", b"0")])
+            return [b""]
+        body = self.metrics.render()
+        start_response(b"200 OK", [(b"Content-Type", METRICS_CONTENT_TYPE),
+                                   (b"Content-Length", str(len(body))),
+                                   (b"Cache-Control", b"no-cache"),
+                                   ])
+        if method == b"HEAD":
+            return [b""]
+        return [body]
+
+    def _wrapStartResponse(self, environ, start_response):
+        """Return a start_response that checks headers and logs the request."""
         start_time = time.time()
 
+
         def _start_response_wrapper(status, response_headers, exc_info=None):
             # util.log("_start_response_wrapped entered.")
             # Postprocess response headers
@@ -382,70 +994,22 @@ class WsgiDAVApp(object):
                 util.warn("Adding 'Connection: close' header")
                 response_headers.append((b"Connection", b"close"))
             
-            # Log request
-            if self._verbose >= 1:
-                userInfo = environ.get(b"http_authenticator.username")
-                if not userInfo:
-                    userInfo = b"(anonymous)"
-                threadInfo = b""
-                if self._verbose >= 1:
-                    threadInfo = b"<%s> " % threading._get_ident()
-                extra = []
-                if b"HTTP_DESTINATION" in environ:
-                    extra.append(b'dest="%s"' % environ.get(b"HTTP_DESTINATION"))
-                if environ.get(b"CONTENT_LENGTH", b"") != b"":
-                    extra.append(b"length=%s" % environ.get(b"CONTENT_LENGTH"))
-                if b"HTTP_DEPTH" in environ:
-                    extra.append(b"depth=%s" % environ.get(b"HTTP_DEPTH"))
-                if b"HTTP_RANGE" in environ:
-                    extra.append(b"range=%s" % environ.get(b"HTTP_RANGE"))
-                if b"HTTP_OVERWRITE" in environ:
-                    extra.append(b"overwrite=%s" % environ.get(b"HTTP_OVERWRITE"))
-                if self._verbose >= 1 and b"HTTP_EXPECT" in environ:
-                    extra.append(b'expect="%s"' % environ.get(b"HTTP_EXPECT"))
-                if self._verbose >= 2 and b"HTTP_CONNECTION" in environ:
-                    extra.append(b'connection="%s"' % environ.get(b"HTTP_CONNECTION"))
-                if self._verbose >= 2 and b"HTTP_USER_AGENT" in environ:
-                    extra.append(b'agent="%s"' % environ.get(b"HTTP_USER_AGENT"))
-                if self._verbose >= 2 and b"HTTP_TRANSFER_ENCODING" in environ:
-                    extra.append(b'transfer-enc=%s' % environ.get(b"HTTP_TRANSFER_ENCODING"))
-                if self._verbose >= 1:
-                    extra.append(b'elap=%.3fsec' % (time.time() - start_time))
-                extra = b", ".join(extra)
-                        
-#               This is the CherryPy format:     
-#                127.0.0.1 - - [08/Jul/2009:17:25:23] "GET /loginPrompt?redirect=/renderActionList%3Frelation%3Dpersonal%26key%3D%26filter%3DprivateSchedule&reason=0 HTTP/1.1" 200 1944 "http://127.0.0.1:8002/command?id=CMD_Schedule" "Mozilla/5.0 (Windows; U; Windows NT 6.0; de; rv:1.9.1) Gecko/20090624 Firefox/3.5"
-#                print >>sys.stderr, '%s - %s - [%s] "%s" %s -> %s' % (
-                print(b'%s - %s - [%s] "%s" %s -> %s' % (
-                                        threadInfo + environ.get(b"REMOTE_ADDR", b""),
-                                        userInfo,
-                                        util.getLogTime(), 
-                                        environ.get(b"REQUEST_METHOD") + b" " + environ.get(b"PATH_INFO", b""),
-                                        extra, 
-                                        status,
-#                                        response_headers.get(""), # response Content-Length
-                                        # referer
-                ), file=sys.stdout)
+            if self._serverTimingHeader and b"wsgidav.timer" in environ:
+                response_headers.append((b"Server-Timing",
+                                         environ[b"wsgidav.timer"].formatServerTiming()))
+
+            # For metrics and the slow request log
+            environ[b"wsgidav.response_status"] = status
+            environ[b"wsgidav.response_length"] = currentContentLength
+
+            # Log request (written by the access logger when the response is done)
+            if self.accessLogger is not None:
+                environ[b"wsgidav.access_log_entry"] = self.accessLogger.makeEntry(
+                    environ, status, response_headers, start_time)
 
             # util.log("_start_response_wrapped CHECKPOINT 1.")
 
             return start_response(status, response_headers, exc_info)
             
-        # Call next middleware
-        try:
-            app_iter = self._application(environ, _start_response_wrapper)
-            for v in app_iter:
-                yield v
-            if hasattr(app_iter, b"close"):
-                app_iter.close()
-        except Exception as ex:
-            # this should not happen, just in case.
-            logger.error("Error in calling application: %r", ex, exc_info=True)
-        finally:
-            # commit batch if any.
-            batch = environ.get(b'batch')
-            if batch:
-                batch.commit()
-                del environ[b'batch']
 
-        return
+        return _start_response_wrapper